@@ -0,0 +1,151 @@
+"""频道路由 - 一个后端同时桥接多个 QQ 群和多个 MC 服务器
+
+每个 MC 服务器是一个频道，拥有独立的令牌、消息队列和玩家缓存；
+路由表按 QQ 群号和令牌建立索引，每条事件的查找都是一次字典访问。
+多个频道绑定同一个群（如公告群）时，群消息扇出到所有这些频道，
+频道的 MC 事件则发送到它绑定的所有群。
+管理令牌（API_TOKEN）可以查看所有频道的状态和运行指标，频道令牌只能查看本频道的状态
+"""
+import logging
+import os
+import secrets
+from typing import Iterator, Optional
+
+from app.config import DEFAULT_API_TOKEN, ChannelConfig, settings
+from app.message_queue import MessageQueueManager, QUEUE_LAST_SEQ, QUEUE_PENDING, create_message_queue
+from app.player_cache import PlayerCache
+from app.shared_queue import SharedMessageQueue
+from app.state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# 未配置 CHANNELS 时由 API_TOKEN 和 QQ_GROUP_ID 组成的频道名
+DEFAULT_CHANNEL = "default"
+
+
+class Channel:
+    """一个 MC 服务器频道"""
+
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        groups: tuple[int, ...],
+        queue: MessageQueueManager | SharedMessageQueue,
+        players: PlayerCache
+    ):
+        self.name = name
+        self.token = token
+        self.groups = groups
+        self.queue = queue
+        self.players = players
+
+    def __repr__(self) -> str:
+        return f"Channel({self.name!r}, groups={self.groups})"
+
+
+class ChannelRouter:
+    """频道路由表"""
+
+    def __init__(self, channels: list[Channel], admin_token: Optional[str] = None):
+        if not channels:
+            raise ValueError("At least one channel is required")
+        self._channels = {channel.name: channel for channel in channels}
+        if len(self._channels) != len(channels):
+            raise ValueError("Duplicate channel name")
+
+        self._admin_token = admin_token
+        self._by_token: dict[str, Channel] = {}
+        self._by_group: dict[int, tuple[Channel, ...]] = {}
+        for channel in channels:
+            if channel.token in self._by_token:
+                raise ValueError(f"Channel {channel.name} reuses another channel's token")
+            self._by_token[channel.token] = channel
+            for group_id in channel.groups:
+                self._by_group[group_id] = self._by_group.get(group_id, ()) + (channel,)
+
+    def __iter__(self) -> Iterator[Channel]:
+        return iter(self._channels.values())
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    @property
+    def groups(self) -> list[int]:
+        """所有被桥接的 QQ 群"""
+        return list(self._by_group)
+
+    def get(self, name: str) -> Optional[Channel]:
+        return self._channels.get(name)
+
+    def by_token(self, token: str) -> Optional[Channel]:
+        """按令牌查找频道，令牌无效时返回 None"""
+        return self._by_token.get(token)
+
+    def is_admin(self, token: str) -> bool:
+        """是否为管理令牌"""
+        return self._admin_token is not None and secrets.compare_digest(token, self._admin_token)
+
+    def for_group(self, group_id: int) -> tuple[Channel, ...]:
+        """群消息要转发到的频道，未桥接的群返回空元组"""
+        return self._by_group.get(group_id, ())
+
+    async def start(self):
+        """恢复所有频道的持久化队列"""
+        for channel in self:
+            await channel.queue.start()
+
+    async def close(self):
+        for channel in self:
+            await channel.queue.close()
+
+
+def _build_channels() -> list[Channel]:
+    if not settings.channels:
+        return [_create_channel(
+            ChannelConfig(name=DEFAULT_CHANNEL, token=settings.api_token, groups=[settings.qq_group_id]),
+            settings.queue_data_dir
+        )]
+    # 每个频道的队列保存在各自的子目录中，只接受各频道自己的令牌
+    return [
+        _create_channel(config, os.path.join(settings.queue_data_dir, config.name) if settings.queue_data_dir else "")
+        for config in settings.channels
+    ]
+
+
+def _admin_token() -> Optional[str]:
+    """未配置 CHANNELS 时 API_TOKEN 既是频道令牌也是管理令牌；配置后只作为管理令牌"""
+    if not settings.channels:
+        return settings.api_token
+    if settings.api_token == DEFAULT_API_TOKEN:
+        # 公开的默认值不能授予查看所有频道的权限
+        logger.warning("API_TOKEN is the default value, admin access to /api/status and /api/metrics is disabled")
+        return None
+    if any(config.token == settings.api_token for config in settings.channels):
+        raise ValueError("API_TOKEN must differ from every channel token when CHANNELS is configured")
+    return settings.api_token
+
+
+def _create_channel(config: ChannelConfig, data_dir: str) -> Channel:
+    if not shared_state.shared:
+        queue, players = create_message_queue(data_dir), PlayerCache()
+    else:
+        # 多 worker 部署：队列和玩家缓存保存在共享状态中
+        queue = SharedMessageQueue(
+            shared_state,
+            f"queue:{config.name}",
+            max_size=settings.queue_max_size,
+            poll_interval=settings.state_poll_interval_ms / 1000
+        )
+        players = PlayerCache(shared_state, f"players:{config.name}")
+    return Channel(config.name, config.token, tuple(config.groups), queue, players)
+
+
+# 全局路由表
+channel_router = ChannelRouter(_build_channels(), _admin_token())
+QUEUE_PENDING.set_function(lambda: {
+    (channel.name, consumer): pending
+    for channel in channel_router
+    for consumer, pending in channel.queue.pending_by_consumer().items()
+})
+QUEUE_LAST_SEQ.set_function(lambda: {(channel.name,): channel.queue.last_seq for channel in channel_router})
@@ -0,0 +1,121 @@
+"""机器人命令服务 - 直接读取进程内的共享状态生成命令回复
+
+回复按所依赖数据的版本缓存，数据未变化时直接返回上次渲染的文本
+"""
+import logging
+from typing import Callable, Hashable, Optional
+
+from app.channels import Channel
+from app.metrics import Counter
+from app.player_cache import PlayerCache, CACHE_EXPIRE_SECONDS
+from app.server_stats import ServerStatsSampler, server_stats
+
+logger = logging.getLogger(__name__)
+
+REPLY_CACHE = Counter("mcqq_command_reply_cache_total", "Command replies served from or rendered into the cache", ("command", "result"))
+
+HELP_REPLY = """📖 可用命令:
+  • list - 查看在线玩家
+  • status - 查看服务器状态
+  • help - 显示此帮助"""
+
+ADMIN_HELP_REPLY = HELP_REPLY + """
+
+🔧 管理员命令:
+  • start - 启动服务器
+  • stop - 关闭服务器
+  • restart - 重启服务器
+  • cmd <命令> - 执行游戏内命令"""
+
+
+class CommandService:
+    """命令服务
+
+    每个命令的回复与生成它时的数据版本一起缓存，
+    版本（如玩家列表版本、采样版本）变化后才重新渲染
+    """
+
+    def __init__(self, server: ServerStatsSampler):
+        self._server = server
+        self._replies: dict[str, tuple[Hashable, str]] = {}
+
+    def list_reply(self, channels: tuple[Channel, ...]) -> str:
+        """群所绑定的各服务器的在线玩家列表"""
+        # 缓存过期与否不会改变版本，需要一起作为缓存键
+        version = tuple((channel.players.version, channel.players.is_stale()) for channel in channels)
+        key = "list:" + ",".join(channel.name for channel in channels)
+        return self._cached("list", key, version, lambda: self._render_lists(channels))
+
+    def status_reply(self) -> str:
+        """服务器运行状态"""
+        return self._cached("status", "status", self._server.version, self._render_status)
+
+    def help_reply(self, is_admin: bool) -> str:
+        return ADMIN_HELP_REPLY if is_admin else HELP_REPLY
+
+    def _cached(self, command: str, key: str, version: Hashable, render: Callable[[], str]) -> str:
+        cached = self._replies.get(key)
+        if cached is not None and cached[0] == version:
+            REPLY_CACHE.inc(command, "hit")
+            return cached[1]
+        REPLY_CACHE.inc(command, "miss")
+        reply = render()
+        self._replies[key] = (version, reply)
+        return reply
+
+    def _render_lists(self, channels: tuple[Channel, ...]) -> str:
+        if len(channels) == 1:
+            return self._render_list(channels[0].players)
+        # 公告群等绑定多个服务器的群，逐个列出
+        return "\n\n".join(f"[{channel.name}]\n{self._render_list(channel.players)}" for channel in channels)
+
+    def _render_list(self, players: PlayerCache) -> str:
+        data = players.get_players()
+        # 如果数据已过期，说明服务器可能离线
+        if data["stale"]:
+            return f"🔴 服务器可能已离线（超过{CACHE_EXPIRE_SECONDS}秒无响应）"
+        if data["online_count"] == 0:
+            return "📊 当前服务器无人在线"
+        player_list = "\n".join(f"  • {p}" for p in data["players"])
+        return f"📊 在线玩家 ({data['online_count']}/{data['max_players']}):\n{player_list}"
+
+    def _render_status(self) -> str:
+        if not self._server.available:
+            return "⚠️ 无法获取服务器状态（系统不支持 /proc）"
+        snapshot = self._server.snapshot()
+        if snapshot is None:
+            return "🔴 服务器状态: 已停止"
+
+        trends = snapshot["trends"].values()
+        threads = snapshot["threads"]
+        return f"""🟢 服务器状态: 运行中
+💾 内存占用: {_format_gib(snapshot["rss_bytes"])}
+⚡ CPU 使用: {_format_percent(snapshot["cpu_percent"])}
+🧵 线程数: {threads if threads is not None else "N/A"}
+⏱️ 运行时间: {_format_uptime(snapshot["uptime_seconds"])}
+📈 1/5/15 分钟平均:
+  内存 {" / ".join(_format_gib(t and t["rss_bytes"]) for t in trends)}
+  CPU {" / ".join(_format_percent(t and t["cpu_percent"]) for t in trends)}"""
+
+
+def _format_gib(value: Optional[float]) -> str:
+    return f"{value / 1024 ** 3:.1f}G" if value is not None else "N/A"
+
+
+def _format_percent(value: Optional[float]) -> str:
+    return f"{value:.1f}%" if value is not None else "N/A"
+
+
+def _format_uptime(seconds: Optional[float]) -> str:
+    """格式化为 [天] 时:分:秒"""
+    if seconds is None:
+        return "N/A"
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    clock = f"{hours:02d}:{minutes:02d}:{secs:02d}"
+    return f"{days}天 {clock}" if days else clock
+
+
+# 全局命令服务实例
+command_service = CommandService(server_stats)
@@ -0,0 +1,91 @@
+"""并发控制 - 相同请求合并（single-flight）与按提供方限制并发"""
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """合并进行中的相同请求
+
+    同一个键同时只执行一次，其余调用方等待同一个结果；
+    调用方被取消不会取消共享的任务
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+        self._shared = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    @property
+    def shared(self) -> int:
+        """被合并（未重复执行）的调用次数"""
+        return self._shared
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """执行 fn，若同键请求正在进行则等待其结果"""
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._finish(key, f))
+        else:
+            self._shared += 1
+        return await asyncio.shield(future)
+
+    def _finish(self, key: str, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # 所有调用方都已取消时由这里取走异常，避免 "exception was never retrieved"
+        if not future.cancelled():
+            future.exception()
+
+
+class ConcurrencyLimiter:
+    """按键（如 API 提供方）限制并发请求数，超出的请求排队"""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._slots: dict[str, asyncio.Semaphore] = {}
+        self._active: dict[str, int] = defaultdict(int)
+        self._waiting: dict[str, int] = defaultdict(int)
+
+    @asynccontextmanager
+    async def slot(self, key: str) -> AsyncIterator[None]:
+        semaphore = self._slots.get(key)
+        if semaphore is None:
+            semaphore = self._slots[key] = asyncio.Semaphore(self._limit)
+
+        self._waiting[key] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[key] -= 1
+
+        self._active[key] += 1
+        try:
+            yield
+        finally:
+            self._active[key] -= 1
+            semaphore.release()
+
+    def waiting(self) -> int:
+        """所有键排队中的请求总数"""
+        return sum(self._waiting.values())
+
+    def stats(self) -> dict:
+        return {
+            key: {
+                "active": self._active[key],
+                "waiting": self._waiting[key],
+                "limit": self._limit,
+            }
+            for key in self._slots
+        }
@@ -1,30 +1,90 @@
+from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import List, Optional
+
+
+# API_TOKEN 的默认值，公开在示例配置中，不能用于实际部署
+DEFAULT_API_TOKEN = "your-secret-token"
+
+
+class ChannelConfig(BaseModel):
+    """一个 MC 服务器频道：该服务器使用的令牌及其绑定的 QQ 群"""
+    name: str = Field(pattern=r"^[A-Za-z0-9_-]{1,64}$")  # 频道名，同时用作队列目录名
+    token: str
+    groups: List[int] = Field(min_length=1)
 
 
 class Settings(BaseSettings):
     # FastAPI 服务配置
     host: str = "0.0.0.0"
     port: int = 8765
-    api_token: str = "your-secret-token"
+    api_token: str = DEFAULT_API_TOKEN
+    ws_heartbeat_interval: int = 20  # MC mod WebSocket 心跳间隔（秒）
+
+    # 消息队列配置
+    queue_max_size: int = 1000  # 队列保留的最大消息数
+    queue_data_dir: str = "data/queue"  # 持久化目录，留空则仅保存在内存中
+    queue_fsync_interval_ms: int = 200  # 批量 fsync 间隔（毫秒）
+    queue_segment_max_records: int = 5000  # 单个日志段的最大记录数
+    # 队列满时的处理策略：drop-oldest / drop-lowest-priority / collapse-duplicates / spill-to-disk
+    queue_overflow_policy: str = "drop-lowest-priority"
+    queue_spill_max_records: int = 50000  # spill-to-disk 策略下磁盘保留的最大消息数
+
+    # 多 worker 部署配置
+    workers: int = 1  # uvicorn worker 进程数，大于 1 时需要 STATE_BACKEND=sqlite
+    # 状态后端：memory 保存在进程内（单 worker）；sqlite 保存在 SQLite 数据库中，多个 worker 共享队列、玩家缓存和锁
+    state_backend: str = "memory"
+    state_path: str = "data/state.sqlite3"  # sqlite 状态数据库路径
+    state_poll_interval_ms: int = 100  # 共享队列长轮询检查其他 worker 入队消息的间隔（毫秒）
+    leader_lease_seconds: float = 15.0  # NapCat 连接的 leader 租约时长（秒），leader 退出后其他 worker 最迟在此时间后接管
 
     # NapCat WebSocket 配置
     napcat_ws_url: str = "ws://localhost:3001"
     napcat_access_token: Optional[str] = None
+    napcat_reconnect_min_seconds: float = 1.0  # 断线后首次重连的延迟（秒），之后每次翻倍并加入随机抖动
+    napcat_reconnect_max_seconds: float = 30.0  # 重连延迟上限（秒）
+    napcat_replay_buffer_size: int = 200  # 断线期间缓存的待发群消息上限，超出时丢弃最旧的
+    napcat_replay_interval_ms: int = 500  # 重连后补发缓存消息的间隔（毫秒）
 
     # QQ 群配置
     qq_group_id: int = 123456789
+    # 多服务器/多群路由（JSON 数组），每个 MC 服务器一个频道，使用独立的令牌和消息队列；
+    # 多个频道绑定同一个群时，群消息转发到所有这些服务器。留空则由 API_TOKEN 和 QQ_GROUP_ID 组成单个频道
+    channels: List[ChannelConfig] = []
     bot_qq: int = 0  # 机器人QQ号，用于检测@机器人
     admin_qq: str = ""  # 管理员QQ号，多个用逗号分隔，可控制服务器
     
+    # MC → QQ 发件箱配置
+    outbox_merge_window_ms: int = 500  # 合并窗口（毫秒），窗口内的消息合并为一条多行消息
+    outbox_rate_per_second: float = 0.5  # 令牌桶速率（条/秒）
+    outbox_burst: int = 5  # 令牌桶容量（允许的突发条数）
+    outbox_max_length: int = 1500  # 单条消息最大长度，超出时拆分
+
+    # MC 事件异步投递配置（/api/messages/send 校验后立即返回 202）
+    delivery_workers: int = 4  # 投递 worker 数，同一频道的事件按提交顺序投递
+    delivery_queue_size: int = 1000  # 等待投递的最大事件数，超出时返回 503
+    delivery_max_attempts: int = 3  # 投递失败时的最大尝试次数
+    delivery_retry_base_ms: int = 200  # 重试间隔（毫秒），每次翻倍
+    delivery_retention: int = 10000  # 保留的投递记录数，用于状态查询和 Idempotency-Key 去重
+    delivery_record_ttl_seconds: int = 3600  # 多 worker 部署时投递记录在共享状态中的保留时间（秒）
+
     # MC 服务器路径配置
     mc_server_dir: str = "/www/wwwroot/mc/server"  # MC服务器目录
     mc_screen_name: str = "mc"  # screen会话名称
+    mc_server_port: int = 25565  # 按命令行找不到服务端进程时，查找监听该端口的进程
+    server_stats_interval: float = 5.0  # 服务器进程 CPU/内存采样间隔（秒）
 
     # OpenAI API 配置 - 图片描述
     openai_api_key: str = ""
     openai_base_url: str = "https://api.openai.com/v1"
     openai_model: str = "gpt-4o"
+    vision_max_concurrency: int = 4  # 每个 API 提供方的最大并发请求数，超出的请求排队
+
+    # 图片预处理配置：上传前缩放并重新编码，去除元数据
+    vision_image_max_edge: int = 1024  # 最长边像素，0 表示不处理
+    vision_image_format: str = "jpeg"  # 重新编码格式：jpeg / webp
+    vision_image_quality: int = 80  # 编码质量
+    vision_preprocess_workers: int = 2  # 预处理进程数
 
     # 视频描述配置（可选，如不配置则使用图片模型配置）
     # 支持直接处理视频的 VL 模型，如 gpt-4o, gemini-2.0-flash 等
@@ -35,6 +95,29 @@ class Settings(BaseSettings):
     # 视频处理配置
     video_max_size_mb: int = 20  # 视频最大尺寸 (MB)
     video_supported_formats: str = "mp4,webm,mov,avi"  # 支持的视频格式
+    # 视频描述模式：video 直接上传视频；keyframes 本地提取关键帧后用图片模型描述；
+    # auto 先上传视频，模型不支持时改用关键帧
+    video_mode: str = "auto"
+    video_keyframes: int = 4  # 最多提取的关键帧数
+    video_keyframe_scene_threshold: float = 0.3  # 场景变化阈值 (0-1)
+
+    # 媒体下载配置
+    media_fetch_timeout: float = 60.0  # 下载超时（秒）
+    media_fetch_max_connections: int = 20  # 连接池最大连接数
+    media_fetch_per_host_limit: int = 4  # 每个主机的最大并发下载数
+    media_spool_threshold_mb: int = 2  # 超过该大小的下载内容暂存到临时文件
+
+    # 媒体描述 worker 池配置
+    media_workers: int = 4  # 并发描述的媒体数量
+    media_queue_size: int = 100  # 等待描述的最大媒体数
+    # 同时处理中的媒体（编码、上传）占用的内存上限，超出时排队，等待超时则降级
+    media_memory_budget_mb: int = 192
+    media_budget_wait_seconds: float = 30.0  # 等待内存预算的最长时间（秒）
+
+    # 媒体描述缓存配置
+    vision_cache_path: str = "data/vision_cache.sqlite3"  # 磁盘缓存路径，留空则仅使用内存缓存
+    vision_cache_max_entries: int = 1024  # 内存 LRU 最大条目数
+    vision_cache_ttl_hours: int = 168  # 缓存有效期（小时）
 
     # 日志级别
     log_level: str = "INFO"
@@ -0,0 +1,333 @@
+"""MC 事件异步投递 - /api/messages/send 校验后立即返回，由投递 worker 池转发到 QQ
+
+每个事件分配投递 ID，可通过 GET /api/messages/deliveries/{id} 查询状态，
+事件的所有 QQ 消息被 NapCat 接受后才标记为 delivered；
+请求携带 Idempotency-Key 时，同一频道内相同的键只投递一次，mod 重试不会产生重复消息。
+多 worker 部署时投递记录和幂等键保存在共享状态中，重试和查询落在任意 worker 上都有效。
+重试只重新提交确定没有发出的群消息，超时等可能已经送达的失败不重发
+"""
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from app.channels import Channel
+from app.config import settings
+from app.message_handler import message_handler
+from app.metrics import Counter, Gauge
+from app.models import DeliveryStatus, McMessage
+from app.napcat_client import NotConnectedError
+from app.outbox import outbox_relay
+from app.state import MemoryState, shared_state
+from app.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_QUEUED = "queued"
+DELIVERY_RETRYING = "retrying"
+DELIVERY_DELIVERED = "delivered"
+DELIVERY_FAILED = "failed"
+
+DELIVERIES = Counter("mcqq_deliveries_total", "MC events submitted for asynchronous delivery by outcome", ("result",))
+DELIVERY_PENDING = Gauge("mcqq_delivery_pending", "MC events waiting for a delivery worker")
+
+# 已提交到发件箱的一条群消息：(群号, 消息, 发送结果)
+Line = tuple[int, str, asyncio.Future]
+
+
+class Delivery:
+    """一次投递的状态"""
+
+    __slots__ = ("id", "channel", "key", "status", "attempts", "result", "error", "created_at", "updated_at")
+
+    def __init__(self, channel: str, key: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.channel = channel
+        self.key = key
+        self.status = DELIVERY_QUEUED
+        self.attempts = 0
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created_at = self.updated_at = datetime.now()
+
+    def set_status(self, status: str):
+        self.status = status
+        self.updated_at = datetime.now()
+
+    def to_status(self) -> DeliveryStatus:
+        return DeliveryStatus(
+            id=self.id,
+            status=self.status,
+            attempts=self.attempts,
+            result=self.result,
+            error=self.error,
+            created_at=self.created_at,
+            updated_at=self.updated_at
+        )
+
+
+class DeliveryService:
+    """投递服务
+
+    事件在 worker 池中格式化后逐群提交到发件箱，同一频道的事件等待前一个事件提交后再提交，保持聊天顺序，
+    不同频道之间并行。提交后释放 worker，在后台等待 NapCat 接受，发件箱得以继续合并后续消息。
+    提交失败或发送时确定没有发出（NotConnectedError）的群消息按指数间隔重新提交，
+    已提交或已发出的群不受影响（重新提交的消息排在之后提交的事件后面）；
+    超时、等待响应时断线等失败可能已经送达，不重发，投递标记为 failed。
+    多 worker 部署时消息由 leader 发送，写入共享流即视为投递完成。
+    单 worker 时投递记录保存在内存中，只保留最近 retention 条；
+    共享状态可跨进程访问时保存在共享状态中，record_ttl 秒后过期
+    """
+
+    def __init__(
+        self,
+        state: MemoryState,
+        workers: int,
+        max_pending: int,
+        max_attempts: int,
+        retry_base: float,
+        retention: int,
+        record_ttl: float
+    ):
+        self._state = state
+        self._pool = WorkerPool("delivery-worker", workers, max_pending)
+        self._max_attempts = max_attempts
+        self._retry_base = retry_base
+        self._retention = retention
+        self._record_ttl = record_ttl
+        self._deliveries: OrderedDict[str, Delivery] = OrderedDict()  # 投递 ID -> 投递，按提交顺序
+        self._keys: dict[tuple[str, str], Delivery] = {}  # (频道, 幂等键) -> 投递
+        self._tails: dict[str, asyncio.Future] = {}  # 频道 -> 最近提交的投递的提交完成标志
+        self._confirming: set[asyncio.Task] = set()  # 等待 NapCat 接受的投递
+
+    def start(self):
+        self._pool.start()
+
+    async def close(self):
+        await self._pool.close()
+        for task in self._confirming:
+            task.cancel()
+
+    def pending(self) -> int:
+        return self._pool.pending()
+
+    async def submit(
+        self, channel: Channel, msg: McMessage, key: Optional[str] = None
+    ) -> tuple[DeliveryStatus, bool]:
+        """提交事件，返回 (投递状态, 是否新提交)；幂等键已存在时返回原来的投递
+
+        等待投递的事件过多时抛出 asyncio.QueueFull
+        """
+        delivery = Delivery(channel.name, key)
+        if self._state.shared:
+            # 先写入记录再占用幂等键，其他 worker 看到键时记录已经存在
+            await self._save(delivery)
+            if key is not None:
+                existing = await self._claim_key(delivery)
+                if existing is not None:
+                    await self._state.delete(_record_key(channel.name, delivery.id))
+                    DELIVERIES.inc("duplicate")
+                    return existing, False
+        elif key is not None:
+            existing = self._keys.get((channel.name, key))
+            if existing is not None:
+                DELIVERIES.inc("duplicate")
+                return existing.to_status(), False
+
+        previous = self._tails.get(channel.name)
+        done = asyncio.get_running_loop().create_future()
+        try:
+            self._pool.submit_nowait(lambda: self._deliver(delivery, channel, msg, previous, done))
+        except asyncio.QueueFull:
+            DELIVERIES.inc("rejected")
+            if self._state.shared:
+                # 释放幂等键，mod 用同一个键重试时重新投递
+                if key is not None:
+                    await self._state.delete(_key_key(channel.name, key))
+                await self._state.delete(_record_key(channel.name, delivery.id))
+            raise
+        self._tails[channel.name] = done
+        if not self._state.shared:
+            self._remember(delivery)
+        DELIVERIES.inc("accepted")
+        return delivery.to_status(), True
+
+    async def get(self, channel: Channel, delivery_id: str) -> Optional[DeliveryStatus]:
+        """查询投递状态，只能查询本频道的投递"""
+        if self._state.shared:
+            record = await self._state.get(_record_key(channel.name, delivery_id))
+            return DeliveryStatus.model_validate_json(record) if record is not None else None
+        delivery = self._deliveries.get(delivery_id)
+        if delivery is None or delivery.channel != channel.name:
+            return None
+        return delivery.to_status()
+
+    async def _claim_key(self, delivery: Delivery) -> Optional[DeliveryStatus]:
+        """在共享状态中占用幂等键，键已被占用时返回原来的投递状态"""
+        def claim(value: Optional[bytes]) -> tuple[Optional[bytes], Optional[str]]:
+            if value is not None:
+                return None, value.decode()
+            return delivery.id.encode(), None
+
+        existing_id = await self._state.update(_key_key(delivery.channel, delivery.key), claim, self._record_ttl)
+        if existing_id is None:
+            return None
+        existing = await self._state.get(_record_key(delivery.channel, existing_id))
+        if existing is None:
+            # 原来的记录已过期，返回仅含 ID 的状态
+            return DeliveryStatus(
+                id=existing_id,
+                status=DELIVERY_QUEUED,
+                attempts=0,
+                created_at=delivery.created_at,
+                updated_at=delivery.updated_at
+            )
+        return DeliveryStatus.model_validate_json(existing)
+
+    async def _save(self, delivery: Delivery):
+        """将投递状态写入共享状态"""
+        record = delivery.to_status().model_dump_json().encode()
+        await self._state.update(_record_key(delivery.channel, delivery.id), lambda _: (record, None), self._record_ttl)
+
+    async def _set_status(self, delivery: Delivery, status: str):
+        delivery.set_status(status)
+        if self._state.shared:
+            try:
+                await self._save(delivery)
+            except Exception as e:
+                logger.warning(f"Failed to save delivery {delivery.id}: {e}")
+
+    def _remember(self, delivery: Delivery):
+        self._deliveries[delivery.id] = delivery
+        if delivery.key is not None:
+            self._keys[(delivery.channel, delivery.key)] = delivery
+        while len(self._deliveries) > self._retention:
+            _, oldest = self._deliveries.popitem(last=False)
+            if oldest.key is not None and self._keys.get((oldest.channel, oldest.key)) is oldest:
+                del self._keys[(oldest.channel, oldest.key)]
+
+    async def _deliver(
+        self,
+        delivery: Delivery,
+        channel: Channel,
+        msg: McMessage,
+        previous: Optional[asyncio.Future],
+        done: asyncio.Future
+    ):
+        lines = None
+        try:
+            if previous is not None:
+                # 队列先进先出，前一个事件已被其他 worker 取出，不会互相等待
+                await asyncio.shield(previous)
+            lines = await self._submit(delivery, channel, msg)
+        finally:
+            done.set_result(None)
+            if self._tails.get(channel.name) is done:
+                del self._tails[channel.name]
+        if lines is not None:
+            task = asyncio.create_task(self._confirm(delivery, lines))
+            self._confirming.add(task)
+            task.add_done_callback(self._confirming.discard)
+
+    async def _submit(self, delivery: Delivery, channel: Channel, msg: McMessage) -> Optional[list[Line]]:
+        """格式化事件并提交到频道绑定的所有群，返回需要等待发送结果的群消息；失败且不再重试时返回 None"""
+        try:
+            text, delivery.result = message_handler.format_mc_message(msg)
+        except ValueError as e:
+            # 字段缺失等错误重试也不会成功
+            await self._fail(delivery, e)
+            return None
+        lines = await self._submit_lines(delivery, [(group_id, text) for group_id in channel.groups])
+        if lines is not None:
+            logger.info(f"Queued to QQ: {text}")
+        return lines
+
+    async def _submit_lines(self, delivery: Delivery, targets: list[tuple[int, str]]) -> Optional[list[Line]]:
+        """逐群提交到发件箱，提交失败时只重新提交尚未提交的群"""
+        lines: list[Line] = []
+        while True:
+            delivery.attempts += 1
+            try:
+                while targets:
+                    group_id, text = targets[0]
+                    future = await outbox_relay.submit(group_id, text)
+                    if future is not None:
+                        lines.append((group_id, text, future))
+                    targets = targets[1:]
+                return lines
+            except Exception as e:
+                if not await self._should_retry(delivery, e):
+                    return None
+
+    async def _confirm(self, delivery: Delivery, lines: list[Line]):
+        """等待 NapCat 接受事件的所有群消息，只重新提交确定没有发出的群消息"""
+        uncertain: Optional[BaseException] = None
+        while lines:
+            results = await asyncio.gather(*(future for _, _, future in lines), return_exceptions=True)
+            unsent = []
+            for (group_id, text, _), result in zip(lines, results):
+                if isinstance(result, NotConnectedError):
+                    unsent.append((group_id, text))
+                elif isinstance(result, BaseException):
+                    # 超时等情况下消息可能已经送达，重发会重复
+                    logger.warning(f"Delivery {delivery.id} to QQ group {group_id} may not have arrived: {result}")
+                    uncertain = result
+            if not unsent:
+                break
+            if not await self._should_retry(delivery, next(r for r in results if isinstance(r, NotConnectedError))):
+                return
+            lines = await self._submit_lines(delivery, unsent)
+            if lines is None:
+                return
+
+        if uncertain is not None:
+            await self._fail(delivery, uncertain)
+            return
+        delivery.error = None
+        await self._set_status(delivery, DELIVERY_DELIVERED)
+        DELIVERIES.inc("delivered")
+
+    async def _should_retry(self, delivery: Delivery, error: Exception) -> bool:
+        """记录失败，未达到最大尝试次数时等待重试间隔后返回 True，否则标记为失败"""
+        if delivery.attempts >= self._max_attempts:
+            await self._fail(delivery, error)
+            return False
+        delivery.error = _describe(error)
+        await self._set_status(delivery, DELIVERY_RETRYING)
+        DELIVERIES.inc("retried")
+        await asyncio.sleep(self._retry_base * 2 ** (delivery.attempts - 1))
+        return True
+
+    async def _fail(self, delivery: Delivery, error: BaseException):
+        delivery.error = _describe(error)
+        await self._set_status(delivery, DELIVERY_FAILED)
+        DELIVERIES.inc("failed")
+        logger.error(f"Delivery {delivery.id} failed after {delivery.attempts} attempt(s): {error}")
+
+
+def _record_key(channel: str, delivery_id: str) -> str:
+    return f"delivery:{channel}:{delivery_id}"
+
+
+def _key_key(channel: str, key: str) -> str:
+    return f"delivery-key:{channel}:{key}"
+
+
+def _describe(error: BaseException) -> str:
+    # asyncio.TimeoutError 等异常没有消息
+    return str(error) or type(error).__name__
+
+
+# 全局投递服务实例
+delivery_service = DeliveryService(
+    shared_state,
+    workers=settings.delivery_workers,
+    max_pending=settings.delivery_queue_size,
+    max_attempts=settings.delivery_max_attempts,
+    retry_base=settings.delivery_retry_base_ms / 1000,
+    retention=settings.delivery_retention,
+    record_ttl=settings.delivery_record_ttl_seconds
+)
+DELIVERY_PENDING.set_function(delivery_service.pending)
@@ -0,0 +1,102 @@
+"""图片预处理 - 在进程池中缩放并重新编码，减小上传到 Vision API 的体积"""
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+FORMAT_MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def preprocess_image(data: bytes, max_edge: int, fmt: str, quality: int) -> tuple[bytes, str]:
+    """缩放到最长边不超过 max_edge 并重新编码，不保留 EXIF 等元数据
+
+    在子进程中执行，动图只保留第一帧
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img.seek(0)
+        # 先按 EXIF 方向旋转，重新编码时元数据会被丢弃
+        frame = ImageOps.exif_transpose(img)
+        if frame.mode in ("RGBA", "LA", "P"):
+            # 透明背景铺白色，避免 JPEG 下变黑
+            frame = frame.convert("RGBA")
+            background = Image.new("RGB", frame.size, (255, 255, 255))
+            background.paste(frame, mask=frame.getchannel("A"))
+            frame = background
+        elif frame.mode != "RGB":
+            frame = frame.convert("RGB")
+
+        frame.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        out = io.BytesIO()
+        frame.save(out, format=fmt.upper(), quality=quality, optimize=True)
+        return out.getvalue(), FORMAT_MIME_TYPES[fmt]
+
+
+class ImagePreprocessor:
+    """图片预处理器，使用进程池避免阻塞事件循环"""
+
+    def __init__(self, max_edge: int, fmt: str, quality: int, workers: int):
+        self._max_edge = max_edge
+        self._format = fmt.lower() if fmt.lower() in FORMAT_MIME_TYPES else "jpeg"
+        self._quality = quality
+        self._workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_edge > 0
+
+    async def process(self, data: bytes) -> Optional[tuple[bytes, str]]:
+        """返回 (处理后的图片, MIME 类型)，未启用或处理失败时返回 None"""
+        if not self.enabled:
+            return None
+
+        if self._executor is None:
+            # spawn 避免在多线程的服务进程中 fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                partial(preprocess_image, data, self._max_edge, self._format, self._quality)
+            )
+            logger.debug(f"Image preprocessed: {len(data)} -> {len(result[0])} bytes")
+            return result
+        except BrokenProcessPool as e:
+            # 子进程异常退出后进程池不可再用，下次调用时重建
+            logger.warning(f"Image preprocess pool broken, recreating: {e}")
+            self.close()
+            return None
+        except Exception as e:
+            logger.warning(f"Image preprocess failed, using original: {e}")
+            return None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# 全局预处理器实例
+image_preprocessor = ImagePreprocessor(
+    max_edge=settings.vision_image_max_edge,
+    fmt=settings.vision_image_format,
+    quality=settings.vision_image_quality,
+    workers=settings.vision_preprocess_workers
+)
@@ -0,0 +1,60 @@
+"""JSON 编解码 - 优先使用 orjson，未安装时回退到标准库"""
+import json
+import re
+from typing import Any, Union
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+# NapCat 心跳等元事件的快速识别，无需完整解析 JSON
+# （消息内容中的引号会被转义，不会误匹配）
+META_EVENT_PATTERN = re.compile(r'"post_type"\s*:\s*"meta_event"')
+META_EVENT_PATTERN_BYTES = re.compile(rb'"post_type"\s*:\s*"meta_event"')
+# 只检查短帧，元事件都很短，长帧直接完整解析
+META_EVENT_MAX_LENGTH = 1024
+
+
+if orjson is not None:
+    JSONDecodeError = orjson.JSONDecodeError
+
+    def dumps(obj: Any) -> bytes:
+        """编码为 UTF-8 JSON 字节串"""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+else:
+    JSONDecodeError = json.JSONDecodeError
+
+    def dumps(obj: Any) -> bytes:
+        """编码为 UTF-8 JSON 字节串"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+
+def dumps_text(obj: Any) -> str:
+    """编码为 JSON 字符串（WebSocket 文本帧）"""
+    return dumps(obj).decode("utf-8")
+
+
+def is_meta_event(frame: Union[str, bytes]) -> bool:
+    """判断 NapCat 帧是否为元事件（心跳、生命周期）"""
+    if len(frame) > META_EVENT_MAX_LENGTH:
+        return False
+    pattern = META_EVENT_PATTERN_BYTES if isinstance(frame, bytes) else META_EVENT_PATTERN
+    return pattern.search(frame) is not None
+
+
+class FastJSONResponse(JSONResponse):
+    """使用快速编解码器渲染的 JSON 响应"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,87 @@
+"""视频关键帧提取 - 调用 ffmpeg 子进程按场景变化截取少量关键帧"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+
+from app.media_fetcher import FetchedMedia
+
+logger = logging.getLogger(__name__)
+
+JPEG_SOI = b"\xff\xd8\xff"
+
+
+def ffmpeg_available() -> bool:
+    """检查 ffmpeg 是否可用"""
+    return shutil.which("ffmpeg") is not None
+
+
+def split_jpeg_stream(data: bytes) -> list[bytes]:
+    """拆分 image2pipe 输出的连续 JPEG 流"""
+    frames = []
+    start = data.find(JPEG_SOI)
+    while start != -1:
+        end = data.find(JPEG_SOI, start + len(JPEG_SOI))
+        frames.append(data[start:end] if end != -1 else data[start:])
+        start = end
+    return frames
+
+
+async def extract_keyframes(
+    video: FetchedMedia,
+    max_frames: int,
+    max_edge: int,
+    scene_threshold: float,
+    timeout: float = 60.0
+) -> list[bytes]:
+    """提取关键帧（JPEG），首帧总是保留，其余按场景变化选取
+
+    视频先流式复制到临时文件（MP4 的索引可能在文件末尾，无法从管道读取），
+    ffmpeg 在子进程中运行，不阻塞事件循环
+    """
+    fd, path = tempfile.mkstemp(suffix=".video")
+    try:
+        await asyncio.to_thread(_write_file, fd, video)
+
+        # 最长边缩放到 max_edge，不放大
+        scale = (
+            f"scale='if(gt(iw,ih),min(iw,{max_edge}),-2)'"
+            f":'if(gt(iw,ih),-2,min(ih,{max_edge}))'"
+        )
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+            "-i", path,
+            "-vf", f"select=eq(n\\,0)+gt(scene\\,{scene_threshold}),{scale}",
+            "-vsync", "vfr",
+            "-frames:v", str(max_frames),
+            "-f", "image2pipe", "-vcodec", "mjpeg", "-q:v", "5",
+            "-",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            logger.warning("Keyframe extraction timed out")
+            return []
+
+        if proc.returncode != 0:
+            logger.warning(f"ffmpeg failed ({proc.returncode}): {stderr.decode(errors='ignore')[:200]}")
+            return []
+
+        frames = split_jpeg_stream(stdout)
+        logger.info(f"Extracted {len(frames)} keyframes ({len(stdout)} bytes) from {video.size} bytes video")
+        return frames
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _write_file(fd: int, video: FetchedMedia):
+    with os.fdopen(fd, "wb") as f:
+        video.copy_to(f)
@@ -0,0 +1,97 @@
+"""NapCat 连接的 leader 选举 - 多 worker 部署时只有一个 worker 连接 NapCat
+
+持有租约的 worker 为 leader，负责 NapCat 连接、QQ 发件箱、媒体描述和服务器采样；
+leader 每隔租约时长的 1/3 续期，退出时释放租约，崩溃时其他 worker 在租约过期后接管。
+单 worker（memory 状态后端）时启动即成为 leader
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from app.config import settings
+from app.metrics import Gauge
+from app.state import MemoryState, WORKER_ID, shared_state
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE = "napcat-leader"
+
+LEADER = Gauge("mcqq_leader", "Whether this worker holds the NapCat connection")
+
+
+class LeaderElection:
+    """基于共享状态租约的 leader 选举"""
+
+    def __init__(self, state: MemoryState, name: str, ttl: float):
+        self._state = state
+        self._name = name
+        self._ttl = ttl
+        self._is_leader = False
+        self._renewed_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._on_elected: Optional[Callable[[], Awaitable[None]]] = None
+        self._on_demoted: Optional[Callable[[], Awaitable[None]]] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    async def start(self, on_elected: Callable[[], Awaitable[None]], on_demoted: Callable[[], Awaitable[None]]):
+        """立即竞选一次，之后在后台续期或等待接管"""
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        await self._attempt()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止选举，leader 停止服务并释放租约，其他 worker 无需等待过期即可接管"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._is_leader:
+            await self._step_down()
+            try:
+                await self._state.release(self._name, WORKER_ID)
+            except Exception as e:
+                logger.warning(f"Failed to release leader lease: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._ttl / 3)
+            await self._attempt()
+
+    async def _attempt(self):
+        try:
+            acquired = await self._state.acquire(self._name, WORKER_ID, self._ttl)
+        except Exception as e:
+            logger.warning(f"Leader lease renewal failed: {e}")
+            # 无法访问共享状态时，在租约过期前主动让出，避免两个 worker 同时连接 NapCat
+            acquired = self._is_leader and time.monotonic() - self._renewed_at < self._ttl * 2 / 3
+        else:
+            if acquired:
+                self._renewed_at = time.monotonic()
+
+        if acquired and not self._is_leader:
+            self._is_leader = True
+            logger.info(f"Worker {WORKER_ID} is now the NapCat leader")
+            try:
+                await self._on_elected()
+            except Exception as e:
+                logger.error(f"Failed to start leader services: {e}")
+        elif not acquired and self._is_leader:
+            logger.warning(f"Worker {WORKER_ID} lost the NapCat leadership")
+            await self._step_down()
+
+    async def _step_down(self):
+        self._is_leader = False
+        try:
+            await self._on_demoted()
+        except Exception as e:
+            logger.error(f"Failed to stop leader services: {e}")
+
+
+# 全局 leader 选举实例
+leader = LeaderElection(shared_state, LEADER_LEASE, settings.leader_lease_seconds)
+LEADER.set_function(lambda: 1 if leader.is_leader else 0)
@@ -1,17 +1,28 @@
 import asyncio
 import logging
 import sys
+import time
 from contextlib import asynccontextmanager
+from typing import Optional
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Request
-import json
 
 from app.config import settings
+from app.json_codec import FastJSONResponse, JSON_BACKEND
 from app.routes import router
 from app.napcat_client import napcat_client
-from app.message_handler import message_handler
+from app.message_handler import message_handler, media_workers
+from app.delivery import delivery_service
+from app.channels import channel_router
+from app.outbox import qq_outbox, outbox_relay
+from app.media_fetcher import media_fetcher
+from app.image_preprocess import image_preprocessor
+from app.server_stats import server_stats
+from app.state import shared_state, WORKER_ID
+from app.leader import leader
+from app.metrics import Counter, Histogram
 
 # 配置日志
 logging.basicConfig(
@@ -22,35 +33,85 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+HTTP_REQUEST_SECONDS = Histogram("mcqq_http_request_seconds", "HTTP request latency by route", ("method", "route"))
+HTTP_RESPONSES = Counter("mcqq_http_responses_total", "HTTP responses by route and status", ("method", "route", "status"))
+
+
+_napcat_task: Optional[asyncio.Task] = None
+
+
+async def start_leader_services():
+    """成为 leader 后启动 NapCat 连接及依赖它的服务"""
+    global _napcat_task
+    _napcat_task = asyncio.create_task(napcat_client.connect())
+    
+    # 启动 MC → QQ 发件箱，多 worker 时同时转交其他 worker 提交的消息
+    qq_outbox.start()
+    outbox_relay.start()
+    
+    # 启动媒体描述 worker 池
+    media_workers.start()
+    
+    # 启动 MC 服务器进程采样
+    server_stats.start()
+
+
+async def stop_leader_services():
+    global _napcat_task
+    await outbox_relay.close()
+    await qq_outbox.close()
+    if _napcat_task is not None:
+        _napcat_task.cancel()
+        _napcat_task = None
+    await napcat_client.close()
+    await media_workers.close()
+    await server_stats.close()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     logger.info("Starting MC-QQ Chat Bridge Backend...")
     
+    # 打开共享状态并恢复各频道持久化的消息队列
+    await shared_state.start()
+    await channel_router.start()
+    
     # 设置消息处理器
     napcat_client.set_message_handler(message_handler.handle_qq_message)
     
-    # 启动 NapCat 客户端连接
-    napcat_task = asyncio.create_task(napcat_client.connect())
+    # 启动 MC 事件投递 worker 池（每个 worker 都接收 MC 事件）
+    delivery_service.start()
+    
+    # 只有一个 worker 连接 NapCat（单 worker 时立即成为 leader）
+    await leader.start(start_leader_services, stop_leader_services)
     
     logger.info(f"Backend started on {settings.host}:{settings.port}")
     logger.info(f"NapCat WebSocket: {settings.napcat_ws_url}")
-    logger.info(f"Target QQ Group: {settings.qq_group_id}")
+    if shared_state.shared:
+        logger.info(f"Worker {WORKER_ID}: {'NapCat leader' if leader.is_leader else 'standby'}")
+    for channel in channel_router:
+        logger.info(f"Channel {channel.name}: QQ groups {', '.join(map(str, channel.groups))}")
+    logger.info(f"JSON codec: {JSON_BACKEND}")
     
     yield
     
     # 关闭连接
     logger.info("Shutting down MC-QQ Chat Bridge Backend...")
-    napcat_task.cancel()
-    await napcat_client.close()
+    await delivery_service.close()
+    await leader.close()
+    await media_fetcher.close()
+    image_preprocessor.close()
+    await channel_router.close()
+    await shared_state.close()
 
 
 app = FastAPI(
     title="MC-QQ Chat Bridge",
     description="Bridge between Minecraft and QQ groups via NapCat",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 # CORS 配置
@@ -62,19 +123,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 添加请求日志中间件
+# 请求指标中间件，按路由模板统计，避免路径参数导致标签膨胀
 @app.middleware("http")
-async def log_requests(request: Request, call_next):
-    if request.url.path == "/api/messages/send" and request.method == "POST":
-        body = await request.body()
-        headers = dict(request.headers)
-        logger.info(f"Raw POST body: {body}, headers: {headers}")
-        # 重新创建request以便后续使用
-        async def receive():
-            return {"type": "http.request", "body": body}
-        request = Request(request.scope, receive)
-    response = await call_next(request)
-    return response
+async def record_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, path)
+        HTTP_RESPONSES.inc(request.method, path, status)
 
 # 注册路由
 app.include_router(router)
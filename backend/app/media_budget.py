@@ -0,0 +1,81 @@
+"""媒体内存预算 - 限制同时处理中的媒体占用的总内存"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from app.config import settings
+from app.metrics import Gauge
+
+# 上传一份媒体时的内存放大倍数估计：base64 缓冲区 + base64 字符串 + SDK 序列化的请求体
+MEDIA_MEMORY_FACTOR = 3
+
+MEDIA_BUDGET_IN_USE = Gauge("mcqq_media_budget_in_use_bytes", "Bytes reserved from the media memory budget")
+MEDIA_BUDGET_WAITING = Gauge("mcqq_media_budget_waiting", "Media jobs waiting for memory budget")
+
+
+class MemoryBudget:
+    """字节预算信号量
+
+    预留超出剩余预算时排队等待，等待超时或单次预留超过总预算时返回 False，由调用方降级处理
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._in_use = 0
+        self._waiting = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    async def acquire(self, size: int, timeout: float) -> bool:
+        """预留 size 字节，成功返回 True"""
+        if size > self._limit:
+            return False
+
+        async with self._cond:
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._in_use + size <= self._limit),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self._waiting -= 1
+            self._in_use += size
+            return True
+
+    async def release(self, size: int):
+        async with self._cond:
+            self._in_use -= size
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, size: int, timeout: float) -> AsyncIterator[bool]:
+        """预留预算的上下文，产出是否预留成功"""
+        reserved = await self.acquire(size, timeout)
+        try:
+            yield reserved
+        finally:
+            if reserved:
+                await self.release(size)
+
+    def stats(self) -> dict:
+        return {
+            "limit_bytes": self._limit,
+            "in_use_bytes": self._in_use,
+            "waiting": self._waiting,
+        }
+
+
+# 全局媒体内存预算
+media_budget = MemoryBudget(settings.media_memory_budget_mb * 1024 * 1024)
+MEDIA_BUDGET_IN_USE.set_function(lambda: media_budget.in_use)
+MEDIA_BUDGET_WAITING.set_function(lambda: media_budget.waiting)
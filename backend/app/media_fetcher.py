@@ -0,0 +1,179 @@
+"""媒体下载 - 共享连接池、流式下载、超限即中止，大文件落盘暂存"""
+import asyncio
+import binascii
+import hashlib
+import logging
+import shutil
+import tempfile
+from typing import BinaryIO, Optional, Union
+from urllib.parse import urlsplit
+
+import httpx
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 需要 h2 包（httpx[http2]），未安装时使用 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# base64 分块大小，取 3 的倍数使每块编码结果不含填充，可直接拼接
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def encode_data_url(mime_type: str, source: Union[bytes, BinaryIO], size: int) -> str:
+    """将内容编码为 data: URL
+
+    按块编码写入预先分配好的缓冲区，最后只生成一次字符串，
+    避免 b64encode + decode + f-string 拼接产生的多份完整副本；
+    source 为文件对象时原始内容不会整体读入内存
+    """
+    prefix = f"data:{mime_type};base64,".encode("ascii")
+    out = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+    out[:len(prefix)] = prefix
+    pos = len(prefix)
+
+    view = memoryview(source) if isinstance(source, (bytes, bytearray)) else None
+    offset = 0
+    while True:
+        if view is not None:
+            chunk = view[offset:offset + BASE64_CHUNK_SIZE]
+        else:
+            chunk = source.read(BASE64_CHUNK_SIZE)
+        if not chunk:
+            break
+        encoded = binascii.b2a_base64(chunk, newline=False)
+        out[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+        offset += len(chunk)
+
+    if pos != len(out):
+        # 实际长度与 size 不符时截断（只在调用方传错 size 时发生）
+        del out[pos:]
+    return out.decode("ascii")
+
+
+class FetchedMedia:
+    """下载结果，小于暂存阈值时保存在内存，否则保存在临时文件"""
+
+    def __init__(self, spool: tempfile.SpooledTemporaryFile, size: int, sha256: str):
+        self._spool = spool
+        self.size = size
+        self.sha256 = sha256  # 内容哈希，下载时顺带计算
+
+    def read(self) -> bytes:
+        """读取全部内容"""
+        self._spool.seek(0)
+        return self._spool.read()
+
+    def head(self, size: int) -> bytes:
+        """读取开头的 size 字节（用于类型检测）"""
+        self._spool.seek(0)
+        return self._spool.read(size)
+
+    def data_url(self, mime_type: str) -> str:
+        """流式编码为 data: URL，不把原始内容整体读入内存"""
+        self._spool.seek(0)
+        return encode_data_url(mime_type, self._spool, self.size)
+
+    def copy_to(self, fileobj: BinaryIO):
+        """把内容复制到另一个文件对象（阻塞调用）"""
+        self._spool.seek(0)
+        shutil.copyfileobj(self._spool, fileobj)
+
+    def close(self):
+        self._spool.close()
+
+    def __enter__(self) -> "FetchedMedia":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MediaFetcher:
+    """共享的媒体下载器
+
+    复用 keep-alive 连接（支持时使用 HTTP/2），单次流式 GET，
+    超过大小限制立即中止，并限制每个主机的并发下载数
+    """
+
+    def __init__(self, timeout: float, max_connections: int, per_host_limit: int, spool_threshold: int):
+        self._timeout = timeout
+        self._max_connections = max_connections
+        self._per_host_limit = per_host_limit
+        self._spool_threshold = spool_threshold
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取共享客户端（懒加载）"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=self._timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self._max_connections,
+                    max_keepalive_connections=self._max_connections
+                )
+            )
+        return self._client
+
+    async def fetch(self, url: str, max_size: int) -> Optional[FetchedMedia]:
+        """下载媒体，失败或超过 max_size 字节时返回 None"""
+        host = urlsplit(url).netloc
+        limit = self._host_limits.get(host)
+        if limit is None:
+            limit = self._host_limits[host] = asyncio.Semaphore(self._per_host_limit)
+
+        async with limit:
+            spool = tempfile.SpooledTemporaryFile(max_size=self._spool_threshold)
+            try:
+                async with self.client.stream("GET", url) as response:
+                    if response.status_code != 200:
+                        logger.warning(f"Failed to download media: HTTP {response.status_code}")
+                        spool.close()
+                        return None
+
+                    content_length = response.headers.get("content-length")
+                    if content_length and int(content_length) > max_size:
+                        logger.warning(f"Media too large: {content_length} bytes > {max_size} bytes")
+                        spool.close()
+                        return None
+
+                    size = 0
+                    hasher = hashlib.sha256()
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > max_size:
+                            logger.warning(f"Downloaded media too large: > {max_size} bytes")
+                            spool.close()
+                            return None
+                        hasher.update(chunk)
+                        spool.write(chunk)
+
+                return FetchedMedia(spool, size, hasher.hexdigest())
+            except Exception as e:
+                logger.error(f"Download media error: {e}")
+                spool.close()
+                return None
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# 全局下载器实例
+media_fetcher = MediaFetcher(
+    timeout=settings.media_fetch_timeout,
+    max_connections=settings.media_fetch_max_connections,
+    per_host_limit=settings.media_fetch_per_host_limit,
+    spool_threshold=settings.media_spool_threshold_mb * 1024 * 1024
+)
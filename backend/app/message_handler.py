@@ -1,19 +1,49 @@
+import asyncio
 import logging
-from typing import Optional
-import httpx
+from functools import partial
+from typing import Awaitable, Callable, Optional
 
+from app.channels import Channel, channel_router
 from app.config import settings
-from app.models import QqMessage
-from app.message_queue import message_queue
+from app.models import QqMessage, McMessage
+from app.metrics import Counter, Gauge, Histogram
 from app.vision_service import vision_service
 from app.napcat_client import napcat_client
+from app.commands import command_service
+from app.state import shared_state
+from app.worker_pool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
+COMMAND_SECONDS = Histogram("mcqq_command_seconds", "Time spent handling @bot commands", ("command",))
+COMMAND_FAILURES = Counter("mcqq_command_failures_total", "@bot commands that raised", ("command",))
+QQ_MESSAGES = Counter("mcqq_qq_messages_total", "Group messages received from the bridged QQ group")
+MEDIA_PENDING = Gauge("mcqq_media_pending", "Media descriptions waiting for a worker")
+
+# 各类 MC 事件必需的字段
+MC_REQUIRED_FIELDS = {
+    "player_chat": ("player", "message"),
+    "system": ("message",),
+    "player_join": ("player",),
+    "player_leave": ("player",),
+    "death": ("message",),
+    "achievement": ("player", "message"),
+}
+
+# 启动/关闭/重启服务器命令共用的锁，同一时间只执行一个
+SERVER_CONTROL_LOCK = "server-control"
+
+# 媒体描述 worker 池，慢速的 Vision 调用不阻塞其他消息
+media_workers = WorkerPool("media-worker", settings.media_workers, settings.media_queue_size)
+
 
 class MessageHandler:
     """消息处理器"""
 
+    def __init__(self):
+        # 每个发送者最近一条消息的入队完成标志，保证同一发送者的消息按顺序入队
+        self._sender_tails: dict[str, asyncio.Future] = {}
+
     async def handle_qq_message(self, data: dict):
         """处理来自 QQ 的消息"""
         message_type = data.get("message_type")
@@ -24,10 +54,12 @@ class MessageHandler:
 
         group_id = data.get("group_id")
         
-        # 检查是否是目标群
-        if group_id != settings.qq_group_id:
+        # 查找该群绑定的频道，未桥接的群直接忽略
+        channels = channel_router.for_group(group_id)
+        if not channels:
             return
 
+        QQ_MESSAGES.inc()
         sender = data.get("sender", {})
         user_id = str(sender.get("user_id", "0"))
         nickname = sender.get("nickname", "Unknown")
@@ -39,12 +71,46 @@ class MessageHandler:
         message_segments = data.get("message", [])
         
         # 处理消息段
-        await self._process_message_segments(message_segments, display_name, user_id)
-
-    async def _process_message_segments(self, segments: list, nickname: str, qq: str):
-        """处理消息段"""
+        await self._process_message_segments(message_segments, display_name, user_id, group_id, channels)
+
+    async def _process_message_segments(
+        self,
+        segments: list,
+        nickname: str,
+        qq: str,
+        group_id: int,
+        channels: tuple[Channel, ...]
+    ):
+        """处理消息段
+
+        媒体描述提交到 worker 池并发执行，不阻塞其他消息；
+        同一发送者在同一个群的消息等待其之前的消息入队后再按顺序入队
+        """
+        tail_key = f"{group_id}:{qq}"
+        prev_tail = self._sender_tails.get(tail_key)
+        tail = asyncio.get_running_loop().create_future()
+        self._sender_tails[tail_key] = tail
+        try:
+            await self._process_segments_in_order(segments, nickname, qq, group_id, channels, prev_tail)
+        finally:
+            if not tail.done():
+                tail.set_result(None)
+            if self._sender_tails.get(tail_key) is tail:
+                del self._sender_tails[tail_key]
+
+    async def _process_segments_in_order(
+        self,
+        segments: list,
+        nickname: str,
+        qq: str,
+        group_id: int,
+        channels: tuple[Channel, ...],
+        prev_tail: Optional[asyncio.Future]
+    ):
+        """解析消息段，等待 prev_tail 完成后按顺序入队到群绑定的所有频道"""
         text_parts = []
         has_at_bot = False  # 是否@了机器人
+        outputs: list = []  # 按顺序待入队的消息，媒体消息为 (类型, 描述或描述 Future)
         
         logger.info(f"Processing message from {nickname}({qq}), segments: {len(segments)}")
         
@@ -81,24 +147,20 @@ class MessageHandler:
                 # 图片
                 url = seg_data.get("url", "")
                 summary = seg_data.get("summary", "")
+                file_id = seg_data.get("file_unique") or seg_data.get("file")
                 
                 if summary and summary != "[图片]":
                     # 使用已有的摘要
                     description = summary
                 elif url:
-                    # 使用 Vision API 描述
-                    description = await vision_service.describe_image(url)
+                    # 使用 Vision API 描述（在 worker 池中执行）
+                    description = await media_workers.submit(
+                        partial(vision_service.describe_image, url, file_id)
+                    )
                 else:
                     description = "[图片]"
 
-                msg = QqMessage(
-                    type="image",
-                    nickname=nickname,
-                    qq=qq,
-                    content="",
-                    description=description
-                )
-                await message_queue.push(msg)
+                outputs.append(("image", description))
 
             elif seg_type == "mface":
                 # 表情包
@@ -112,7 +174,7 @@ class MessageHandler:
                     content="",
                     face_name=face_name
                 )
-                await message_queue.push(msg)
+                outputs.append(msg)
 
             elif seg_type == "face":
                 # QQ 表情
@@ -126,32 +188,28 @@ class MessageHandler:
                     content="",
                     face_name=face_name
                 )
-                await message_queue.push(msg)
+                outputs.append(msg)
 
             elif seg_type == "video":
                 # 视频 - 直接使用 VL 模型处理视频
                 video_url = seg_data.get("url", "")
                 cover_url = seg_data.get("cover", "")
+                file_id = seg_data.get("file_unique") or seg_data.get("file")
                 
                 if video_url:
                     # 优先直接处理视频，失败时使用封面
-                    description = await vision_service.describe_video_with_cover(
-                        video_url, cover_url
+                    description = await media_workers.submit(
+                        partial(vision_service.describe_video_with_cover, video_url, cover_url, file_id)
                     )
                 elif cover_url:
                     # 只有封面，使用图片描述
-                    description = await vision_service.describe_image(cover_url)
+                    description = await media_workers.submit(
+                        partial(vision_service.describe_image, cover_url)
+                    )
                 else:
                     description = "[视频]"
 
-                msg = QqMessage(
-                    type="video",
-                    nickname=nickname,
-                    qq=qq,
-                    content="",
-                    description=description
-                )
-                await message_queue.push(msg)
+                outputs.append(("video", description))
 
             elif seg_type == "record":
                 # 语音
@@ -161,7 +219,7 @@ class MessageHandler:
                     qq=qq,
                     content="[语音消息]"
                 )
-                await message_queue.push(msg)
+                outputs.append(msg)
 
             elif seg_type == "at":
                 # @某人
@@ -184,7 +242,7 @@ class MessageHandler:
                     qq=qq,
                     content="[合并转发消息]"
                 )
-                await message_queue.push(msg)
+                outputs.append(msg)
 
             elif seg_type == "file":
                 # 文件
@@ -195,7 +253,32 @@ class MessageHandler:
                     qq=qq,
                     content=f"[文件] {file_name}"
                 )
-                await message_queue.push(msg)
+                outputs.append(msg)
+
+        # 等待同一发送者之前的消息入队（asyncio.wait 被取消时不会连带取消 prev_tail）
+        if prev_tail is not None:
+            await asyncio.wait([prev_tail])
+
+        for item in outputs:
+            if isinstance(item, QqMessage):
+                await self._push(channels, item)
+                continue
+
+            msg_type, description = item
+            if isinstance(description, asyncio.Future):
+                try:
+                    description = await description
+                except Exception:
+                    description = "[图片]" if msg_type == "image" else "[视频]"
+
+            msg = QqMessage(
+                type=msg_type,
+                nickname=nickname,
+                qq=qq,
+                content="",
+                description=description
+            )
+            await self._push(channels, msg)
 
         # 合并所有文本部分
         if text_parts:
@@ -204,7 +287,7 @@ class MessageHandler:
             logger.info(f"Combined text: '{combined_text}', has_at_bot: {has_at_bot}")
             
             # 检查是否是命令
-            if has_at_bot and await self._handle_command(combined_text, nickname, qq):
+            if has_at_bot and await self._handle_command(combined_text, nickname, qq, group_id, channels):
                 logger.info("Command handled, not forwarding to MC")
                 return  # 命令已处理，不转发到MC
             
@@ -214,8 +297,13 @@ class MessageHandler:
                 qq=qq,
                 content=combined_text
             )
-            await message_queue.push(msg)
-            
+            await self._push(channels, msg)
+
+    async def _push(self, channels: tuple[Channel, ...], msg: QqMessage):
+        """入队到每个频道（公告群等绑定多个服务器的群扇出到所有服务器）"""
+        for channel in channels:
+            await channel.queue.push(msg)
+
     def _is_admin(self, qq: str) -> bool:
         """检查是否是管理员"""
         if not settings.admin_qq:
@@ -223,8 +311,15 @@ class MessageHandler:
         admin_list = [q.strip() for q in settings.admin_qq.split(",") if q.strip()]
         return str(qq) in admin_list
     
-    async def _handle_command(self, text: str, nickname: str, qq: str) -> bool:
-        """处理命令，返回True表示已处理"""
+    async def _handle_command(
+        self,
+        text: str,
+        nickname: str,
+        qq: str,
+        group_id: int,
+        channels: tuple[Channel, ...]
+    ) -> bool:
+        """处理命令，回复到发出命令的群，返回True表示已处理"""
         # 清理文本，移除@标记和QQ号
         import re
         # 移除 @xxx 模式（@后面跟任意非空白字符）
@@ -244,18 +339,18 @@ class MessageHandler:
         # list命令：显示在线玩家
         if text_lower in ["list"]:
             logger.info(f"List command triggered by {nickname}")
-            await self._handle_list_command()
+            await self._run_command("list", self._handle_list_command(group_id, channels))
             return True
         
         # status命令：显示服务器状态
         if text_lower in ["status"]:
             logger.info(f"Status command triggered by {nickname}")
-            await self._handle_status_command()
+            await self._run_command("status", self._handle_status_command(group_id))
             return True
         
         # help命令：显示帮助
         if text_lower in ["help"]:
-            await self._handle_help_command(is_admin)
+            await self._run_command("help", self._handle_help_command(group_id, is_admin))
             return True
         
         # ===== 管理员命令 =====
@@ -263,19 +358,19 @@ class MessageHandler:
             # 重启服务器
             if text_lower in ["restart"]:
                 logger.info(f"Admin {nickname}({qq}) triggered restart")
-                await self._handle_admin_restart()
+                await self._run_server_control("restart", group_id, self._handle_admin_restart)
                 return True
             
             # 启动服务器
             if text_lower in ["start"]:
                 logger.info(f"Admin {nickname}({qq}) triggered start")
-                await self._handle_admin_start()
+                await self._run_server_control("start", group_id, self._handle_admin_start)
                 return True
             
             # 关闭服务器
             if text_lower in ["stop"]:
                 logger.info(f"Admin {nickname}({qq}) triggered stop")
-                await self._handle_admin_stop()
+                await self._run_server_control("stop", group_id, self._handle_admin_stop)
                 return True
             
             # 执行游戏内命令
@@ -288,148 +383,56 @@ class MessageHandler:
                 
                 if game_cmd:
                     logger.info(f"Admin {nickname}({qq}) executing command: {game_cmd}")
-                    await self._handle_admin_cmd(game_cmd, nickname)
+                    await self._run_command("cmd", self._handle_admin_cmd(group_id, game_cmd, nickname))
                     return True
             
         return False
     
-    async def _handle_list_command(self):
-        """处理list命令 - 查询在线玩家"""
-        try:
-            # 调用MC服务器API
-            mc_backend_url = "http://localhost:8765"
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(
-                    f"{mc_backend_url}/api/players",
-                    headers={"Authorization": f"Bearer {settings.api_token}"}
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    is_stale = data.get("stale", False)
-                    
-                    # 如果数据已过期，说明服务器可能离线
-                    if is_stale:
-                        message = "🔴 服务器可能已离线（超过30秒无响应）"
-                    else:
-                        online_count = data.get("online_count", 0)
-                        max_players = data.get("max_players", 0)
-                        players = data.get("players", [])
-                        
-                        if online_count == 0:
-                            message = "📊 当前服务器无人在线"
-                        else:
-                            player_list = "\n".join([f"  • {p}" for p in players])
-                            message = f"📊 在线玩家 ({online_count}/{max_players}):\n{player_list}"
-                    
-                    # 发送消息，忽略发送过程中的超时等错误（消息可能已经发出）
-                    try:
-                        await napcat_client.send_group_message(settings.qq_group_id, message)
-                        logger.info(f"Sent player list to QQ: {online_count} players")
-                    except Exception as send_err:
-                        logger.warning(f"Send message may have timed out (message might still be sent): {send_err}")
-                else:
-                    logger.error(f"Failed to get player list: {response.status_code}")
-                    try:
-                        await napcat_client.send_group_message(settings.qq_group_id, "❌ 查询失败，服务器可能未响应")
-                    except Exception:
-                        pass
-                    
-        except httpx.RequestError as e:
-            logger.error(f"HTTP request error: {e}")
+    async def _run_command(self, name: str, handler: Awaitable[None]):
+        """执行命令处理并记录耗时"""
+        with COMMAND_SECONDS.time(name):
             try:
-                await napcat_client.send_group_message(settings.qq_group_id, f"❌ 查询出错: 无法连接到服务器")
+                await handler
             except Exception:
-                pass
-        except Exception as e:
-            logger.error(f"Error handling list command: {e}")
-            # 不再尝试发送错误消息，因为可能是连接问题导致的
+                COMMAND_FAILURES.inc(name)
+                raise
+
+    async def _run_server_control(self, name: str, group_id: int, handler: Callable[[int], Awaitable[None]]):
+        """执行服务器控制命令，已有控制命令在执行（可能在其他 worker 上）时拒绝"""
+        async with shared_state.lock(SERVER_CONTROL_LOCK) as acquired:
+            if not acquired:
+                await self._reply(group_id, "⏳ 另一个服务器控制命令正在执行，请稍后再试")
+                return
+            await self._run_command(name, handler(group_id))
+
+    async def _handle_list_command(self, group_id: int, channels: tuple[Channel, ...]):
+        """处理list命令 - 查询在线玩家"""
+        await asyncio.gather(*(channel.players.refresh() for channel in channels))
+        await self._reply(group_id, command_service.list_reply(channels))
+        logger.info("Sent player list to QQ")
 
-    async def _handle_status_command(self):
+    async def _handle_status_command(self, group_id: int):
         """处理status命令 - 查询服务器运行状态"""
-        import asyncio
-        
-        try:
-            # 获取 MC 服务器进程信息（兼容 Forge/Fabric/Paper 等各种服务端）
-            # 查找 Java Minecraft 服务器进程
-            info_cmd = """
-            # 查找包含 minecraftforge 或 user_jvm_args 或 fabric 的 java 进程
-            PID=$(ps aux | grep -E "java.*minecraftforge|java.*user_jvm_args|java.*fabric-server|java.*paper|java.*spigot" | grep -v grep | awk '{print $2}' | head -1)
-            
-            if [ -z "$PID" ]; then
-                # 备用：查找监听 25565 端口的进程
-                PID=$(lsof -i :25565 -t 2>/dev/null | head -1)
-            fi
-            
-            CORES=$(nproc)
-            if [ -n "$PID" ]; then
-                MEM=$(ps -p $PID -o rss= 2>/dev/null | awk '{printf "%.1f", $1/1024/1024}')
-                CPU=$(ps -p $PID -o %cpu= 2>/dev/null | awk -v cores="$CORES" '{printf "%.1f", $1/cores}')
-                UPTIME=$(ps -p $PID -o etime= 2>/dev/null | xargs)
-                echo "running|$MEM|$CPU|$UPTIME"
-            else
-                echo "stopped|||"
-            fi
-            """
-            proc = await asyncio.create_subprocess_shell(
-                info_cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await proc.communicate()
-            result = stdout.decode().strip()
-            
-            parts = result.split('|')
-            status = parts[0] if len(parts) > 0 else "stopped"
-            
-            if status != "running":
-                message = "🔴 服务器状态: 已停止"
-            else:
-                mem = parts[1] if len(parts) > 1 and parts[1] else "N/A"
-                cpu = parts[2] if len(parts) > 2 and parts[2] else "N/A"
-                uptime = parts[3] if len(parts) > 3 and parts[3] else "N/A"
-                
-                message = f"""🟢 服务器状态: 运行中
-💾 内存占用: {mem}G
-⚡ CPU 使用: {cpu}%
-⏱️ 运行时间: {uptime}"""
-            
-            try:
-                await napcat_client.send_group_message(settings.qq_group_id, message)
-                logger.info(f"Sent server status to QQ")
-            except Exception as send_err:
-                logger.warning(f"Send message may have timed out: {send_err}")
-                
-        except Exception as e:
-            logger.error(f"Error handling status command: {e}")
+        await self._reply(group_id, command_service.status_reply())
+        logger.info("Sent server status to QQ")
 
-    async def _handle_help_command(self, is_admin: bool):
+    async def _handle_help_command(self, group_id: int, is_admin: bool):
         """显示帮助信息"""
-        help_msg = """📖 可用命令:
-  • list - 查看在线玩家
-  • status - 查看服务器状态
-  • help - 显示此帮助"""
-        
-        if is_admin:
-            help_msg += """
+        await self._reply(group_id, command_service.help_reply(is_admin))
 
-🔧 管理员命令:
-  • start - 启动服务器
-  • stop - 关闭服务器
-  • restart - 重启服务器
-  • cmd <命令> - 执行游戏内命令"""
-        
+    async def _reply(self, group_id: int, message: str):
+        """回复到群，忽略发送过程中的超时等错误（消息可能已经发出）"""
         try:
-            await napcat_client.send_group_message(settings.qq_group_id, help_msg)
-        except Exception:
-            pass
+            await napcat_client.send_group_message(group_id, message)
+        except Exception as send_err:
+            logger.warning(f"Send message may have timed out (message might still be sent): {send_err}")
 
-    async def _handle_admin_start(self):
+    async def _handle_admin_start(self, group_id: int):
         """管理员命令：启动服务器"""
         import asyncio
         
         try:
-            await napcat_client.send_group_message(settings.qq_group_id, "🔄 正在启动服务器...")
+            await napcat_client.send_group_message(group_id, "🔄 正在启动服务器...")
         except Exception:
             pass
         
@@ -457,19 +460,19 @@ class MessageHandler:
                 message = "❌ 服务器启动失败，请检查日志"
             
             try:
-                await napcat_client.send_group_message(settings.qq_group_id, message)
+                await napcat_client.send_group_message(group_id, message)
             except Exception:
                 pass
                 
         except Exception as e:
             logger.error(f"Error starting server: {e}")
 
-    async def _handle_admin_stop(self):
+    async def _handle_admin_stop(self, group_id: int):
         """管理员命令：关闭服务器"""
         import asyncio
         
         try:
-            await napcat_client.send_group_message(settings.qq_group_id, "🔄 正在关闭服务器...")
+            await napcat_client.send_group_message(group_id, "🔄 正在关闭服务器...")
         except Exception:
             pass
         
@@ -498,19 +501,19 @@ class MessageHandler:
                 await asyncio.create_subprocess_shell("systemctl kill minecraft")
             
             try:
-                await napcat_client.send_group_message(settings.qq_group_id, message)
+                await napcat_client.send_group_message(group_id, message)
             except Exception:
                 pass
                 
         except Exception as e:
             logger.error(f"Error stopping server: {e}")
 
-    async def _handle_admin_restart(self):
+    async def _handle_admin_restart(self, group_id: int):
         """管理员命令：重启服务器"""
         import asyncio
         
         try:
-            await napcat_client.send_group_message(settings.qq_group_id, "🔄 正在重启服务器...")
+            await napcat_client.send_group_message(group_id, "🔄 正在重启服务器...")
         except Exception:
             pass
         
@@ -537,14 +540,14 @@ class MessageHandler:
                 message = "❌ 服务器重启失败，请检查日志"
             
             try:
-                await napcat_client.send_group_message(settings.qq_group_id, message)
+                await napcat_client.send_group_message(group_id, message)
             except Exception:
                 pass
                 
         except Exception as e:
             logger.error(f"Error restarting server: {e}")
 
-    async def _handle_admin_cmd(self, game_cmd: str, admin_name: str):
+    async def _handle_admin_cmd(self, group_id: int, game_cmd: str, admin_name: str):
         """管理员命令：执行游戏内命令"""
         import asyncio
         
@@ -561,7 +564,7 @@ class MessageHandler:
             
             if stdout.decode().strip() != 'ok':
                 try:
-                    await napcat_client.send_group_message(settings.qq_group_id, "❌ 服务器未运行或无法连接到控制台")
+                    await napcat_client.send_group_message(group_id, "❌ 服务器未运行或无法连接到控制台")
                 except Exception:
                     pass
                 return
@@ -581,14 +584,14 @@ class MessageHandler:
             logger.info(f"Admin {admin_name} executed: {game_cmd}")
             
             try:
-                await napcat_client.send_group_message(settings.qq_group_id, message)
+                await napcat_client.send_group_message(group_id, message)
             except Exception:
                 pass
                 
         except Exception as e:
             logger.error(f"Error executing game command: {e}")
             try:
-                await napcat_client.send_group_message(settings.qq_group_id, f"❌ 命令执行失败: {str(e)}")
+                await napcat_client.send_group_message(group_id, f"❌ 命令执行失败: {str(e)}")
             except Exception:
                 pass
 
@@ -658,24 +661,38 @@ class MessageHandler:
         }
         return face_map.get(str(face_id), f"表情{face_id}")
 
-    async def send_to_qq(self, player: str, message: str):
-        """发送消息到 QQ 群"""
-        try:
-            formatted = f"[MC] {player}: {message}"
-            await napcat_client.send_group_message(settings.qq_group_id, formatted)
-            logger.info(f"Sent to QQ: {formatted}")
-        except Exception as e:
-            logger.error(f"Failed to send to QQ: {e}")
+    @staticmethod
+    def validate_mc_message(msg: McMessage):
+        """检查事件类型所需的字段，缺失时抛出 ValueError"""
+        fields = MC_REQUIRED_FIELDS.get(msg.type)
+        if fields is None:
+            raise ValueError(f"Unknown message type: {msg.type}")
+        if not all(getattr(msg, field) for field in fields):
+            raise ValueError(f"Missing {' or '.join(fields)}")
 
-    async def send_system_to_qq(self, message: str):
-        """发送系统消息到 QQ 群"""
-        try:
-            await napcat_client.send_group_message(settings.qq_group_id, message)
-            logger.info(f"Sent system message to QQ: {message}")
-        except Exception as e:
-            logger.error(f"Failed to send system message to QQ: {e}")
+    def format_mc_message(self, msg: McMessage) -> tuple[str, str]:
+        """把 MC 事件格式化为 QQ 消息，返回 (消息, 处理结果描述)；字段缺失时抛出 ValueError"""
+        self.validate_mc_message(msg)
+
+        if msg.type == "player_chat":
+            return f"[MC] {msg.player}: {msg.message}", "Message sent"
+
+        elif msg.type == "system":
+            return msg.message, "System message sent"
+
+        elif msg.type == "player_join":
+            return f"📥 {msg.player} 加入了服务器", "Join event sent"
+
+        elif msg.type == "player_leave":
+            return f"📤 {msg.player} 离开了服务器", "Leave event sent"
+
+        elif msg.type == "death":
+            return f"💀 {msg.message}", "Death message sent"
+
+        else:
+            return f"🏆 {msg.player} 获得了成就: {msg.message}", "Achievement sent"
 
 
 # 全局处理器实例
 message_handler = MessageHandler()
-
+MEDIA_PENDING.set_function(media_workers.pending)
@@ -1,42 +1,420 @@
 import asyncio
 import logging
+from bisect import bisect_left, bisect_right
 from collections import deque
 from typing import Optional
-from datetime import datetime
 
+from app.config import settings
+from app.json_codec import dumps
 from app.models import QqMessage
+from app.message_store import SegmentedLog
+from app.metrics import Counter, Gauge
 
 logger = logging.getLogger(__name__)
 
+# 未指定 consumer 时使用的默认消费者
+DEFAULT_CONSUMER = "default"
+
+# 优先级通道，数值越大越晚被淘汰
+LANE_MEDIA = 0
+LANE_CHAT = 1
+LANE_SYSTEM = 2
+LANE_COUNT = 3
+MESSAGE_LANES = {
+    "system": LANE_SYSTEM,
+    "chat": LANE_CHAT,
+    "face": LANE_MEDIA,
+    "image": LANE_MEDIA,
+    "video": LANE_MEDIA,
+}
+
+# 队列满时的处理策略
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_LOWEST_PRIORITY = "drop-lowest-priority"
+OVERFLOW_COLLAPSE_DUPLICATES = "collapse-duplicates"
+OVERFLOW_SPILL_TO_DISK = "spill-to-disk"
+OVERFLOW_POLICIES = (
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DROP_LOWEST_PRIORITY,
+    OVERFLOW_COLLAPSE_DUPLICATES,
+    OVERFLOW_SPILL_TO_DISK,
+)
+
+QUEUE_PUSHED = Counter("mcqq_queue_pushed_total", "QQ messages pushed to the queue")
+QUEUE_DROPPED = Counter(
+    "mcqq_queue_dropped_total", "Messages lost before the consumer acknowledged them", ("consumer",)
+)
+QUEUE_OVERFLOW = Counter("mcqq_queue_overflow_total", "Overflow handling actions on a full queue", ("action",))
+QUEUE_POLLS = Counter("mcqq_queue_polls_total", "Queue polls by outcome", ("result",))
+QUEUE_DELIVERED = Counter("mcqq_queue_delivered_total", "Messages returned by polls")
+QUEUE_PENDING = Gauge("mcqq_queue_pending", "Unacknowledged messages per consumer", ("channel", "consumer"))
+QUEUE_LAST_SEQ = Gauge("mcqq_queue_last_seq", "Sequence number of the newest message", ("channel",))
+
+
+class QueueEntry:
+    """队列中的一条消息：序号和入队时编码好的 JSON（不含 null 字段）
+
+    轮询响应直接拼接 wire，不再逐条构造和序列化模型；
+    lane / sender / key 用于溢出时选择淘汰对象
+    """
+
+    __slots__ = ("seq", "wire", "lane", "sender", "key")
+
+    def __init__(self, seq: int, wire: bytes, lane: int = LANE_CHAT, sender: str = "", key: int = 0):
+        self.seq = seq
+        self.wire = wire
+        self.lane = lane
+        self.sender = sender
+        self.key = key  # 内容哈希，用于折叠重复消息
+
+    @classmethod
+    def from_record(cls, seq: int, data: dict) -> "QueueEntry":
+        msg_type = data.get("type")
+        sender = str(data.get("qq", ""))
+        key = hash((sender, msg_type, data.get("content"), data.get("description"), data.get("face_name")))
+        data["seq"] = seq
+        return cls(seq, dumps(data), MESSAGE_LANES.get(msg_type, LANE_CHAT), sender, key)
+
+    @classmethod
+    def from_message(cls, seq: int, message: QqMessage) -> "QueueEntry":
+        return cls.from_record(seq, message.model_dump(exclude_none=True))
+
+
+def encode_entries(entries: list[QueueEntry]) -> bytes:
+    """将多条消息拼接为 JSON 数组"""
+    return b"[" + b",".join(entry.wire for entry in entries) + b"]"
+
 
 class MessageQueueManager:
-    """消息队列管理器 - 用于 MC mod 轮询"""
+    """消息队列管理器 - 用于 MC mod 轮询
 
-    def __init__(self, max_size: int = 1000):
-        self._queue: deque[QqMessage] = deque(maxlen=max_size)
+    消息按序号保存在内存中，每个消费者（MC 服务器）拥有独立的游标，
+    互不抢占消息。内存中的消息达到 max_size 时先移除所有消费者都已确认的最旧消息，
+    否则按 overflow_policy 处理：
+    - drop-oldest：丢弃最旧的消息
+    - drop-lowest-priority：从最低优先级通道（媒体 < 聊天 < 系统）中，
+      丢弃该通道内消息最多的发送者的最旧消息，新消息优先级更低时丢弃新消息
+    - collapse-duplicates：与队列中已有消息重复的新消息直接丢弃，否则同 drop-lowest-priority
+    - spill-to-disk：最旧的消息移出内存但保留在磁盘日志中，轮询到时从磁盘读取
+    配置了 store 时消息和游标同时写入磁盘日志，启动时恢复
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        store: Optional[SegmentedLog] = None,
+        overflow_policy: str = OVERFLOW_DROP_LOWEST_PRIORITY
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            logger.warning(f"Unknown queue overflow policy '{overflow_policy}', using {OVERFLOW_DROP_LOWEST_PRIORITY}")
+            overflow_policy = OVERFLOW_DROP_LOWEST_PRIORITY
+        if overflow_policy == OVERFLOW_SPILL_TO_DISK and store is None:
+            logger.warning("Queue overflow policy spill-to-disk requires QUEUE_DATA_DIR, using drop-oldest")
+            overflow_policy = OVERFLOW_DROP_OLDEST
+
+        self._max_size = max_size
+        self._store = store
+        self._policy = overflow_policy
+        self._entries: dict[int, QueueEntry] = {}
+        self._seqs: list[int] = []  # 内存中消息的序号，升序
+        # 通道 -> 发送者 -> 该发送者在该通道中的消息序号（升序）
+        self._lanes: list[dict[str, deque[int]]] = [{} for _ in range(LANE_COUNT)]
+        self._keys: dict[int, int] = {}  # 内容哈希 -> 最新的序号
+        self._spill_floor = 1  # 磁盘上可读取的最旧序号（spill-to-disk）
+        self._overflowing = False
+        self._next_seq = 1  # 下一条消息的序号
+        self._cursors: dict[str, int] = {}  # 消费者 -> 已确认的最大序号
         self._lock = asyncio.Lock()
+        # 长轮询等待者在此条件上挂起，push 时唤醒
+        self._not_empty = asyncio.Condition(self._lock)
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    async def start(self):
+        """从磁盘日志恢复队列并启动后台落盘"""
+        if self._store is None:
+            return
 
-    async def push(self, message: QqMessage):
-        """添加消息到队列"""
+        records, cursors, max_seq = await asyncio.to_thread(self._store.recover)
         async with self._lock:
-            self._queue.append(message)
-            logger.debug(f"Message queued: {message.content[:50]}")
+            if records:
+                self._spill_floor = records[0][0]
+            for seq, data in records[-self._max_size:]:
+                self._insert(QueueEntry.from_message(seq, QqMessage.model_validate(data)))
+            self._next_seq = max_seq + 1
+            self._cursors.update(cursors)
+        self._store.set_live_source(self._live_before)
+        self._store.start()
+
+    async def close(self):
+        """落盘并关闭磁盘日志"""
+        if self._store is not None:
+            await self._store.close()
+
+    @property
+    def last_seq(self) -> int:
+        """最新一条消息的序号，0 表示尚无消息"""
+        return self._next_seq - 1
+
+    @property
+    def first_seq(self) -> int:
+        """内存中最旧消息的序号"""
+        return self._seqs[0] if self._seqs else self._next_seq
+
+    async def push(self, message: QqMessage) -> Optional[int]:
+        """添加消息到队列，返回分配的序号；队列已满且按策略丢弃新消息时返回 None"""
+        async with self._not_empty:
+            seq = self._next_seq
+            entry = QueueEntry.from_message(seq, message)
+
+            victim = None
+            if len(self._seqs) >= self._max_size:
+                victim = self._resolve_overflow(entry)
+                if victim is None:
+                    return None
+
+            if self._store is not None:
+                self._store.append(seq, entry.wire)
+            if victim is not None:
+                self._evict(*victim)
+            self._insert(entry)
+            self._next_seq += 1
+            self._not_empty.notify_all()
+            QUEUE_PUSHED.inc()
+            logger.debug(f"Message queued #{seq}: {message.content[:50]}")
+            return seq
+
+    async def poll(
+        self,
+        consumer: str = DEFAULT_CONSUMER,
+        after: Optional[int] = None,
+        max_count: int = 50,
+        timeout: float = 0
+    ) -> list[QueueEntry]:
+        """获取序号大于 after 的消息
+
+        after 为 None 时从该消费者的游标开始读取并自动确认（至多一次）；
+        指定 after 时只读不确认，由调用方通过 ack 确认（至少一次）。
+        after 为负数时从该消费者的游标开始读取，但不自动确认（mod 启动后尚无序号时使用）；
+        after 大于最新序号时（来自后端重启前或迁移前的队列），同样从游标重新开始。
+        timeout > 0 时为长轮询：没有新消息则等待新消息到达或超时
+        """
+        async with self._not_empty:
+            auto_ack = after is None
+            if auto_ack:
+                after = self._cursor(consumer)
+            elif after < 0:
+                after = self._cursor(consumer)
+            elif after > self.last_seq:
+                logger.debug(f"Consumer {consumer} polled after {after} beyond last seq {self.last_seq}, resetting")
+                after = self._cursor(consumer)
+
+            if not self._has_after(after) and timeout > 0:
+                try:
+                    await asyncio.wait_for(
+                        self._not_empty.wait_for(lambda: self._has_after(after)),
+                        timeout
+                    )
+                except asyncio.TimeoutError:
+                    QUEUE_POLLS.inc("empty")
+                    return []
 
-    async def poll(self, max_count: int = 50) -> list[QqMessage]:
-        """获取并清空队列中的消息"""
+            if self._spilled_after(after):
+                # 溢出到磁盘的消息在锁外读取
+                spill_after = max(after, self._spill_floor_seq() - 1)
+                spill_before = self.first_seq
+            else:
+                return self._take(consumer, after, max_count, auto_ack)
+
+        records = await asyncio.to_thread(self._store.read_range, spill_after, spill_before, max_count)
+        messages = [QueueEntry.from_record(seq, data) for seq, data in records]
+        if not messages:
+            # 磁盘上的记录已被压缩，从内存继续
+            async with self._lock:
+                return self._take(consumer, spill_before - 1, max_count, auto_ack)
+        if auto_ack:
+            await self.ack(consumer, messages[-1].seq)
+        QUEUE_POLLS.inc("messages")
+        QUEUE_DELIVERED.inc(amount=len(messages))
+        return messages
+
+    def _take(self, consumer: str, after: int, max_count: int, auto_ack: bool) -> list[QueueEntry]:
+        """从内存中取出序号大于 after 的消息（调用方持有锁）"""
+        start = bisect_right(self._seqs, after)
+        messages = [self._entries[seq] for seq in self._seqs[start:start + max_count]]
+        if auto_ack and messages:
+            self._set_cursor(consumer, messages[-1].seq)
+
+        QUEUE_POLLS.inc("messages" if messages else "empty")
+        QUEUE_DELIVERED.inc(amount=len(messages))
+        return messages
+
+    async def ack(self, consumer: str, seq: int):
+        """确认消费者已处理到 seq（含）；超过最新序号的确认来自过期的序号，忽略"""
         async with self._lock:
-            messages = []
-            count = min(len(self._queue), max_count)
-            for _ in range(count):
-                messages.append(self._queue.popleft())
-            return messages
-
-    async def size(self) -> int:
-        """获取队列大小"""
+            if self._cursor(consumer) < seq <= self.last_seq:
+                self._set_cursor(consumer, seq)
+
+    async def cursor(self, consumer: str = DEFAULT_CONSUMER) -> int:
+        """获取消费者已确认的最大序号"""
+        async with self._lock:
+            return self._cursor(consumer)
+
+    async def size(self, consumer: str = DEFAULT_CONSUMER) -> int:
+        """获取消费者尚未确认的消息数量"""
         async with self._lock:
-            return len(self._queue)
+            return self._pending(self._cursor(consumer))
+
+    async def stats(self) -> dict:
+        """获取队列状态"""
+        async with self._lock:
+            return {
+                "first_seq": self.first_seq,
+                "last_seq": self.last_seq,
+                "in_memory": len(self._seqs),
+                "overflow_policy": self._policy,
+                "consumers": self.pending_by_consumer()
+            }
+
+    def pending_by_consumer(self) -> dict[str, int]:
+        """各消费者尚未确认的消息数（只读快照，无需加锁）"""
+        return {name: self._pending(cursor) for name, cursor in self._cursors.items()}
+
+    def _pending(self, cursor: int) -> int:
+        pending = len(self._seqs) - bisect_right(self._seqs, cursor)
+        if self._policy == OVERFLOW_SPILL_TO_DISK:
+            # 溢出到磁盘的消息序号连续
+            pending += max(0, self.first_seq - max(cursor + 1, self._spill_floor_seq()))
+        return pending
+
+    def _has_after(self, after: int) -> bool:
+        """是否存在序号大于 after 的消息"""
+        return bool(self._seqs) and self._seqs[-1] > after or self._spilled_after(after)
+
+    def _spilled_after(self, after: int) -> bool:
+        """是否有序号大于 after、已溢出到磁盘的消息"""
+        return (
+            self._policy == OVERFLOW_SPILL_TO_DISK
+            and max(after + 1, self._spill_floor_seq()) < self.first_seq
+        )
+
+    def _spill_floor_seq(self) -> int:
+        """磁盘上保证可读取的最旧序号（压缩按段进行，实际保留的可能更多）"""
+        return max(self._spill_floor, self._next_seq - self._store.retain)
+
+    def _resolve_overflow(self, entry: QueueEntry) -> Optional[tuple[int, str]]:
+        """队列已满时决定淘汰哪条消息，返回 (序号, 原因)；返回 None 表示丢弃新消息"""
+        oldest = self._seqs[0]
+        # 所有消费者都已确认的消息可以直接移除
+        if self._cursors and min(self._cursors.values()) >= oldest:
+            if self._overflowing:
+                self._overflowing = False
+                logger.info("Message queue has room again")
+            return oldest, "acked"
+
+        if not self._overflowing:
+            self._overflowing = True
+            logger.warning(
+                f"Message queue full ({self._max_size} unacknowledged messages), "
+                f"applying overflow policy {self._policy}"
+            )
+
+        policy = self._policy
+        if policy == OVERFLOW_SPILL_TO_DISK:
+            return oldest, "spilled"
+        if policy == OVERFLOW_DROP_OLDEST:
+            return oldest, "drop_oldest"
+        if policy == OVERFLOW_COLLAPSE_DUPLICATES and entry.key in self._keys:
+            QUEUE_OVERFLOW.inc("collapsed")
+            return None
+
+        victim = self._fair_victim(entry.lane)
+        if victim is None:
+            # 新消息的优先级低于队列中所有消息
+            QUEUE_OVERFLOW.inc("rejected")
+            for name in self._cursors:
+                QUEUE_DROPPED.inc(name)
+            return None
+        return victim, "drop_lowest_priority"
+
+    def _fair_victim(self, lane: int) -> Optional[int]:
+        """从不高于 lane 的最低优先级通道中，选出消息最多的发送者的最旧消息"""
+        for candidate_lane in range(lane + 1):
+            senders = self._lanes[candidate_lane]
+            if senders:
+                return max(senders.values(), key=len)[0]
+        return None
+
+    def _evict(self, seq: int, action: str):
+        QUEUE_OVERFLOW.inc(action)
+        if action != "spilled":
+            for name, cursor in self._cursors.items():
+                if cursor < seq:
+                    QUEUE_DROPPED.inc(name)
+
+        is_oldest = seq == self._seqs[0]
+        self._remove(seq)
+        if self._store is not None and self._policy != OVERFLOW_SPILL_TO_DISK:
+            if not is_oldest:
+                # 不是最旧的消息，恢复时无法按条数推断，需要记录删除标记
+                self._store.append_tombstone(seq)
+
+    def _live_before(self, seq: int) -> list[tuple[int, bytes]]:
+        """内存中序号小于 seq 的消息，磁盘日志压缩旧段时复制保留（调用方持有锁）"""
+        if self._policy == OVERFLOW_SPILL_TO_DISK:
+            # 溢出的消息按保留条数从磁盘淘汰，内存中的消息总在保留范围内
+            return []
+        return [(s, self._entries[s].wire) for s in self._seqs[:bisect_left(self._seqs, seq)]]
+
+    def _insert(self, entry: QueueEntry):
+        self._entries[entry.seq] = entry
+        self._seqs.append(entry.seq)
+        self._lanes[entry.lane].setdefault(entry.sender, deque()).append(entry.seq)
+        self._keys[entry.key] = entry.seq
+
+    def _remove(self, seq: int):
+        entry = self._entries.pop(seq)
+        del self._seqs[bisect_left(self._seqs, seq)]
+        senders = self._lanes[entry.lane]
+        seqs = senders[entry.sender]
+        if seqs[0] == seq:
+            seqs.popleft()
+        else:
+            seqs.remove(seq)
+        if not seqs:
+            del senders[entry.sender]
+        if self._keys.get(entry.key) == seq:
+            del self._keys[entry.key]
+
+    def _cursor(self, consumer: str) -> int:
+        """新消费者从内存中最旧的消息开始读取"""
+        cursor = self._cursors.get(consumer)
+        if cursor is None:
+            cursor = self.first_seq - 1
+            self._set_cursor(consumer, cursor)
+        return cursor
 
+    def _set_cursor(self, consumer: str, seq: int):
+        self._cursors[consumer] = seq
+        if self._store is not None:
+            self._store.save_cursors(self._cursors)
 
-# 全局消息队列
-message_queue = MessageQueueManager()
 
+def create_message_queue(data_dir: str) -> MessageQueueManager:
+    """按配置创建消息队列，data_dir 为空时仅保存在内存中"""
+    return MessageQueueManager(
+        max_size=settings.queue_max_size,
+        store=SegmentedLog(
+            data_dir,
+            retain=(
+                settings.queue_spill_max_records
+                if settings.queue_overflow_policy == OVERFLOW_SPILL_TO_DISK
+                else settings.queue_max_size
+            ),
+            segment_max_records=settings.queue_segment_max_records,
+            fsync_interval=settings.queue_fsync_interval_ms / 1000
+        ) if data_dir else None,
+        overflow_policy=settings.queue_overflow_policy
+    )
@@ -0,0 +1,248 @@
+"""消息持久化 - 追加写分段日志，保证重启/崩溃后队列不丢失"""
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import IO, Callable, Optional
+
+from app.json_codec import loads
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".log"
+CURSORS_FILE = "cursors.json"
+
+
+class SegmentedLog:
+    """追加写分段日志
+
+    每条记录一行 JSON，写入只进入操作系统缓冲区，由后台任务批量 fsync；
+    段文件写满后滚动，并删除已超出保留条数的旧段；旧段中仍在使用的记录（如未被淘汰的系统消息）
+    先复制到当前段，磁盘占用始终与保留条数相当。
+    被提前淘汰的消息以删除标记记录（{"seq": N, "drop": true}），恢复时跳过
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        retain: int,
+        segment_max_records: int = 5000,
+        fsync_interval: float = 0.2
+    ):
+        self._dir = Path(directory)
+        self._retain = retain
+        self._segment_max_records = segment_max_records
+        self._fsync_interval = fsync_interval
+        self._segments: list[tuple[int, Path]] = []  # (首条序号, 路径)，按序号升序
+        self._file: Optional[IO[bytes]] = None
+        self._file_records = 0
+        self._unsynced: list[IO[bytes]] = []  # 自上次 fsync 以来写入过的文件
+        self._retired: list[IO[bytes]] = []  # 已滚动、等待 fsync 后关闭的文件
+        self._cursors: Optional[dict[str, int]] = None  # 待写入的游标快照
+        self._flusher: Optional[asyncio.Task] = None
+        self._syncing: Optional[asyncio.Future] = None  # 正在线程中执行的 fsync，取消等待不会中止它
+        # 返回序号小于给定值、仍在使用的记录 [(序号, 编码后的 JSON)]，压缩时复制到当前段
+        self._live_source: Optional[Callable[[int], list[tuple[int, bytes]]]] = None
+
+    @property
+    def retain(self) -> int:
+        return self._retain
+
+    def recover(self) -> tuple[list[tuple[int, dict]], dict[str, int], int]:
+        """读取磁盘上的记录和游标，截断崩溃时写了一半的尾部记录
+
+        返回 (未被淘汰的记录, 游标, 出现过的最大序号)
+        """
+        self._dir.mkdir(parents=True, exist_ok=True)
+        live: dict[int, dict] = {}
+        max_seq = 0
+
+        for path in sorted(self._dir.glob(f"*{SEGMENT_SUFFIX}")):
+            first_seq = int(path.stem)
+            self._segments.append((first_seq, path))
+            for seq, message in self._read_segment(path):
+                max_seq = max(max_seq, seq)
+                if message is None:
+                    live.pop(seq, None)
+                else:
+                    live[seq] = message
+        records = sorted(live.items())
+
+        cursors: dict[str, int] = {}
+        cursors_path = self._dir / CURSORS_FILE
+        if cursors_path.exists():
+            try:
+                cursors = json.loads(cursors_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to load queue cursors: {e}")
+
+        logger.info(f"Recovered {len(records)} queued messages from {self._dir}")
+        return records[-self._retain:], cursors, max_seq
+
+    def _read_segment(self, path: Path) -> list[tuple[int, Optional[dict]]]:
+        """读取单个段文件，遇到损坏的记录时截断到最后一条完整记录
+
+        删除标记的消息为 None
+        """
+        records = []
+        good_offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("torn record")
+                    record = loads(line)
+                    records.append((record["seq"], None if record.get("drop") else record["msg"]))
+                    good_offset += len(line)
+                except (ValueError, KeyError):
+                    logger.warning(f"Truncating corrupt queue segment {path.name} at offset {good_offset}")
+                    with open(path, "r+b") as wf:
+                        wf.truncate(good_offset)
+                    break
+        return records
+
+    def start(self):
+        """启动后台 fsync 任务"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    def append(self, seq: int, message: bytes):
+        """追加一条记录，message 为已编码的 JSON"""
+        if self._file is None or self._file_records >= self._segment_max_records:
+            self._roll(seq)
+
+        self._write(b'{"seq":%d,"msg":%s}\n' % (seq, message))
+
+    def append_tombstone(self, seq: int):
+        """记录 seq 已被淘汰，须在该序号之后的某条消息写入后调用（不会触发滚动）"""
+        if self._file is not None:
+            self._write(b'{"seq":%d,"drop":true}\n' % seq)
+
+    def set_live_source(self, source: Callable[[int], list[tuple[int, bytes]]]):
+        """设置压缩时查询仍在使用的旧记录的回调"""
+        self._live_source = source
+
+    def read_range(self, after: int, before: int, max_count: int) -> list[tuple[int, dict]]:
+        """读取 after < seq < before 的未淘汰记录（阻塞调用，只读，不截断文件）"""
+        records = []
+        segments = list(self._segments)
+        for i, (first_seq, path) in enumerate(segments):
+            if first_seq >= before:
+                break
+            # 本段最后一条序号 = 下一段首条序号 - 1
+            if i + 1 < len(segments) and segments[i + 1][0] - 1 <= after:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        record = loads(line)
+                        seq = record["seq"]
+                        if seq >= before:
+                            break
+                        if seq > after and not record.get("drop"):
+                            records.append((seq, record["msg"]))
+                            if len(records) >= max_count:
+                                return records
+            except FileNotFoundError:
+                # 读取期间被压缩删除
+                continue
+        return records
+
+    def _write(self, line: bytes):
+        self._file.write(line)
+        self._file.flush()  # 只写入操作系统缓冲区，fsync 由后台批量完成
+        self._file_records += 1
+        if self._file not in self._unsynced:
+            self._unsynced.append(self._file)
+
+    def save_cursors(self, cursors: dict[str, int]):
+        """记录游标快照，由后台任务写盘"""
+        self._cursors = dict(cursors)
+
+    def _roll(self, seq: int):
+        """滚动到新的段文件，并压缩旧段"""
+        if self._file is not None:
+            self._retired.append(self._file)
+
+        self._dir.mkdir(parents=True, exist_ok=True)
+        path = self._dir / f"{seq:020d}{SEGMENT_SUFFIX}"
+        self._file = open(path, "ab")
+        self._file_records = 0
+        if not self._segments or self._segments[-1][1] != path:
+            self._segments.append((seq, path))
+        self._compact(seq)
+
+    def _compact(self, next_seq: int):
+        """删除所有记录都已超出保留条数的段，其中仍在使用的记录先复制到当前段"""
+        min_seq = next_seq - self._retain
+        # 某段的最后一条序号 = 下一段首条序号 - 1
+        expired = 0
+        while expired + 1 < len(self._segments) and self._segments[expired + 1][0] - 1 < min_seq:
+            expired += 1
+        if not expired:
+            return
+
+        if self._live_source is not None:
+            live = self._live_source(self._segments[expired][0])
+            for seq, message in live:
+                self._write(b'{"seq":%d,"msg":%s}\n' % (seq, message))
+            if live:
+                # 旧段删除前确保副本已落盘（只在有记录需要保留时发生）
+                os.fsync(self._file.fileno())
+                logger.debug(f"Carried {len(live)} live queue records forward")
+
+        for _, path in self._segments[:expired]:
+            try:
+                path.unlink()
+                logger.debug(f"Compacted queue segment {path.name}")
+            except OSError as e:
+                logger.warning(f"Failed to remove queue segment {path.name}: {e}")
+        del self._segments[:expired]
+
+    async def _flush_loop(self):
+        """定期批量 fsync"""
+        while True:
+            await asyncio.sleep(self._fsync_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Queue fsync failed: {e}")
+
+    async def flush(self):
+        """将待同步的文件和游标落盘"""
+        files, self._unsynced = self._unsynced, []
+        retired, self._retired = self._retired, []
+        cursors, self._cursors = self._cursors, None
+        if files or retired or cursors is not None:
+            self._syncing = asyncio.ensure_future(asyncio.to_thread(self._sync, files, retired, cursors))
+            await asyncio.shield(self._syncing)
+
+    def _sync(self, files: list[IO[bytes]], retired: list[IO[bytes]], cursors: Optional[dict[str, int]]):
+        for f in files:
+            os.fsync(f.fileno())
+        for f in retired:
+            f.close()
+        if cursors is not None:
+            tmp_path = self._dir / f"{CURSORS_FILE}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cursors, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._dir / CURSORS_FILE)
+
+    async def close(self):
+        """停止后台任务并落盘，等待进行中的 fsync 完成后再关闭文件"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if self._syncing is not None:
+            # 失败已由后台任务记录
+            await asyncio.gather(self._syncing, return_exceptions=True)
+            self._syncing = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,169 @@
+"""运行指标 - 以 Prometheus 文本格式导出的计数器、仪表和直方图
+
+指标只在事件循环线程中更新，更新操作就是一次字典读写，不加锁；
+抓取时才生成文本
+"""
+import bisect
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Union
+
+# 耗时直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = tuple[str, ...]
+# 回调返回单个值（无标签）或 {标签值元组: 值}
+MetricCallback = Callable[[], Union[float, dict[LabelValues, float]]]
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """生成 Prometheus 文本格式（0.0.4）"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# 全局注册表
+REGISTRY = Registry()
+
+
+class Metric:
+    """指标基类，创建时自动注册"""
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        fn: Optional[MetricCallback] = None,
+        registry: Registry = REGISTRY
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._fn = fn
+        self._values: dict[LabelValues, float] = {} if labelnames else {(): 0.0}
+        registry.register(self)
+
+    def set_function(self, fn: MetricCallback):
+        """改为在抓取时调用 fn 取值"""
+        self._fn = fn
+
+    def samples(self) -> Iterator[tuple[str, list[tuple[str, str]], float]]:
+        values = self._values
+        if self._fn is not None:
+            result = self._fn()
+            values = result if isinstance(result, dict) else {(): result}
+        for labelvalues, value in values.items():
+            yield "", list(zip(self.labelnames, labelvalues)), value
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    type = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的仪表"""
+
+    type = "gauge"
+
+    def set(self, value: float, *labelvalues: str):
+        self._values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) - amount
+
+
+class Histogram(Metric):
+    """分桶直方图，每组标签保存各桶计数、总和与次数"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        registry: Registry = REGISTRY
+    ):
+        self._buckets = tuple(sorted(buckets))
+        self._states: dict[LabelValues, list] = {}
+        super().__init__(name, help, labelnames, registry=registry)
+
+    def observe(self, value: float, *labelvalues: str):
+        state = self._states.get(labelvalues)
+        if state is None:
+            # [各桶计数（最后一个为 +Inf）, 总和, 次数]
+            state = self._states[labelvalues] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self._buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        """记录代码块的耗时（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self) -> Iterator[tuple[str, list[tuple[str, str]], float]]:
+        for labelvalues, (counts, total, count) in self._states.items():
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield "_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+def _format_labels(labels: list[tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render_metrics() -> str:
+    """导出全局注册表中的所有指标"""
+    return REGISTRY.render()
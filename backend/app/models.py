@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List, Literal
+from pydantic import BaseModel, Field
+from typing import Any, Dict, Optional, List, Literal, Union
 from datetime import datetime
 
 
@@ -18,11 +18,19 @@ class QqMessage(BaseModel):
     content: str
     description: Optional[str] = None
     face_name: Optional[str] = None
+    seq: Optional[int] = None  # 入队时分配的序号
 
 
 class MessageQueue(BaseModel):
     """消息队列响应"""
     messages: List[QqMessage]
+    last_seq: int  # 下次轮询时作为 since 传回以确认
+
+
+class AckRequest(BaseModel):
+    """消费确认"""
+    consumer: str = "default"
+    seq: int
 
 
 class SendResponse(BaseModel):
@@ -31,6 +39,38 @@ class SendResponse(BaseModel):
     message: str
 
 
+class DeliveryAccepted(SendResponse):
+    """异步投递受理响应"""
+    delivery_id: str
+    status: str
+
+
+class DeliveryStatus(BaseModel):
+    """投递状态：queued / retrying / delivered / failed"""
+    id: str
+    status: str
+    attempts: int
+    result: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+
+# 单次批量提交的最大事件数
+MAX_BATCH_SIZE = 500
+
+
+class McMessageBatch(BaseModel):
+    """批量提交的 MC 事件，逐条校验，单条无效不影响其他事件"""
+    messages: List[Dict[str, Any]] = Field(max_length=MAX_BATCH_SIZE)
+
+
+class BatchResponse(BaseModel):
+    """批量提交响应，results 与请求中的事件一一对应，已受理的事件带投递 ID"""
+    success: bool
+    results: List[Union[DeliveryAccepted, SendResponse]]
+
+
 class HealthCheck(BaseModel):
     """健康检查"""
     status: str
@@ -39,7 +79,14 @@ class HealthCheck(BaseModel):
 
 
 class PlayerListUpdate(BaseModel):
-    """玩家列表更新"""
-    players: List[str]
+    """玩家列表更新
+
+    players 为完整列表；不提供时 joined/left 为相对上次的增量，都为空则是列表未变化的心跳。
+    hash 为更新后列表的摘要，与后端不一致时返回 409，mod 需要重新发送完整列表
+    """
+    players: Optional[List[str]] = None
+    joined: List[str] = []
+    left: List[str] = []
+    hash: Optional[str] = None
     max_players: int = 20
 
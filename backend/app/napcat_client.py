@@ -1,17 +1,48 @@
 import asyncio
-import json
 import logging
-from typing import Optional, Callable, Awaitable
+import random
+import time
+from collections import deque
+from typing import Optional, Callable, Awaitable, NamedTuple
 import websockets
 from websockets.client import WebSocketClientProtocol
 
 from app.config import settings
+from app.json_codec import dumps_text, loads, is_meta_event, JSONDecodeError
+from app.metrics import Counter, Gauge, Histogram
 
 logger = logging.getLogger(__name__)
 
+NAPCAT_EVENTS = Counter("mcqq_napcat_events_total", "Frames received from NapCat by post type", ("post_type",))
+NAPCAT_API_SECONDS = Histogram("mcqq_napcat_api_seconds", "NapCat API call round-trip time", ("action",))
+NAPCAT_API_FAILURES = Counter("mcqq_napcat_api_failures_total", "Failed NapCat API calls", ("action", "reason"))
+NAPCAT_RECONNECTS = Counter("mcqq_napcat_reconnects_total", "NapCat reconnect attempts")
+NAPCAT_CONNECTED = Gauge("mcqq_napcat_connected", "Whether the NapCat WebSocket is connected")
+NAPCAT_REPLAY = Counter(
+    "mcqq_napcat_replay_total", "Group messages buffered while NapCat was disconnected, by outcome", ("result",)
+)
+NAPCAT_REPLAY_PENDING = Gauge("mcqq_napcat_replay_pending", "Group messages waiting to be replayed to NapCat")
+
+
+class NotConnectedError(ConnectionError):
+    """请求未能发出（未连接或发送时连接已断开），可以安全地重新发送"""
+
+
+class Buffered(NamedTuple):
+    """群消息因未连接放入了补发缓冲区，不是 API 响应
+
+    replayed 在补发成功后得到 API 响应，被丢弃时为 NotConnectedError（没有发出，可以重新提交），
+    补发失败时为其他异常（可能已经送达）
+    """
+    replayed: asyncio.Future
+
 
 class NapCatClient:
-    """NapCat WebSocket 客户端"""
+    """NapCat WebSocket 客户端
+
+    断线时立即让等待中的 API 调用失败，按指数退避加随机抖动重连；
+    断线期间发送的群消息放入有界的补发缓冲区（满时丢弃最旧的），重连后按顺序补发
+    """
 
     def __init__(self):
         self.ws: Optional[WebSocketClientProtocol] = None
@@ -21,13 +52,18 @@ class NapCatClient:
         self._pending_requests: dict[str, asyncio.Future] = {}
         self._reconnect_task: Optional[asyncio.Task] = None
         self._receive_task: Optional[asyncio.Task] = None
+        self._event_tasks: set[asyncio.Task] = set()  # 正在处理的事件
+        # 断线期间待发送的群消息：(action, params, 入队时间, 补发结果)
+        self._replay: deque[tuple[str, dict, float, asyncio.Future]] = deque()
+        self._replay_task: Optional[asyncio.Task] = None
 
     def set_message_handler(self, handler: Callable[[dict], Awaitable[None]]):
         """设置消息处理回调"""
         self._message_handler = handler
 
     async def connect(self):
-        """连接到 NapCat WebSocket"""
+        """连接到 NapCat WebSocket，断开后自动重连"""
+        attempt = 0
         while True:
             try:
                 url = settings.napcat_ws_url
@@ -38,7 +74,9 @@ class NapCatClient:
                 logger.info(f"Connecting to NapCat: {url}")
                 self.ws = await websockets.connect(url, additional_headers=headers)
                 self.connected = True
+                attempt = 0
                 logger.info("Connected to NapCat successfully!")
+                self._start_replay()
 
                 # 启动接收任务
                 self._receive_task = asyncio.create_task(self._receive_loop())
@@ -46,23 +84,45 @@ class NapCatClient:
 
             except websockets.exceptions.ConnectionClosed as e:
                 logger.warning(f"NapCat connection closed: {e}")
-                self.connected = False
             except Exception as e:
                 logger.error(f"NapCat connection error: {e}")
-                self.connected = False
+            self.connected = False
+            self._fail_pending()
 
             # 重连延迟
-            logger.info("Reconnecting to NapCat in 5 seconds...")
-            await asyncio.sleep(5)
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            logger.info(f"Reconnecting to NapCat in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+            NAPCAT_RECONNECTS.inc()
+
+    @staticmethod
+    def _reconnect_delay(attempt: int) -> float:
+        """指数退避，在上限的一半到上限之间随机取值，避免与 NapCat 重启的节奏同步"""
+        ceiling = min(
+            settings.napcat_reconnect_max_seconds,
+            settings.napcat_reconnect_min_seconds * 2 ** min(attempt, 16)
+        )
+        return random.uniform(ceiling / 2, ceiling)
+
+    def _fail_pending(self):
+        """连接断开，等待响应的 API 调用立即失败而不是等到超时"""
+        for future in self._pending_requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError("NapCat connection lost"))
 
     async def _receive_loop(self):
         """接收消息循环"""
         try:
             async for message in self.ws:
+                # 心跳等元事件不做处理，跳过完整解析
+                if is_meta_event(message):
+                    NAPCAT_EVENTS.inc("meta_event")
+                    continue
                 try:
-                    data = json.loads(message)
+                    data = loads(message)
                     await self._handle_message(data)
-                except json.JSONDecodeError as e:
+                except JSONDecodeError as e:
                     logger.error(f"Invalid JSON received: {e}")
         except websockets.exceptions.ConnectionClosed:
             logger.warning("WebSocket connection closed")
@@ -77,17 +137,28 @@ class NapCatClient:
                 self._pending_requests[echo].set_result(data)
                 return
 
-        # 处理事件
+        # 处理事件：并发分发，避免慢速处理阻塞接收循环和 API 响应
         post_type = data.get("post_type")
+        NAPCAT_EVENTS.inc(str(post_type or "unknown"))
         if post_type == "message" and self._message_handler:
-            await self._message_handler(data)
+            task = asyncio.create_task(self._dispatch_event(data))
+            self._event_tasks.add(task)
+            task.add_done_callback(self._event_tasks.discard)
         elif post_type == "meta_event":
             logger.debug(f"Meta event: {data.get('meta_event_type')}")
 
+    async def _dispatch_event(self, data: dict):
+        """在独立任务中执行消息处理回调"""
+        try:
+            await self._message_handler(data)
+        except Exception as e:
+            logger.error(f"Error handling NapCat event: {e}")
+
     async def call_api(self, action: str, params: dict = None, timeout: float = 10.0) -> dict:
         """调用 NapCat API"""
         if not self.connected or not self.ws:
-            raise ConnectionError("Not connected to NapCat")
+            NAPCAT_API_FAILURES.inc(action, "disconnected")
+            raise NotConnectedError("Not connected to NapCat")
 
         self._echo_counter += 1
         echo = f"mc_qq_{self._echo_counter}"
@@ -102,29 +173,95 @@ class NapCatClient:
         self._pending_requests[echo] = future
 
         try:
-            await self.ws.send(json.dumps(request))
-            result = await asyncio.wait_for(future, timeout)
+            with NAPCAT_API_SECONDS.time(action):
+                try:
+                    await self.ws.send(dumps_text(request))
+                except websockets.exceptions.ConnectionClosed as e:
+                    raise NotConnectedError(f"NapCat connection closed: {e}") from e
+                result = await asyncio.wait_for(future, timeout)
             return result
+        except NotConnectedError:
+            NAPCAT_API_FAILURES.inc(action, "disconnected")
+            raise
         except asyncio.TimeoutError:
+            NAPCAT_API_FAILURES.inc(action, "timeout")
             logger.error(f"API call timeout: {action}")
             raise
+        except Exception:
+            NAPCAT_API_FAILURES.inc(action, "error")
+            raise
         finally:
             self._pending_requests.pop(echo, None)
 
-    async def send_group_message(self, group_id: int, message: str) -> dict:
-        """发送群消息"""
-        return await self.call_api("send_group_msg", {
+    async def send_group_message(self, group_id: int, message: str) -> dict | Buffered:
+        """发送群消息，未连接时放入补发缓冲区"""
+        return await self._send_or_buffer("send_group_msg", {
             "group_id": group_id,
             "message": message
         })
 
-    async def send_group_message_cq(self, group_id: int, message_segments: list) -> dict:
-        """发送群消息（CQ码格式）"""
-        return await self.call_api("send_group_msg", {
+    async def send_group_message_cq(self, group_id: int, message_segments: list) -> dict | Buffered:
+        """发送群消息（CQ码格式），未连接时放入补发缓冲区"""
+        return await self._send_or_buffer("send_group_msg", {
             "group_id": group_id,
             "message": message_segments
         })
 
+    async def _send_or_buffer(self, action: str, params: dict) -> dict | Buffered:
+        """发送消息并返回 API 响应；未连接或仍有待补发的消息时放入缓冲区并返回 Buffered，保证按提交顺序送达
+
+        请求已发出但等待响应时断开的消息不补发（可能已经送达），调用方收到 ConnectionError
+        """
+        if self.connected and not self._replay:
+            try:
+                return await self.call_api(action, params)
+            except NotConnectedError:
+                pass
+        if len(self._replay) >= settings.napcat_replay_buffer_size:
+            _, _, _, dropped = self._replay.popleft()
+            _fail(dropped, NotConnectedError("Dropped from the full NapCat replay buffer"))
+            NAPCAT_REPLAY.inc("dropped")
+            logger.warning("NapCat replay buffer full, dropped the oldest message")
+        replayed = asyncio.get_running_loop().create_future()
+        self._replay.append((action, params, time.time(), replayed))
+        NAPCAT_REPLAY.inc("buffered")
+        if self.connected:
+            self._start_replay()
+        return Buffered(replayed)
+
+    def _start_replay(self):
+        if self._replay and (self._replay_task is None or self._replay_task.done()):
+            self._replay_task = asyncio.create_task(self._replay_loop())
+
+    async def _replay_loop(self):
+        """重连后按顺序补发缓冲区中的消息，再次断开时保留剩余的消息"""
+        count = 0
+        while self._replay and self.connected:
+            action, params, _, replayed = self._replay[0]
+            try:
+                result = await self.call_api(action, params)
+                NAPCAT_REPLAY.inc("replayed")
+                if not replayed.done():
+                    replayed.set_result(result)
+            except NotConnectedError:
+                break
+            except Exception as e:
+                # 超时等情况下消息可能已经送达，不再重发，由调用方决定是否重新提交
+                NAPCAT_REPLAY.inc("failed")
+                logger.warning(f"Failed to replay buffered message: {e}")
+                _fail(replayed, e)
+            self._replay.popleft()
+            count += 1
+            if self._replay:
+                # 补发也要避免短时间内大量发送触发风控
+                await asyncio.sleep(settings.napcat_replay_interval_ms / 1000)
+        if count:
+            logger.info(f"Replayed {count} message(s) buffered while NapCat was disconnected")
+
+    def replay_pending(self) -> int:
+        """等待补发的消息数"""
+        return len(self._replay)
+
     async def get_group_member_info(self, group_id: int, user_id: int) -> dict:
         """获取群成员信息"""
         return await self.call_api("get_group_member_info", {
@@ -141,13 +278,26 @@ class NapCatClient:
     async def close(self):
         """关闭连接"""
         self.connected = False
+        self._fail_pending()
+        if self._replay_task:
+            self._replay_task.cancel()
         if self._receive_task:
             self._receive_task.cancel()
+        for task in list(self._event_tasks):
+            task.cancel()
         if self.ws:
             await self.ws.close()
         logger.info("NapCat client closed")
 
 
+def _fail(future: asyncio.Future, error: BaseException):
+    if not future.done():
+        future.set_exception(error)
+        # 调用方不关心补发结果时不再提示异常未被读取
+        future.exception()
+
+
 # 全局客户端实例
 napcat_client = NapCatClient()
-
+NAPCAT_CONNECTED.set_function(lambda: 1 if napcat_client.connected else 0)
+NAPCAT_REPLAY_PENDING.set_function(napcat_client.replay_pending)
@@ -0,0 +1,300 @@
+"""MC → QQ 发件箱 - 合并突发消息、限速并按长度拆分，避免触发 QQ 风控"""
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import partial
+from typing import Awaitable, Callable, Optional
+
+from app.config import settings
+from app.json_codec import dumps, loads
+from app.metrics import Counter, Gauge
+from app.napcat_client import Buffered, NotConnectedError, napcat_client
+from app.state import MemoryState, shared_state
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_SUBMITTED = Counter("mcqq_outbox_submitted_total", "MC messages submitted to the QQ outbox")
+OUTBOX_SENT = Counter("mcqq_outbox_sent_total", "Merged messages sent to QQ by outcome", ("result",))
+OUTBOX_PENDING = Gauge("mcqq_outbox_pending", "Messages waiting in the QQ outbox")
+
+# 多 worker 部署时转交给 leader 的消息流
+RELAY_STREAM = "outbox"
+RELAY_CONSUMER = "leader"
+RELAY_STREAM_MAX = 10000
+RELAY_BATCH = 100
+
+
+class TokenBucket:
+    """令牌桶限速器"""
+
+    def __init__(self, rate: float, capacity: int):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        """获取一个令牌，不足时等待"""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+def split_message(lines: list[str], max_length: int) -> list[str]:
+    """将多行消息合并为若干条不超过 max_length 的消息
+
+    优先在行边界拆分，单行过长时在空白处或按长度硬切
+    """
+    return [chunk for chunk, _, _ in split_message_spans(lines, max_length)]
+
+
+def split_message_spans(lines: list[str], max_length: int) -> list[tuple[str, int, int]]:
+    """同 split_message，同时返回每条消息包含的行的下标范围 (消息, 首行, 末行)"""
+    chunks: list[tuple[str, int, int]] = []
+    current = ""
+    current_first = 0
+
+    for i, line in enumerate(lines):
+        while len(line) > max_length:
+            cut = line.rfind(" ", 0, max_length)
+            if cut <= 0:
+                cut = max_length
+            if current:
+                chunks.append((current, current_first, i - 1))
+                current = ""
+            chunks.append((line[:cut], i, i))
+            line = line[cut:].lstrip(" ")
+
+        if not current:
+            current = line
+            current_first = i
+        elif len(current) + 1 + len(line) <= max_length:
+            current = f"{current}\n{line}"
+        else:
+            chunks.append((current, current_first, i - 1))
+            current = line
+            current_first = i
+
+    if current:
+        chunks.append((current, current_first, len(lines) - 1))
+    return chunks
+
+
+class PendingLine:
+    """一行消息的发送结果：所在的每条消息都被 NapCat 接受后成功，任何一条失败即失败
+
+    失败为 NotConnectedError 时该行确定没有发出，可以重新提交
+    """
+
+    __slots__ = ("future", "remaining", "error", "partial")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.remaining = 0  # 尚未有结果的消息数
+        self.error: Optional[BaseException] = None
+        self.partial = False  # 过长被拆分时是否已有部分发出
+
+    def settle(self, error: Optional[BaseException]):
+        if error is None:
+            self.partial = True
+        elif self.error is None:
+            self.error = error
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.resolve()
+
+    def resolve(self):
+        if self.future.done():
+            return
+        if self.error is None:
+            self.future.set_result(None)
+        else:
+            error = self.error
+            if self.partial and isinstance(error, NotConnectedError):
+                # 已有部分发出，重新提交整行会重复
+                error = ConnectionError(f"Message was only partially sent: {error}")
+            self.future.set_exception(error)
+            # 发件箱已记录错误日志，调用方不关心结果时不再提示异常未被读取
+            self.future.exception()
+
+
+class QqOutbox:
+    """发件箱
+
+    收到第一条消息后等待合并窗口，再取出期间积压的全部消息，
+    按群合并为多行消息发送；每次发送消耗一个令牌。
+    submit 返回的 Future 在该行所在的消息被 NapCat 接受（断线时为重连后补发成功）时完成
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int, str], Awaitable[dict | Buffered]],
+        merge_window: float,
+        rate: float,
+        burst: int,
+        max_length: int
+    ):
+        self._send = send
+        self._merge_window = merge_window
+        self._bucket = TokenBucket(rate, burst)
+        self._max_length = max_length
+        self._queue: asyncio.Queue[tuple[int, str, PendingLine]] = asyncio.Queue()
+        # 已合并、等待发送的消息及其包含的行
+        self._chunks: deque[tuple[int, str, list[PendingLine]]] = deque()
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, group_id: int, text: str) -> asyncio.Future:
+        """提交一条待发送的消息，返回发送结果 Future"""
+        OUTBOX_SUBMITTED.inc()
+        line = PendingLine(asyncio.get_running_loop().create_future())
+        self._queue.put_nowait((group_id, text, line))
+        return line.future
+
+    def pending(self) -> int:
+        """等待发送的消息数"""
+        return self._queue.qsize() + len(self._chunks)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止发件箱，不限速地发出剩余的消息"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._merge(self._drain())
+        await self._send_chunks(rate_limited=False)
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if self._merge_window > 0:
+                await asyncio.sleep(self._merge_window)
+            self._merge([first] + self._drain())
+            await self._send_chunks()
+
+    def _drain(self) -> list[tuple[int, str, PendingLine]]:
+        items = []
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    def _merge(self, items: list[tuple[int, str, PendingLine]]):
+        """按群合并为若干条多行消息"""
+        by_group: dict[int, list[tuple[str, PendingLine]]] = {}
+        for group_id, text, line in items:
+            by_group.setdefault(group_id, []).append((text, line))
+
+        for group_id, entries in by_group.items():
+            pending = [line for _, line in entries]
+            for chunk, first, last in split_message_spans([text for text, _ in entries], self._max_length):
+                owners = pending[first:last + 1]
+                for line in owners:
+                    line.remaining += 1
+                self._chunks.append((group_id, chunk, owners))
+            for line in pending:
+                # 空行不产生消息
+                if line.remaining == 0:
+                    line.resolve()
+
+    async def _send_chunks(self, rate_limited: bool = True):
+        """依次发送已合并的消息，发送完成后才出队，停止时不会丢失"""
+        while self._chunks:
+            if rate_limited:
+                await self._bucket.acquire()
+            group_id, chunk, owners = self._chunks[0]
+            try:
+                result = await self._send(group_id, chunk)
+                line_count = chunk.count("\n") + 1
+                if isinstance(result, Buffered):
+                    # NapCat 断线中，重连后由客户端补发，补发有结果时再完成
+                    OUTBOX_SENT.inc("buffered")
+                    logger.info(f"Buffered for QQ group {group_id} until NapCat reconnects: {line_count} line(s)")
+                    result.replayed.add_done_callback(partial(_settle_replayed, owners))
+                else:
+                    OUTBOX_SENT.inc("ok")
+                    logger.info(f"Sent to QQ group {group_id}: {line_count} line(s), {len(chunk)} chars")
+                    _settle(owners, None)
+            except Exception as e:
+                OUTBOX_SENT.inc("error")
+                logger.error(f"Failed to send to QQ: {e}")
+                _settle(owners, e)
+            self._chunks.popleft()
+
+
+def _settle(owners: list[PendingLine], error: Optional[BaseException]):
+    for line in owners:
+        line.settle(error)
+
+
+def _settle_replayed(owners: list[PendingLine], replayed: asyncio.Future):
+    if replayed.cancelled():
+        _settle(owners, ConnectionError("NapCat replay was cancelled"))
+    else:
+        _settle(owners, replayed.exception())
+
+
+class OutboxRelay:
+    """发件箱入口
+
+    单 worker 时直接提交到本进程的发件箱；多 worker 部署时写入共享状态中的流，
+    由 leader 读出后提交到它的发件箱，所有 worker 的消息经同一个发件箱合并限速
+    """
+
+    def __init__(self, state: MemoryState, outbox: QqOutbox, poll_interval: float):
+        self._state = state
+        self._outbox = outbox
+        self._poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, group_id: int, text: str) -> Optional[asyncio.Future]:
+        """提交一条待发送的消息
+
+        单 worker 时返回发送结果 Future；多 worker 时写入共享流即返回 None，发送由 leader 进行
+        """
+        if not self._state.shared:
+            return self._outbox.submit(group_id, text)
+        await self._state.append(RELAY_STREAM, dumps([group_id, text]), RELAY_STREAM_MAX)
+        return None
+
+    def start(self):
+        """成为 leader 后开始转交其他 worker 提交的消息"""
+        if self._state.shared and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                records = await self._state.claim(RELAY_STREAM, RELAY_CONSUMER, RELAY_BATCH)
+            except Exception as e:
+                logger.warning(f"Failed to read relayed QQ messages: {e}")
+                records = []
+            for _, payload in records:
+                group_id, text = loads(payload)
+                self._outbox.submit(group_id, text)
+            if len(records) < RELAY_BATCH:
+                await asyncio.sleep(self._poll_interval)
+
+
+# 全局发件箱实例
+qq_outbox = QqOutbox(
+    napcat_client.send_group_message,
+    merge_window=settings.outbox_merge_window_ms / 1000,
+    rate=settings.outbox_rate_per_second,
+    burst=settings.outbox_burst,
+    max_length=settings.outbox_max_length
+)
+OUTBOX_PENDING.set_function(qq_outbox.pending)
+outbox_relay = OutboxRelay(shared_state, qq_outbox, poll_interval=settings.state_poll_interval_ms / 1000)
@@ -1,37 +1,169 @@
-"""玩家缓存 - 用于存储当前在线玩家信息"""
+"""玩家缓存 - 用于存储当前在线玩家信息
+
+MC mod 在玩家列表变化时发送完整列表或加入/离开增量，未变化时只发送列表摘要作为心跳；
+缓存保存在线玩家及其本次会话的开始时间，每次变化递增版本号。
+多 worker 部署时缓存保存在共享状态中
+"""
 import asyncio
-from typing import List, Dict, Optional
+import hashlib
+import secrets
+from typing import Callable, Iterable, List, Dict, Optional
 from datetime import datetime, timedelta
 
+from app.json_codec import dumps, loads
+from app.state import MemoryState
+
 
 # 缓存过期时间（秒）- MC mod 每5秒更新一次，30秒没更新说明服务器可能离线
 CACHE_EXPIRE_SECONDS = 30
 
+# 玩家列表变更：接收当前会话、当前摘要和当前时间，返回新的会话，返回 None 表示拒绝
+SessionsChange = Callable[[Dict[str, datetime], str, datetime], Optional[Dict[str, datetime]]]
+
+
+def players_hash(players: Iterable[str]) -> str:
+    """玩家列表摘要：按名称排序后以换行连接的 SHA-1，与 mod 的计算方式一致"""
+    return hashlib.sha1("\n".join(sorted(players)).encode("utf-8")).hexdigest()
+
 
 class PlayerCache:
-    """玩家信息缓存"""
-    
-    def __init__(self):
-        self._players: List[str] = []
+    """玩家信息缓存
+
+    指定 state 时数据保存在共享状态的 key 中，多个 worker 读写同一份玩家列表；
+    读取方法返回本进程最近一次写入或 refresh 得到的副本
+    """
+
+    def __init__(self, state: Optional[MemoryState] = None, key: str = "players"):
+        # 在线玩家 -> 本次会话开始时间，按加入顺序排列
+        self._sessions: Dict[str, datetime] = {}
+        self._hash = players_hash(())
         self._max_players: int = 20
-        self._online_count: int = 0
         self._last_update: Optional[datetime] = None  # 初始为None表示从未收到数据
+        self._version = 0  # 玩家列表或人数上限变化时递增
+        # 进程标识，重启后版本号从头开始，ETag 需要区分
+        self._instance = secrets.token_hex(4)
         self._lock = asyncio.Lock()
-    
+        self._state = state
+        self._key = key
+
+    @property
+    def version(self) -> int:
+        """数据版本，用于判断缓存的回复是否仍然有效"""
+        return self._version
+
+    @property
+    def hash(self) -> str:
+        return self._hash
+
+    def etag(self) -> str:
+        """GET /api/players 的 ETag，数据版本或过期状态变化时改变"""
+        return f'W/"{self._instance}-{self._version}-{int(self.is_stale())}"'
+
     async def update(self, players: List[str], max_players: int = 20):
-        """更新玩家列表"""
-        async with self._lock:
-            self._players = players
-            self._online_count = len(players)
-            self._max_players = max_players
-            self._last_update = datetime.now()
-    
+        """以完整列表更新，仍在线的玩家保留会话开始时间"""
+        await self._mutate(
+            lambda sessions, current_hash, now: {name: sessions.get(name, now) for name in players},
+            max_players
+        )
+
+    async def apply_delta(
+        self,
+        joined: List[str],
+        left: List[str],
+        max_players: int,
+        expected_hash: Optional[str] = None
+    ) -> bool:
+        """应用加入/离开增量
+
+        expected_hash 与应用后的列表摘要不一致时不做修改并返回 False，需要 mod 重新发送完整列表
+        """
+        def change(sessions: Dict[str, datetime], current_hash: str, now: datetime) -> Optional[Dict[str, datetime]]:
+            sessions = dict(sessions)
+            for name in left:
+                sessions.pop(name, None)
+            for name in joined:
+                sessions.setdefault(name, now)
+            if expected_hash is not None and players_hash(sessions) != expected_hash:
+                return None
+            return sessions
+        return await self._mutate(change, max_players)
+
+    async def heartbeat(self, max_players: int, expected_hash: Optional[str] = None) -> bool:
+        """列表未变化时的心跳，摘要不一致（如后端重启过）时返回 False"""
+        def change(sessions: Dict[str, datetime], current_hash: str, now: datetime) -> Optional[Dict[str, datetime]]:
+            if expected_hash is not None and expected_hash != current_hash:
+                return None
+            return sessions
+        return await self._mutate(change, max_players)
+
+    async def refresh(self):
+        """共享状态模式下从共享状态重新加载（其他 worker 可能已更新）"""
+        if self._state is not None:
+            raw = await self._state.get(self._key)
+            if raw is not None:
+                self._load(loads(raw))
+
+    async def _mutate(self, change: SessionsChange, max_players: int) -> bool:
+        """应用变更，change 返回 None 表示拒绝；共享状态模式下在共享状态中原子地读-改-写"""
+        if self._state is None:
+            async with self._lock:
+                now = datetime.now()
+                sessions = change(self._sessions, self._hash, now)
+                if sessions is None:
+                    return False
+                self._commit(sessions, max_players, now)
+                return True
+
+        def updater(raw: Optional[bytes]) -> tuple[Optional[bytes], tuple[Optional[dict], bool]]:
+            current = PlayerCache()
+            record = loads(raw) if raw is not None else None
+            if record is not None:
+                current._load(record)
+            now = datetime.now()
+            sessions = change(current._sessions, current._hash, now)
+            if sessions is None:
+                return None, (record, False)
+            current._commit(sessions, max_players, now)
+            record = current._dump()
+            return dumps(record), (record, True)
+
+        record, accepted = await self._state.update(self._key, updater)
+        if record is not None:
+            self._load(record)
+        return accepted
+
+    def _commit(self, sessions: Dict[str, datetime], max_players: int, now: datetime):
+        if sessions.keys() != self._sessions.keys() or max_players != self._max_players:
+            self._version += 1
+            self._hash = players_hash(sessions)
+        self._sessions = sessions
+        self._max_players = max_players
+        self._last_update = now
+
+    def _dump(self) -> dict:
+        return {
+            "instance": self._instance,
+            "version": self._version,
+            "hash": self._hash,
+            "max_players": self._max_players,
+            "last_update": self._last_update.isoformat() if self._last_update else None,
+            "sessions": {name: joined.isoformat() for name, joined in self._sessions.items()}
+        }
+
+    def _load(self, record: dict):
+        self._instance = record["instance"]
+        self._version = record["version"]
+        self._hash = record["hash"]
+        self._max_players = record["max_players"]
+        self._last_update = datetime.fromisoformat(record["last_update"]) if record["last_update"] else None
+        self._sessions = {name: datetime.fromisoformat(joined) for name, joined in record["sessions"].items()}
+
     def is_stale(self) -> bool:
         """检查缓存是否过期（服务器可能已离线）"""
         if self._last_update is None:
             return True  # 从未收到过数据
         return datetime.now() - self._last_update > timedelta(seconds=CACHE_EXPIRE_SECONDS)
-    
+
     def get_players(self) -> Dict:
         """获取玩家信息"""
         # 如果缓存过期，返回空列表表示服务器可能离线
@@ -40,19 +172,19 @@ class PlayerCache:
                 "players": [],
                 "online_count": 0,
                 "max_players": self._max_players,
+                "sessions": {},
+                "version": self._version,
                 "last_update": self._last_update.isoformat() if self._last_update else None,
                 "stale": True  # 标记数据已过期
             }
-        
+
         return {
-            "players": self._players,
-            "online_count": self._online_count,
+            "players": list(self._sessions),
+            "online_count": len(self._sessions),
             "max_players": self._max_players,
+            # 玩家 -> 本次会话开始时间
+            "sessions": {name: joined.isoformat() for name, joined in self._sessions.items()},
+            "version": self._version,
             "last_update": self._last_update.isoformat(),
             "stale": False
         }
-
-
-# 全局实例
-player_cache = PlayerCache()
-
@@ -1,32 +1,71 @@
+import asyncio
 import logging
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Response, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
 from typing import Optional
 
 from app.config import settings
-from app.models import McMessage, MessageQueue, SendResponse, HealthCheck, QqMessage, PlayerListUpdate
-from app.message_queue import message_queue
-from app.message_handler import message_handler
+from app.json_codec import FastJSONResponse, dumps_text, loads
+from app.models import (
+    McMessage, McMessageBatch, MessageQueue, SendResponse, BatchResponse, HealthCheck, QqMessage,
+    PlayerListUpdate, AckRequest, DeliveryAccepted, DeliveryStatus
+)
+from app.channels import Channel, channel_router
+from app.message_queue import encode_entries, DEFAULT_CONSUMER
+from app.message_handler import message_handler, media_workers
+from app.delivery import delivery_service
 from app.napcat_client import napcat_client
+from app.outbox import qq_outbox
+from app.vision_cache import vision_cache
+from app.media_budget import media_budget
+from app.vision_service import vision_service
+from app.player_cache import PlayerCache
+from app.server_stats import server_stats
+from app.leader import leader
+from app.state import WORKER_ID
+from app.metrics import Gauge, render_metrics
 
 logger = logging.getLogger(__name__)
 
+WS_CONNECTIONS = Gauge("mcqq_ws_connections", "MC mods connected over WebSocket")
+
 router = APIRouter(prefix="/api")
 
 
-async def verify_token(authorization: Optional[str] = Header(None)):
-    """验证 API Token"""
+def _bearer_token(authorization: Optional[str]) -> str:
+    """从 Authorization 头中取出令牌"""
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing authorization header")
     
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization format")
     
-    token = authorization[7:]
-    if token != settings.api_token:
+    return authorization[7:]
+
+
+async def verify_token(authorization: Optional[str] = Header(None)) -> Channel:
+    """验证 API Token，返回令牌对应的频道"""
+    channel = channel_router.by_token(_bearer_token(authorization))
+    if channel is None:
         raise HTTPException(status_code=403, detail="Invalid token")
     
-    return token
+    return channel
+
+
+async def verify_admin_token(authorization: Optional[str] = Header(None)):
+    """验证管理令牌（API_TOKEN）"""
+    if not channel_router.is_admin(_bearer_token(authorization)):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+async def verify_status_token(authorization: Optional[str] = Header(None)) -> tuple[Optional[Channel], bool]:
+    """验证频道令牌或管理令牌，返回 (令牌对应的频道, 是否为管理令牌)"""
+    token = _bearer_token(authorization)
+    channel, admin = channel_router.by_token(token), channel_router.is_admin(token)
+    if channel is None and not admin:
+        raise HTTPException(status_code=403, detail="Invalid token")
+    return channel, admin
 
 
 @router.get("/health", response_model=HealthCheck)
@@ -39,91 +78,330 @@ async def health_check():
     )
 
 
-@router.get("/messages/poll", response_model=MessageQueue, dependencies=[Depends(verify_token)])
-async def poll_messages():
-    """轮询获取 QQ 消息（供 MC mod 调用）"""
-    messages = await message_queue.poll()
-    return MessageQueue(messages=messages)
+@router.get(
+    "/messages/poll",
+    response_model=MessageQueue,
+    responses={204: {"description": "没有新消息"}}
+)
+async def poll_messages(
+    channel: Channel = Depends(verify_token),
+    wait: float = Query(0, ge=0, le=60, description="长轮询等待秒数，0 表示立即返回"),
+    consumer: str = Query(DEFAULT_CONSUMER, min_length=1, max_length=64, description="消费者 ID，每个 MC 服务器独立"),
+    since: Optional[int] = Query(None, ge=-1, description="已处理到的序号，同时作为确认；-1 表示尚无序号")
+):
+    """轮询获取 QQ 消息（供 MC mod 调用）
 
+    指定 wait 时请求会挂起，直到有新消息或超时。
+    指定 since 时返回序号大于 since 的消息并确认 since 及之前的消息，
+    响应丢失时下次使用相同的 since 重新拉取即可；不指定 since 则读取即确认。
+    since=-1 从该消费者的游标开始拉取但不确认，mod 启动后的第一次轮询使用，响应丢失也不会丢消息。
+    since 大于最新序号（后端重启后队列未持久化，或队列目录变更）时不确认，从该消费者的游标重新拉取，
+    mod 以响应中的 last_seq 替换本地的序号
+    没有新消息时返回 204；响应体由入队时编码好的消息直接拼接
+    """
+    queue = channel.queue
+    if since is not None and since >= 0:
+        await queue.ack(consumer, since)
+    entries = await queue.poll(consumer, after=since, timeout=wait)
+    if not entries:
+        return Response(status_code=204)
+    body = b'{"messages":%s,"last_seq":%d}' % (encode_entries(entries), entries[-1].seq)
+    return Response(content=body, media_type="application/json")
 
-@router.post("/messages/send", response_model=SendResponse, dependencies=[Depends(verify_token)])
-async def send_message(msg: McMessage):
-    """发送消息到 QQ 群（供 MC mod 调用）"""
+
+@router.post("/messages/ack")
+async def ack_messages(data: AckRequest, channel: Channel = Depends(verify_token)):
+    """确认消费者已处理到指定序号"""
+    await channel.queue.ack(data.consumer, data.seq)
+    return {"success": True}
+
+
+@router.post("/messages/send", response_model=DeliveryAccepted, status_code=202)
+async def send_message(
+    msg: McMessage,
+    channel: Channel = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None, max_length=128)
+):
+    """发送消息到 QQ 群（供 MC mod 调用）
+
+    校验后交给投递 worker 池并立即返回 202 和投递 ID，不等待发送到 QQ；
+    携带 Idempotency-Key 时相同的键只投递一次，重试的请求返回原来的投递
+    """
     logger.info(f"Received message: type={msg.type}, player={msg.player}, message={msg.message}")
     try:
-        if msg.type == "player_chat":
-            if msg.player and msg.message:
-                await message_handler.send_to_qq(msg.player, msg.message)
-                return SendResponse(success=True, message="Message sent")
-            else:
-                raise HTTPException(status_code=400, detail="Missing player or message")
-
-        elif msg.type == "system":
-            if msg.message:
-                await message_handler.send_system_to_qq(msg.message)
-                return SendResponse(success=True, message="System message sent")
-            else:
-                raise HTTPException(status_code=400, detail="Missing message")
-
-        elif msg.type == "player_join":
-            if msg.player:
-                await message_handler.send_system_to_qq(f"📥 {msg.player} 加入了服务器")
-                return SendResponse(success=True, message="Join event sent")
-            else:
-                raise HTTPException(status_code=400, detail="Missing player")
-
-        elif msg.type == "player_leave":
-            if msg.player:
-                await message_handler.send_system_to_qq(f"📤 {msg.player} 离开了服务器")
-                return SendResponse(success=True, message="Leave event sent")
-            else:
-                raise HTTPException(status_code=400, detail="Missing player")
-
-        elif msg.type == "death":
-            if msg.message:
-                await message_handler.send_system_to_qq(f"💀 {msg.message}")
-                return SendResponse(success=True, message="Death message sent")
-            else:
-                raise HTTPException(status_code=400, detail="Missing message")
-
-        elif msg.type == "achievement":
-            if msg.player and msg.message:
-                await message_handler.send_system_to_qq(f"🏆 {msg.player} 获得了成就: {msg.message}")
-                return SendResponse(success=True, message="Achievement sent")
-            else:
-                raise HTTPException(status_code=400, detail="Missing player or message")
-
-        else:
-            raise HTTPException(status_code=400, detail=f"Unknown message type: {msg.type}")
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error sending message: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        return await _accept_message(msg, channel, idempotency_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Delivery queue is full", headers={"Retry-After": "1"})
+
+
+async def _accept_message(msg: McMessage, channel: Channel, key: Optional[str]) -> DeliveryAccepted:
+    """校验事件并交给投递 worker 池；事件无效时抛出 ValueError，等待投递的事件过多时抛出 asyncio.QueueFull"""
+    message_handler.validate_mc_message(msg)
+    delivery, created = await delivery_service.submit(channel, msg, key)
+    return DeliveryAccepted(
+        success=True,
+        message="Accepted" if created else "Duplicate",
+        delivery_id=delivery.id,
+        status=delivery.status
+    )
+
+
+@router.get("/messages/deliveries/{delivery_id}", response_model=DeliveryStatus)
+async def get_delivery(delivery_id: str, channel: Channel = Depends(verify_token)):
+    """查询 /api/messages/send 提交的事件的投递状态"""
+    delivery = await delivery_service.get(channel, delivery_id)
+    if delivery is None:
+        raise HTTPException(status_code=404, detail="Unknown delivery")
+    return delivery
+
+
+@router.post("/messages/batch", response_model=BatchResponse)
+async def send_batch(
+    batch: McMessageBatch,
+    channel: Channel = Depends(verify_token),
+    idempotency_key: Optional[str] = Header(None, max_length=128)
+):
+    """批量发送消息到 QQ 群（供 MC mod 调用）
+
+    事件按顺序校验并交给投递 worker 池，返回与请求一一对应的结果；单条事件无效不影响其他事件。
+    携带 Idempotency-Key 时第 i 条事件使用 "<键>:<i>" 作为幂等键，重试整批时已受理的事件不会重复投递
+    """
+    try:
+        results = await _handle_batch(batch, channel, idempotency_key)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Delivery queue is full", headers={"Retry-After": "1"})
+    logger.info(f"Received batch: {len(results)} message(s), {sum(not r.success for r in results)} failed")
+    return BatchResponse(success=all(r.success for r in results), results=results)
+
+
+async def _handle_batch(
+    batch: McMessageBatch, channel: Channel, key: Optional[str]
+) -> list[SendResponse]:
+    """逐条受理批量事件；等待投递的事件过多时抛出 asyncio.QueueFull，之前已受理的事件保留在投递队列中"""
+    results = []
+    for index, item in enumerate(batch.messages):
+        try:
+            msg = McMessage.model_validate(item)
+            results.append(await _accept_message(msg, channel, f"{key}:{index}" if key else None))
+        except (ValidationError, ValueError) as e:
+            results.append(SendResponse(success=False, message=str(e)))
+    return results
 
 
 @router.get("/status")
-async def get_status(token: str = Depends(verify_token)):
-    """获取状态信息"""
-    return {
+async def get_status(access: tuple[Optional[Channel], bool] = Depends(verify_status_token)):
+    """获取状态信息
+
+    频道令牌得到本频道的队列信息；管理令牌（API_TOKEN）另外得到 channels，即所有频道的概况。
+    多 worker 部署时 NapCat、发件箱、媒体和服务器采样等信息只在 leader 上有效
+    """
+    channel, admin = access
+    status = {
         "napcat_connected": napcat_client.connected,
-        "queue_size": await message_queue.size(),
-        "group_id": settings.qq_group_id
+        "worker": WORKER_ID,
+        "leader": leader.is_leader,
+        "outbox_pending": qq_outbox.pending(),
+        "vision_cache": vision_cache.stats(),
+        "media_pending": media_workers.pending(),
+        "delivery_pending": delivery_service.pending(),
+        "media_budget": media_budget.stats(),
+        "vision": vision_service.stats(),
+        "server": server_stats.stats(),
     }
+    if channel is not None:
+        status.update({
+            "channel": channel.name,
+            "queue_size": await channel.queue.size(),
+            "queue": await channel.queue.stats(),
+            "groups": channel.groups,
+        })
+    if admin:
+        await asyncio.gather(*(other.players.refresh() for other in channel_router))
+        status["channels"] = {
+            other.name: {
+                "groups": other.groups,
+                "queue_size": await other.queue.size(),
+                "online_count": other.players.get_players()["online_count"]
+            }
+            for other in channel_router
+        }
+    return status
 
 
-@router.get("/players")
-async def get_players(token: str = Depends(verify_token)):
-    """获取在线玩家列表（由MC服务器提供数据）"""
-    from app.player_cache import player_cache
-    return player_cache.get_players()
+@router.get("/metrics", dependencies=[Depends(verify_admin_token)])
+async def get_metrics():
+    """Prometheus 格式的运行指标"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
-@router.post("/players/update", dependencies=[Depends(verify_token)])
-async def update_players(data: PlayerListUpdate):
-    """更新在线玩家列表（MC mod调用）"""
-    from app.player_cache import player_cache
-    await player_cache.update(data.players, data.max_players)
-    return {"success": True}
+@router.get("/players", responses={304: {"description": "玩家列表未变化"}})
+async def get_players(
+    if_none_match: Optional[str] = Header(None),
+    channel: Channel = Depends(verify_token)
+):
+    """获取在线玩家列表（由MC服务器提供数据）
+
+    响应带 ETag，请求携带匹配的 If-None-Match 时返回 304
+    """
+    players = channel.players
+    await players.refresh()
+    etag = players.etag()
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FastJSONResponse(players.get_players(), headers={"ETag": etag})
+
+
+@router.post("/players/update")
+async def update_players(data: PlayerListUpdate, channel: Channel = Depends(verify_token)):
+    """更新在线玩家列表（MC mod调用）
+
+    接受完整列表、加入/离开增量或心跳；摘要与后端不一致时返回 409，mod 应重新发送完整列表
+    """
+    if not await _apply_player_update(channel.players, data):
+        raise HTTPException(status_code=409, detail="Player list out of sync, send the full list")
+    return {"success": True, "version": channel.players.version}
+
+
+async def _apply_player_update(players: PlayerCache, data: PlayerListUpdate) -> bool:
+    """应用玩家列表更新，摘要不一致时返回 False"""
+    if data.players is not None:
+        await players.update(data.players, data.max_players)
+        return True
+    if data.joined or data.left:
+        return await players.apply_delta(data.joined, data.left, data.max_players, data.hash)
+    return await players.heartbeat(data.max_players, data.hash)
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 使用弱比较"""
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+
+
+
+@router.websocket("/ws/mc")
+async def mc_websocket(
+    websocket: WebSocket,
+    token: Optional[str] = Query(None),
+    consumer: str = Query(DEFAULT_CONSUMER, min_length=1, max_length=64),
+    authorization: Optional[str] = Header(None)
+):
+    """MC mod 长连接通道
+
+    下行: {"op": "messages", "messages": [...]} / {"op": "pong"} / {"op": "ack", ...}
+          / {"op": "players", "resync": true}
+    上行: {"op": "message", "id": <幂等键>, "data": McMessage} / {"op": "batch", "id": <幂等键>, "data": McMessageBatch}
+          / {"op": "players", "data": PlayerListUpdate}
+          / {"op": "ack", "seq": ...} / {"op": "ping"}
+
+    推送从该消费者已确认的位置开始，未确认的消息在重连后会重新推送
+    """
+    if authorization and authorization.startswith("Bearer "):
+        token = authorization[7:]
+    channel = channel_router.by_token(token) if token else None
+    if channel is None:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    logger.info(f"MC mod connected via WebSocket (channel {channel.name})")
+    WS_CONNECTIONS.inc()
+
+    heartbeat = settings.ws_heartbeat_interval
+    sender_task = asyncio.create_task(_ws_send_loop(websocket, channel, consumer, heartbeat))
+    try:
+        while True:
+            # 超过 3 个心跳周期没有收到任何帧，视为连接已失效
+            frame = await asyncio.wait_for(_receive_frame(websocket), heartbeat * 3)
+            await _handle_ws_frame(websocket, channel, consumer, frame)
+    except WebSocketDisconnect:
+        logger.info("MC mod WebSocket disconnected")
+    except asyncio.TimeoutError:
+        logger.warning("MC mod WebSocket heartbeat timeout, closing")
+        await websocket.close(code=1001)
+    except Exception as e:
+        logger.error(f"MC mod WebSocket error: {e}")
+    finally:
+        WS_CONNECTIONS.dec()
+        sender_task.cancel()
+
+
+async def _receive_frame(websocket: WebSocket) -> dict:
+    """接收并解析一个 JSON 文本帧"""
+    frame = loads(await websocket.receive_text())
+    if not isinstance(frame, dict):
+        raise ValueError("WebSocket frame must be a JSON object")
+    return frame
+
+
+async def _ws_send_loop(websocket: WebSocket, channel: Channel, consumer: str, heartbeat: int):
+    """将频道队列中的 QQ 消息实时推送给 MC mod"""
+    queue = channel.queue
+    try:
+        sent_seq = await queue.cursor(consumer)
+        while True:
+            entries = await queue.poll(consumer, after=sent_seq, timeout=heartbeat)
+            if entries:
+                sent_seq = entries[-1].seq
+                frame = b'{"op":"messages","messages":%s,"last_seq":%d}' % (encode_entries(entries), sent_seq)
+                await websocket.send_text(frame.decode("utf-8"))
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.warning(f"MC mod WebSocket send failed: {e}")
+
+
+async def _accept_ws_frame(op: str, data: dict, channel: Channel, frame_id) -> dict:
+    """受理 message / batch 帧，返回确认内容，code 为对应 HTTP 接口的状态码
+
+    字符串形式的帧 ID 同时作为幂等键，与 HTTP 接口的 Idempotency-Key 共用，
+    mod 未收到确认时改用 HTTP 以同一个键重发，事件只会投递一次
+    """
+    key = frame_id if isinstance(frame_id, str) and 0 < len(frame_id) <= 128 else None
+    try:
+        if op == "message":
+            accepted = await _accept_message(McMessage.model_validate(data), channel, key)
+            return {"code": 202, **accepted.model_dump(mode="json")}
+        results = await _handle_batch(McMessageBatch.model_validate(data), channel, key)
+        return {
+            "code": 200,
+            "success": all(r.success for r in results),
+            "results": [r.model_dump(mode="json") for r in results]
+        }
+    except (ValidationError, ValueError) as e:
+        return {"code": 400, "success": False, "message": str(e)}
+    except asyncio.QueueFull:
+        return {"code": 503, "success": False, "message": "Delivery queue is full"}
+
+
+async def _handle_ws_frame(websocket: WebSocket, channel: Channel, consumer: str, frame: dict):
+    """处理 MC mod 上行帧"""
+    op = frame.get("op")
+
+    if op == "ping":
+        await websocket.send_text(dumps_text({"op": "pong"}))
+
+    elif op == "ack":
+        seq = frame.get("seq")
+        if isinstance(seq, int):
+            await channel.queue.ack(consumer, seq)
+
+    elif op in ("message", "batch"):
+        frame_id = frame.get("id")
+        ack = await _accept_ws_frame(op, frame.get("data") or {}, channel, frame_id)
+        await websocket.send_text(dumps_text({"op": "ack", "id": frame_id, **ack}))
+
+    elif op == "players":
+        try:
+            data = PlayerListUpdate.model_validate(frame.get("data") or {})
+            if not await _apply_player_update(channel.players, data):
+                # 摘要不一致，要求 mod 重新发送完整列表
+                await websocket.send_text(dumps_text({"op": "players", "resync": True}))
+        except ValidationError as e:
+            logger.warning(f"Invalid player list frame: {e}")
 
+    else:
+        logger.debug(f"Unknown WebSocket frame op: {op}")
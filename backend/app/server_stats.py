@@ -0,0 +1,320 @@
+"""MC 服务器进程监控 - 后台定时读取 /proc 采样 CPU、内存与线程数
+
+找到 MC 服务端 JVM 后缓存其 PID，之后每次采样只读取
+/proc/<pid>/stat、/proc/<pid>/status 和 /proc/stat 三个文件，不再创建子进程；
+历史数据保存在定长环形缓冲区中，用于计算 1/5/15 分钟的平均值
+"""
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+from array import array
+from typing import Optional
+
+from app.config import settings
+from app.metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+PROC = "/proc"
+# MC 服务端进程的命令行特征（兼容 Forge/Fabric/Paper 等各种服务端）
+SERVER_CMDLINE_PATTERN = re.compile(rb"java.*(minecraftforge|user_jvm_args|fabric-server|paper|spigot)")
+# 趋势统计的时间窗口（秒）
+TREND_WINDOWS = (60, 300, 900)
+# /proc/net/tcp 中 LISTEN 状态的编码
+TCP_LISTEN = "0A"
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+SERVER_CPU = Gauge("mcqq_server_cpu_percent", "Minecraft server CPU usage as a share of all cores")
+SERVER_RSS = Gauge("mcqq_server_rss_bytes", "Minecraft server resident memory")
+SERVER_THREADS = Gauge("mcqq_server_threads", "Minecraft server thread count")
+
+
+class StatsRing:
+    """定长环形缓冲区，按列保存采样时间、CPU、RSS 与线程数"""
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._times = array("d", [0.0]) * capacity
+        self._cpu = array("d", [0.0]) * capacity
+        self._rss = array("d", [0.0]) * capacity
+        self._threads = array("d", [0.0]) * capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: float, cpu: float, rss: float, threads: float):
+        i = self._next
+        self._times[i] = timestamp
+        self._cpu[i] = cpu
+        self._rss[i] = rss
+        self._threads[i] = threads
+        self._next = (i + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def latest(self) -> Optional[tuple[float, float, float, float]]:
+        """最近一次采样 (时间, CPU, RSS, 线程数)"""
+        if not self._count:
+            return None
+        i = self._next - 1
+        return self._times[i], self._cpu[i], self._rss[i], self._threads[i]
+
+    def average(self, seconds: float, now: float) -> Optional[tuple[float, float, float]]:
+        """最近 seconds 秒内的平均 (CPU, RSS, 线程数)，从最新的采样向前累加"""
+        since = now - seconds
+        cpu = rss = threads = 0.0
+        n = 0
+        i = self._next
+        for _ in range(self._count):
+            i = (i - 1) % self._capacity
+            if self._times[i] < since:
+                break
+            cpu += self._cpu[i]
+            rss += self._rss[i]
+            threads += self._threads[i]
+            n += 1
+        if not n:
+            return None
+        return cpu / n, rss / n, threads / n
+
+
+class ServerStatsSampler:
+    """MC 服务器进程采样器
+
+    采样在线程中执行，只有采样任务访问 PID 与上一次的 CPU 计数；
+    进程退出或 PID 被复用（启动时间变化）时清空历史并重新查找
+    """
+
+    def __init__(self, interval: float, port: int):
+        self._interval = interval
+        self._port = port
+        self._ring = StatsRing(math.ceil(max(TREND_WINDOWS) / interval) + 1)
+        self._task: Optional[asyncio.Task] = None
+        self._pid: Optional[int] = None
+        self._start_ticks = 0
+        self._last_ticks: Optional[tuple[int, int]] = None  # (进程 CPU 时钟数, 系统总时钟数)
+        self._boot_time: Optional[float] = None
+        self._version = 0  # 每次采样结果变化时递增
+        self._available = os.path.isdir(os.path.join(PROC, "self"))
+
+    @property
+    def available(self) -> bool:
+        """系统是否提供 /proc"""
+        return self._available
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._pid
+
+    @property
+    def version(self) -> int:
+        """采样版本，用于判断缓存的回复是否仍然有效"""
+        return self._version
+
+    def start(self):
+        if not self._available:
+            logger.warning("/proc is not available, server stats are disabled")
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                pid = self._pid
+                sample = await asyncio.to_thread(self._collect)
+                if sample is None:
+                    self._ring.clear()
+                elif sample[1] is not None:
+                    self._ring.append(sample[0], *sample[1:])
+                    self._version += 1
+                if self._pid != pid:
+                    self._version += 1
+            except Exception as e:
+                logger.warning(f"Server stats sampling failed: {e}")
+            await asyncio.sleep(self._interval)
+
+    def _collect(self) -> Optional[tuple]:
+        """采样一次，返回 (时间, CPU%, RSS 字节, 线程数)；进程不存在返回 None
+
+        首次采样还没有 CPU 时钟差值，CPU 为 None
+        """
+        try:
+            if self._pid is None:
+                pid = self._find_pid()
+                if pid is None:
+                    return None
+                self._attach(pid)
+            proc_ticks, start_ticks = _read_pid_stat(self._pid)
+            rss, threads = _read_pid_status(self._pid)
+        except (FileNotFoundError, ProcessLookupError):
+            start_ticks = None
+        if start_ticks != self._start_ticks:
+            if self._pid is not None:
+                logger.info(f"Minecraft server process {self._pid} exited")
+                self._pid = None
+            return None
+
+        total_ticks = _read_total_ticks()
+        cpu = None
+        if self._last_ticks is not None:
+            elapsed = total_ticks - self._last_ticks[1]
+            if elapsed > 0:
+                cpu = (proc_ticks - self._last_ticks[0]) * 100.0 / elapsed
+        self._last_ticks = (proc_ticks, total_ticks)
+        return time.time(), cpu, rss, threads
+
+    def _attach(self, pid: int):
+        _, self._start_ticks = _read_pid_stat(pid)
+        self._pid = pid
+        self._last_ticks = None
+        logger.info(f"Monitoring Minecraft server process {pid}")
+
+    def _find_pid(self) -> Optional[int]:
+        """按命令行特征查找 MC 服务端进程，找不到时查找监听服务器端口的进程"""
+        for pid in _list_pids():
+            try:
+                with open(os.path.join(PROC, str(pid), "cmdline"), "rb") as f:
+                    cmdline = f.read().replace(b"\0", b" ")
+            except OSError:
+                continue
+            if SERVER_CMDLINE_PATTERN.search(cmdline):
+                return pid
+        return _find_listener(self._port)
+
+    def uptime(self) -> Optional[float]:
+        """服务器进程已运行的秒数"""
+        if self._pid is None:
+            return None
+        if self._boot_time is None:
+            self._boot_time = _read_boot_time()
+        return time.time() - (self._boot_time + self._start_ticks / CLOCK_TICKS)
+
+    def snapshot(self) -> Optional[dict]:
+        """最近一次采样和各时间窗口的平均值，进程未运行时返回 None
+
+        刚找到进程、还没有完整的采样时各项数值为 None
+        """
+        pid = self._pid
+        if pid is None:
+            return None
+        latest = self._ring.latest()
+        timestamp, cpu, rss, threads = latest if latest is not None else (None,) * 4
+        now = time.time()
+        return {
+            "pid": pid,
+            "cpu_percent": cpu,
+            "rss_bytes": rss,
+            "threads": int(threads) if threads is not None else None,
+            "uptime_seconds": self.uptime(),
+            "sampled_at": timestamp,
+            "trends": {
+                f"{seconds // 60}m": _trend(self._ring.average(seconds, now))
+                for seconds in TREND_WINDOWS
+            },
+        }
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot()
+        return {"running": snapshot is not None, **(snapshot or {})}
+
+    def latest_value(self, index: int) -> float:
+        """最近一次采样中的某一列，进程未运行时为 0"""
+        latest = self._ring.latest() if self._pid is not None else None
+        return latest[index] if latest is not None else 0.0
+
+
+def _trend(average: Optional[tuple[float, float, float]]) -> Optional[dict]:
+    if average is None:
+        return None
+    cpu, rss, threads = average
+    return {"cpu_percent": cpu, "rss_bytes": rss, "threads": threads}
+
+
+def _list_pids() -> list[int]:
+    return [int(name) for name in os.listdir(PROC) if name.isdigit()]
+
+
+def _read_pid_stat(pid: int) -> tuple[int, int]:
+    """读取 /proc/<pid>/stat，返回 (utime + stime, 进程启动时间)，单位为时钟数"""
+    with open(os.path.join(PROC, str(pid), "stat"), "rb") as f:
+        data = f.read()
+    # 进程名可能包含空格和括号，从最后一个右括号之后开始按空格拆分
+    fields = data[data.rindex(b")") + 2:].split()
+    return int(fields[11]) + int(fields[12]), int(fields[19])
+
+
+def _read_pid_status(pid: int) -> tuple[float, float]:
+    """读取 /proc/<pid>/status，返回 (RSS 字节, 线程数)"""
+    rss = threads = 0.0
+    with open(os.path.join(PROC, str(pid), "status"), "rb") as f:
+        for line in f:
+            if line.startswith(b"VmRSS:"):
+                rss = int(line.split()[1]) * 1024.0
+            elif line.startswith(b"Threads:"):
+                threads = float(line.split()[1])
+    return rss, threads
+
+
+def _read_total_ticks() -> int:
+    """读取 /proc/stat 中所有 CPU 的总时钟数（guest 时间已计入 user，不重复累加）"""
+    with open(os.path.join(PROC, "stat"), "rb") as f:
+        fields = f.readline().split()
+    return sum(int(value) for value in fields[1:9])
+
+
+def _read_boot_time() -> float:
+    with open(os.path.join(PROC, "stat"), "rb") as f:
+        for line in f:
+            if line.startswith(b"btime "):
+                return float(line.split()[1])
+    return time.time() - time.monotonic()
+
+
+def _find_listener(port: int) -> Optional[int]:
+    """查找监听指定 TCP 端口的进程"""
+    inodes = set()
+    for name in ("tcp", "tcp6"):
+        try:
+            with open(os.path.join(PROC, "net", name)) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    local_port = int(fields[1].rsplit(":", 1)[1], 16)
+                    if local_port == port and fields[3] == TCP_LISTEN:
+                        inodes.add(f"socket:[{fields[9]}]")
+        except OSError:
+            continue
+    if not inodes:
+        return None
+
+    for pid in _list_pids():
+        fd_dir = os.path.join(PROC, str(pid), "fd")
+        try:
+            for fd in os.listdir(fd_dir):
+                if os.readlink(os.path.join(fd_dir, fd)) in inodes:
+                    return pid
+        except OSError:
+            continue
+    return None
+
+
+# 全局采样器实例
+server_stats = ServerStatsSampler(settings.server_stats_interval, settings.mc_server_port)
+SERVER_CPU.set_function(lambda: server_stats.latest_value(1))
+SERVER_RSS.set_function(lambda: server_stats.latest_value(2))
+SERVER_THREADS.set_function(lambda: server_stats.latest_value(3))
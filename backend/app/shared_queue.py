@@ -0,0 +1,132 @@
+"""共享消息队列 - 多 worker 部署时保存在共享状态中的消息队列
+
+接口与 MessageQueueManager 相同，MC mod 的轮询可以落在任意 worker 上
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from app.json_codec import dumps, loads
+from app.message_queue import (
+    DEFAULT_CONSUMER, OVERFLOW_DROP_OLDEST, QUEUE_DELIVERED, QUEUE_POLLS, QUEUE_PUSHED, QueueEntry
+)
+from app.models import QqMessage
+from app.state import MemoryState, StreamInfo
+
+logger = logging.getLogger(__name__)
+
+
+class SharedMessageQueue:
+    """共享消息队列
+
+    消息保存在共享状态的流中，超过 max_size 时丢弃最旧的消息
+    （其他溢出策略依赖进程内的发送者和优先级索引，共享队列不支持）。
+    其他 worker 入队的消息无法唤醒本进程的长轮询，等待期间每隔 poll_interval 检查一次；
+    last_seq、pending_by_consumer 等同步属性是最近一次访问共享状态时的快照
+    """
+
+    def __init__(self, state: MemoryState, stream: str, max_size: int = 1000, poll_interval: float = 0.1):
+        self._state = state
+        self._stream = stream
+        self._max_size = max_size
+        self._poll_interval = poll_interval
+        self._info = StreamInfo(1, 0, {})
+        # 本进程入队时唤醒本进程的长轮询，每次入队后替换
+        self._pushed = asyncio.Event()
+
+    @property
+    def policy(self) -> str:
+        return OVERFLOW_DROP_OLDEST
+
+    async def start(self):
+        await self._refresh()
+
+    async def close(self):
+        pass
+
+    @property
+    def last_seq(self) -> int:
+        return self._info.last_seq
+
+    @property
+    def first_seq(self) -> int:
+        return self._info.first_seq
+
+    async def push(self, message: QqMessage) -> Optional[int]:
+        """添加消息到队列，返回分配的序号"""
+        seq = await self._state.append(self._stream, dumps(message.model_dump(exclude_none=True)), self._max_size)
+        self._info = self._info._replace(last_seq=seq)
+        self._pushed.set()
+        self._pushed = asyncio.Event()
+        QUEUE_PUSHED.inc()
+        logger.debug(f"Message queued #{seq}: {message.content[:50]}")
+        return seq
+
+    async def poll(
+        self,
+        consumer: str = DEFAULT_CONSUMER,
+        after: Optional[int] = None,
+        max_count: int = 50,
+        timeout: float = 0
+    ) -> list[QueueEntry]:
+        """获取序号大于 after 的消息，语义与 MessageQueueManager.poll 相同"""
+        if after is not None and after < 0:
+            after = await self.cursor(consumer)
+        elif after is not None and after > self.last_seq:
+            # 快照可能落后于其他 worker，确认确实超过最新序号后再从游标重新开始
+            await self._refresh()
+            if after > self.last_seq:
+                after = await self.cursor(consumer)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            pushed = self._pushed
+            if after is None:
+                records = await self._state.claim(self._stream, consumer, max_count)
+            else:
+                records = await self._state.read(self._stream, after, max_count)
+            remaining = deadline - loop.time()
+            if records or remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(pushed.wait(), min(self._poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+        messages = [QueueEntry.from_record(seq, loads(payload)) for seq, payload in records]
+        QUEUE_POLLS.inc("messages" if messages else "empty")
+        QUEUE_DELIVERED.inc(amount=len(messages))
+        return messages
+
+    async def ack(self, consumer: str, seq: int):
+        """确认消费者已处理到 seq（含）；超过最新序号的确认被忽略"""
+        await self._state.advance(self._stream, consumer, seq)
+
+    async def cursor(self, consumer: str = DEFAULT_CONSUMER) -> int:
+        return await self._state.cursor(self._stream, consumer)
+
+    async def size(self, consumer: str = DEFAULT_CONSUMER) -> int:
+        """获取消费者尚未确认的消息数量"""
+        cursor = await self.cursor(consumer)
+        await self._refresh()
+        return self._pending(cursor)
+
+    async def stats(self) -> dict:
+        await self._refresh()
+        return {
+            "first_seq": self.first_seq,
+            "last_seq": self.last_seq,
+            "in_memory": self.last_seq - self.first_seq + 1,
+            "overflow_policy": self.policy,
+            "consumers": self.pending_by_consumer()
+        }
+
+    def pending_by_consumer(self) -> dict[str, int]:
+        return {name: self._pending(cursor) for name, cursor in self._info.cursors.items()}
+
+    def _pending(self, cursor: int) -> int:
+        # 流中的序号连续
+        return self.last_seq - max(cursor, self.first_seq - 1)
+
+    async def _refresh(self):
+        self._info = await self._state.info(self._stream)
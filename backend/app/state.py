@@ -0,0 +1,374 @@
+"""共享状态 - 多个 uvicorn worker 之间共享队列、玩家缓存和锁
+
+提供三类原语：
+- 流：按序号追加的消息流，每个消费者一个游标（消息队列、跨 worker 的发件箱）
+- 键值：原子的读-改-写，可设置过期时间（玩家缓存、投递记录）
+- 租约：带过期时间的命名锁（管理命令锁、NapCat 连接的 leader 选举）
+
+MemoryState 保存在进程内，只适用于单 worker；SqliteState 保存在 SQLite 数据库中，
+同一台机器上的多个 worker 进程通过 WAL 模式共享
+"""
+import asyncio
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from itertools import islice
+from pathlib import Path
+from typing import AsyncIterator, Callable, NamedTuple, Optional, TypeVar
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+STATE_MEMORY = "memory"
+STATE_SQLITE = "sqlite"
+STATE_BACKENDS = (STATE_MEMORY, STATE_SQLITE)
+
+# 本 worker 的标识，用作租约持有者
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+
+# 键值更新函数：接收当前值（不存在时为 None），返回 (新值, 结果)，新值为 None 时不写入
+Updater = Callable[[Optional[bytes]], tuple[Optional[bytes], T]]
+
+
+class StreamInfo(NamedTuple):
+    """流的概况：保留的最旧/最新序号和各消费者的游标，流为空时 first_seq = last_seq + 1"""
+    first_seq: int
+    last_seq: int
+    cursors: dict[str, int]
+
+
+class MemoryState:
+    """进程内状态，接口与 SqliteState 相同"""
+
+    shared = False
+
+    def __init__(self):
+        self._streams: dict[str, deque[tuple[int, bytes]]] = {}
+        self._last_seqs: dict[str, int] = {}
+        self._cursors: dict[str, dict[str, int]] = {}
+        self._values: dict[str, bytes] = {}
+        self._expires: dict[str, float] = {}  # 键 -> 过期时间，只记录设置了 ttl 的键
+        self._leases: dict[str, tuple[str, float]] = {}  # 名称 -> (持有者, 过期时间)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def append(self, stream: str, payload: bytes, max_len: int) -> int:
+        """追加一条消息，返回分配的序号；超过 max_len 时丢弃最旧的消息"""
+        entries = self._streams.setdefault(stream, deque())
+        seq = self._last_seqs.get(stream, 0) + 1
+        self._last_seqs[stream] = seq
+        entries.append((seq, payload))
+        while len(entries) > max_len:
+            entries.popleft()
+        return seq
+
+    async def read(self, stream: str, after: int, limit: int) -> list[tuple[int, bytes]]:
+        """读取序号大于 after 的消息"""
+        entries = self._streams.get(stream)
+        if not entries:
+            return []
+        start = max(0, after + 1 - entries[0][0])
+        return list(islice(entries, start, start + limit))
+
+    async def claim(self, stream: str, consumer: str, limit: int) -> list[tuple[int, bytes]]:
+        """读取消费者游标之后的消息并移动游标"""
+        records = await self.read(stream, self._cursor(stream, consumer), limit)
+        if records:
+            self._cursors[stream][consumer] = records[-1][0]
+        return records
+
+    async def cursor(self, stream: str, consumer: str) -> int:
+        """消费者已确认的最大序号，新消费者从最旧的消息开始"""
+        return self._cursor(stream, consumer)
+
+    async def advance(self, stream: str, consumer: str, seq: int):
+        """将游标前移到 seq（不会后退；seq 超过最新序号时来自过期的序号，忽略）"""
+        if self._cursor(stream, consumer) < seq <= self._last_seqs.get(stream, 0):
+            self._cursors[stream][consumer] = seq
+
+    async def info(self, stream: str) -> StreamInfo:
+        last_seq = self._last_seqs.get(stream, 0)
+        entries = self._streams.get(stream)
+        first_seq = entries[0][0] if entries else last_seq + 1
+        return StreamInfo(first_seq, last_seq, dict(self._cursors.get(stream, {})))
+
+    def _cursor(self, stream: str, consumer: str) -> int:
+        cursors = self._cursors.setdefault(stream, {})
+        if consumer not in cursors:
+            entries = self._streams.get(stream)
+            cursors[consumer] = entries[0][0] - 1 if entries else self._last_seqs.get(stream, 0)
+        return cursors[consumer]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._value(key)
+
+    async def update(self, key: str, updater: Updater[T], ttl: Optional[float] = None) -> T:
+        """原子地读-改-写一个键，已过期的键视为不存在；ttl 为写入的新值的有效秒数"""
+        value, result = updater(self._value(key))
+        if value is not None:
+            self._values[key] = value
+            if ttl is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = time.time() + ttl
+        return result
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+        self._expires.pop(key, None)
+
+    def _value(self, key: str) -> Optional[bytes]:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            del self._values[key], self._expires[key]
+        return self._values.get(key)
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """获取或续期租约，被其他持有者占用且未过期时返回 False"""
+        now = time.time()
+        holder = self._leases.get(name)
+        if holder is not None and holder[0] != owner and holder[1] > now:
+            return False
+        self._leases[name] = (owner, now + ttl)
+        return True
+
+    async def release(self, name: str, owner: str):
+        holder = self._leases.get(name)
+        if holder is not None and holder[0] == owner:
+            del self._leases[name]
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = 300) -> AsyncIterator[bool]:
+        """尝试获取命名锁，得到是否获取成功；ttl 防止持有者崩溃后锁无法释放"""
+        owner = f"{WORKER_ID}:{secrets.token_hex(4)}"
+        acquired = await self.acquire(f"lock:{name}", owner, ttl)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await self.release(f"lock:{name}", owner)
+
+
+class SqliteState(MemoryState):
+    """SQLite 共享状态
+
+    每个进程一个连接，在线程中执行；写操作使用 BEGIN IMMEDIATE 事务，
+    多个进程的读-改-写由 SQLite 的写锁串行化
+    """
+
+    shared = True
+
+    def __init__(self, db_path: str):
+        super().__init__()
+        self._db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+    async def start(self):
+        await asyncio.to_thread(self._transaction, lambda conn: None)
+        logger.info(f"Shared state: {self._db_path} (worker {WORKER_ID})")
+
+    async def close(self):
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def append(self, stream: str, payload: bytes, max_len: int) -> int:
+        def append(conn: sqlite3.Connection) -> int:
+            row = conn.execute("SELECT last_seq FROM streams WHERE name = ?", (stream,)).fetchone()
+            seq = (row[0] if row else 0) + 1
+            conn.execute("INSERT OR REPLACE INTO streams (name, last_seq) VALUES (?, ?)", (stream, seq))
+            conn.execute("INSERT INTO stream_entries (stream, seq, payload) VALUES (?, ?, ?)", (stream, seq, payload))
+            conn.execute("DELETE FROM stream_entries WHERE stream = ? AND seq <= ?", (stream, seq - max_len))
+            return seq
+        return await self._run(append)
+
+    async def read(self, stream: str, after: int, limit: int) -> list[tuple[int, bytes]]:
+        return await self._run(lambda conn: self._read(conn, stream, after, limit), write=False)
+
+    async def claim(self, stream: str, consumer: str, limit: int) -> list[tuple[int, bytes]]:
+        # 先用只读事务检查，没有新消息时不占用写锁（长轮询会反复调用）
+        if not await self._run(lambda conn: self._has_unclaimed(conn, stream, consumer), write=False):
+            return []
+
+        def claim(conn: sqlite3.Connection) -> list[tuple[int, bytes]]:
+            records = self._read(conn, stream, self._db_cursor(conn, stream, consumer), limit)
+            if records:
+                self._set_cursor(conn, stream, consumer, records[-1][0])
+            return records
+        return await self._run(claim)
+
+    async def cursor(self, stream: str, consumer: str) -> int:
+        return await self._run(lambda conn: self._db_cursor(conn, stream, consumer))
+
+    async def advance(self, stream: str, consumer: str, seq: int):
+        def advance(conn: sqlite3.Connection):
+            if self._db_cursor(conn, stream, consumer) < seq <= self._last_seq(conn, stream):
+                self._set_cursor(conn, stream, consumer, seq)
+        await self._run(advance)
+
+    async def info(self, stream: str) -> StreamInfo:
+        def info(conn: sqlite3.Connection) -> StreamInfo:
+            last_seq = self._last_seq(conn, stream)
+            first_seq = self._first_seq(conn, stream, last_seq)
+            cursors = dict(conn.execute(
+                "SELECT consumer, seq FROM stream_cursors WHERE stream = ?", (stream,)
+            ).fetchall())
+            return StreamInfo(first_seq, last_seq, cursors)
+        return await self._run(info, write=False)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._run(lambda conn: self._get(conn, key), write=False)
+
+    async def update(self, key: str, updater: Updater[T], ttl: Optional[float] = None) -> T:
+        def update(conn: sqlite3.Connection) -> T:
+            value, result = updater(self._get(conn, key))
+            if value is not None:
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, None if ttl is None else now + ttl)
+                )
+                if ttl is not None:
+                    # 写入会过期的键时顺带清理已过期的键
+                    conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+            return result
+        return await self._run(update)
+
+    async def delete(self, key: str):
+        await self._run(lambda conn: conn.execute("DELETE FROM kv WHERE key = ?", (key,)))
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        def acquire(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                (name, owner, now + ttl)
+            )
+            return True
+        return await self._run(acquire)
+
+    async def release(self, name: str, owner: str):
+        await self._run(lambda conn: conn.execute(
+            "DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)
+        ))
+
+    async def _run(self, fn: Callable[[sqlite3.Connection], T], write: bool = True) -> T:
+        return await asyncio.to_thread(self._transaction, fn, write)
+
+    def _transaction(self, fn: Callable[[sqlite3.Connection], T], write: bool = True) -> T:
+        with self._db_lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                result = fn(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def _db(self) -> sqlite3.Connection:
+        """懒加载数据库连接（每个 worker 进程各自打开）"""
+        if self._conn is None:
+            Path(self._db_path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS streams (name TEXT PRIMARY KEY, last_seq INTEGER NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS stream_entries ("
+                "stream TEXT NOT NULL, seq INTEGER NOT NULL, payload BLOB NOT NULL, "
+                "PRIMARY KEY (stream, seq)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS stream_cursors ("
+                "stream TEXT NOT NULL, consumer TEXT NOT NULL, seq INTEGER NOT NULL, "
+                "PRIMARY KEY (stream, consumer)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL);"
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);"
+            )
+            if "expires_at" not in {row[1] for row in conn.execute("PRAGMA table_info(kv)")}:
+                # 旧版本创建的数据库
+                conn.execute("ALTER TABLE kv ADD COLUMN expires_at REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires_at)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, key: str) -> Optional[bytes]:
+        row = conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _read(conn: sqlite3.Connection, stream: str, after: int, limit: int) -> list[tuple[int, bytes]]:
+        return conn.execute(
+            "SELECT seq, payload FROM stream_entries WHERE stream = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (stream, after, limit)
+        ).fetchall()
+
+    @staticmethod
+    def _last_seq(conn: sqlite3.Connection, stream: str) -> int:
+        row = conn.execute("SELECT last_seq FROM streams WHERE name = ?", (stream,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _first_seq(conn: sqlite3.Connection, stream: str, last_seq: int) -> int:
+        row = conn.execute("SELECT MIN(seq) FROM stream_entries WHERE stream = ?", (stream,)).fetchone()
+        return row[0] if row[0] is not None else last_seq + 1
+
+    def _has_unclaimed(self, conn: sqlite3.Connection, stream: str, consumer: str) -> bool:
+        row = conn.execute(
+            "SELECT seq FROM stream_cursors WHERE stream = ? AND consumer = ?", (stream, consumer)
+        ).fetchone()
+        return row is None or self._last_seq(conn, stream) > row[0]
+
+    def _db_cursor(self, conn: sqlite3.Connection, stream: str, consumer: str) -> int:
+        row = conn.execute(
+            "SELECT seq FROM stream_cursors WHERE stream = ? AND consumer = ?", (stream, consumer)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        # 新消费者从最旧的消息开始（调用方持有写事务）
+        cursor = self._first_seq(conn, stream, self._last_seq(conn, stream)) - 1
+        self._set_cursor(conn, stream, consumer, cursor)
+        return cursor
+
+    @staticmethod
+    def _set_cursor(conn: sqlite3.Connection, stream: str, consumer: str, seq: int):
+        conn.execute(
+            "INSERT OR REPLACE INTO stream_cursors (stream, consumer, seq) VALUES (?, ?, ?)",
+            (stream, consumer, seq)
+        )
+
+
+def create_state() -> MemoryState:
+    """按配置创建状态后端"""
+    backend = settings.state_backend
+    if backend not in STATE_BACKENDS:
+        logger.warning(f"Unknown state backend '{backend}', using {STATE_MEMORY}")
+        backend = STATE_MEMORY
+    if backend == STATE_SQLITE:
+        return SqliteState(settings.state_path)
+    return MemoryState()
+
+
+# 全局状态实例
+shared_state = create_state()
@@ -0,0 +1,136 @@
+"""媒体描述缓存 - 内存 LRU + 磁盘 SQLite 两级缓存，避免重复调用 Vision API"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional
+
+from app.config import settings
+from app.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+VISION_CACHE_LOOKUPS = Counter("mcqq_vision_cache_lookups_total", "Vision cache lookups by outcome", ("result",))
+
+
+class VisionCache:
+    """媒体描述缓存
+
+    键为媒体内容的 SHA-256（如 "image:sha256:<hex>"），
+    QQ 消息段中的 file_unique / file 作为别名（如 "image:file:<id>"），命中别名时可跳过下载
+    """
+
+    def __init__(self, db_path: str, max_entries: int, ttl_seconds: float):
+        self._db_path = db_path
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()  # 键 -> (描述, 过期时间)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        """查询描述，内存未命中时查询磁盘"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            description, expires_at = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return description
+            del self._memory[key]
+
+        if self._db_path:
+            row = await asyncio.to_thread(self._db_get, key)
+            if row is not None:
+                description, expires_at = row
+                self._remember(key, description, expires_at)
+                self.hits_disk += 1
+                return description
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, description: str, aliases: Iterable[str] = ()):
+        """写入描述及其别名"""
+        expires_at = time.time() + self._ttl
+        keys = [key, *aliases]
+        for k in keys:
+            self._remember(k, description, expires_at)
+        if self._db_path:
+            await asyncio.to_thread(self._db_put, keys, description, expires_at)
+
+    def stats(self) -> dict:
+        """命中统计"""
+        total = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "entries": len(self._memory),
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_memory + self.hits_disk) / total, 3) if total else 0.0
+        }
+
+    def _remember(self, key: str, description: str, expires_at: float):
+        self._memory[key] = (description, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_entries:
+            self._memory.popitem(last=False)
+
+    def _db(self) -> sqlite3.Connection:
+        """懒加载数据库连接，打开时清理过期记录"""
+        if self._conn is None:
+            Path(self._db_path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self._db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS descriptions ("
+                "key TEXT PRIMARY KEY, description TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("DELETE FROM descriptions WHERE expires_at <= ?", (time.time(),))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _db_get(self, key: str) -> Optional[tuple[str, float]]:
+        try:
+            with self._db_lock:
+                row = self._db().execute(
+                    "SELECT description, expires_at FROM descriptions WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Vision cache read failed: {e}")
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0], row[1]
+
+    def _db_put(self, keys: list[str], description: str, expires_at: float):
+        try:
+            with self._db_lock:
+                conn = self._db()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO descriptions (key, description, expires_at) VALUES (?, ?, ?)",
+                    [(k, description, expires_at) for k in keys]
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Vision cache write failed: {e}")
+
+
+# 全局缓存实例
+vision_cache = VisionCache(
+    settings.vision_cache_path,
+    max_entries=settings.vision_cache_max_entries,
+    ttl_seconds=settings.vision_cache_ttl_hours * 3600
+)
+VISION_CACHE_LOOKUPS.set_function(lambda: {
+    ("memory_hit",): vision_cache.hits_memory,
+    ("disk_hit",): vision_cache.hits_disk,
+    ("miss",): vision_cache.misses,
+})
@@ -1,13 +1,25 @@
-import base64
 import logging
-import httpx
+from functools import partial
 from typing import Optional
+from urllib.parse import urlsplit
 from openai import AsyncOpenAI
 
+from app.concurrency import SingleFlight, ConcurrencyLimiter
 from app.config import settings
+from app.image_preprocess import image_preprocessor
+from app.keyframes import extract_keyframes, ffmpeg_available
+from app.media_budget import media_budget, MEDIA_MEMORY_FACTOR
+from app.media_fetcher import media_fetcher, encode_data_url, FetchedMedia
+from app.metrics import Counter, Gauge, Histogram
+from app.vision_cache import vision_cache
 
 logger = logging.getLogger(__name__)
 
+VISION_SECONDS = Histogram("mcqq_vision_request_seconds", "Vision API call latency", ("kind",))
+VISION_REQUESTS = Counter("mcqq_vision_requests_total", "Vision API calls by outcome", ("kind", "result"))
+VISION_COALESCED = Counter("mcqq_vision_coalesced_total", "Describe calls served by an in-flight duplicate")
+VISION_QUEUED = Gauge("mcqq_vision_queued", "Vision API calls waiting for a provider slot")
+
 
 class VisionService:
     """OpenAI Vision API 服务 - 支持图片和视频多模态"""
@@ -20,6 +32,10 @@ class VisionService:
         )
         # 视频处理客户端（可能使用不同的模型/API）
         self._video_client: Optional[AsyncOpenAI] = None
+        # 合并进行中的相同请求（按文件标识/链接，以及按内容哈希）
+        self._flights = SingleFlight()
+        # 每个 API 提供方的并发请求上限
+        self._limiter = ConcurrencyLimiter(settings.vision_max_concurrency)
 
     @property
     def video_client(self) -> AsyncOpenAI:
@@ -31,23 +47,93 @@ class VisionService:
             )
         return self._video_client
 
-    async def describe_image(self, image_url: str) -> str:
-        """使用 Vision API 描述图片"""
+    async def describe_image(self, image_url: str, file_id: Optional[str] = None) -> str:
+        """使用 Vision API 描述图片
+
+        file_id 为 QQ 消息段中的文件标识，命中缓存时可跳过下载
+        """
         if not settings.openai_api_key:
             return "[未配置 OpenAI API，无法描述图片]"
 
+        # 同一张图片被同时转发多次时只下载、描述一次
+        key = f"image:file:{file_id}" if file_id else f"image:url:{image_url}"
+        return await self._flights.do(key, partial(self._describe_image, image_url, file_id))
+
+    async def _describe_image(self, image_url: str, file_id: Optional[str]) -> str:
         try:
+            alias = f"image:file:{file_id}" if file_id else None
+            if alias:
+                cached = await vision_cache.get(alias)
+                if cached:
+                    return cached
+
             # 下载图片并转换为 base64
-            image_data = await self._download_media(image_url)
-            if not image_data:
+            media = await self._download_media(image_url)
+            if not media:
                 return "[无法获取图片]"
 
-            base64_image = base64.b64encode(image_data).decode("utf-8")
-            
-            # 检测图片类型
-            mime_type = self._detect_image_mime_type(image_data)
+            content_key = self._content_key("image", media.sha256)
+            cached = await vision_cache.get(content_key)
+            if cached:
+                media.close()
+                if alias:
+                    await vision_cache.put(alias, cached)
+                return cached
+
+            # 不同链接的相同内容正在处理时直接等待其结果
+            if content_key in self._flights:
+                media.close()
+            return await self._flights.do(
+                content_key, partial(self._describe_image_media, media, content_key, alias)
+            )
+
+        except Exception as e:
+            logger.error(f"Vision API error: {e}")
+            return f"[图片描述失败: {str(e)[:30]}]"
+
+    async def _describe_image_media(self, media: FetchedMedia, content_key: str, alias: Optional[str]) -> str:
+        """描述已下载的图片，读取后关闭 media"""
+        try:
+            # 预留内存预算，处理期间同时存在原图、预处理结果和编码后的字符串
+            async with media_budget.reserve(
+                media.size * MEDIA_MEMORY_FACTOR, settings.media_budget_wait_seconds
+            ) as reserved:
+                if not reserved:
+                    media.close()
+                    logger.warning(f"Media memory budget exhausted, skipping image ({media.size} bytes)")
+                    return "[图片描述失败: 媒体处理繁忙]"
+
+                with media:
+                    image_data = media.read()
+
+                # 缩放并重新编码，结果更大时保留原图
+                processed = await image_preprocessor.process(image_data)
+                if processed and len(processed[0]) < len(image_data):
+                    image_data, mime_type = processed
+                else:
+                    # 检测图片类型
+                    mime_type = self._detect_image_mime_type(image_data)
+
+                data_url = encode_data_url(mime_type, image_data, len(image_data))
+                del image_data, processed
+
+                description = await self._request_image_description(data_url)
+
+            logger.info(f"Image description: {description}")
+            await vision_cache.put(content_key, description, [alias] if alias else [])
+            return description
+
+        except Exception as e:
+            logger.error(f"Vision API error: {e}")
+            return f"[图片描述失败: {str(e)[:30]}]"
+        finally:
+            media.close()
 
-            response = await self.image_client.chat.completions.create(
+    async def _request_image_description(self, data_url: str) -> str:
+        """调用 Vision API 描述一张已编码的图片"""
+        async with self._provider_slot(settings.openai_base_url):
+            response = await self._create_completion(
+                self.image_client, "image",
                 model=settings.openai_model,
                 messages=[
                     {
@@ -60,7 +146,7 @@ class VisionService:
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:{mime_type};base64,{base64_image}"
+                                    "url": data_url
                                 }
                             },
                             {
@@ -72,89 +158,195 @@ class VisionService:
                 ],
                 max_tokens=100
             )
+        return response.choices[0].message.content
 
-            description = response.choices[0].message.content
-            logger.info(f"Image description: {description}")
-            return description
-
-        except Exception as e:
-            logger.error(f"Vision API error: {e}")
-            return f"[图片描述失败: {str(e)[:30]}]"
-
-    async def describe_video(self, video_url: str) -> str:
+    async def describe_video(self, video_url: str, file_id: Optional[str] = None) -> str:
         """使用 VL 模型直接描述视频内容"""
         api_key = settings.get_video_api_key()
         if not api_key:
             return "[未配置视频 API，无法描述视频]"
 
+        # 同一视频被同时转发多次时只处理一次
+        key = f"video:file:{file_id}" if file_id else f"video:url:{video_url}"
+        return await self._flights.do(key, partial(self._describe_video, video_url, file_id))
+
+    async def _describe_video(self, video_url: str, file_id: Optional[str]) -> str:
         try:
+            alias = f"video:file:{file_id}" if file_id else None
+            if alias:
+                cached = await vision_cache.get(alias)
+                if cached:
+                    return cached
+
             # 下载视频
-            video_data = await self._download_media(
+            media = await self._download_media(
                 video_url, 
                 max_size_mb=settings.video_max_size_mb
             )
-            if not video_data:
+            if not media:
                 return "[无法获取视频或视频过大]"
 
-            base64_video = base64.b64encode(video_data).decode("utf-8")
-            
-            # 检测视频类型
-            mime_type = self._detect_video_mime_type(video_data)
-            
-            logger.info(f"Processing video: {len(video_data)} bytes, type: {mime_type}")
+            content_key = self._content_key("video", media.sha256)
+            cached = await vision_cache.get(content_key)
+            if cached:
+                media.close()
+                if alias:
+                    await vision_cache.put(alias, cached)
+                return cached
 
-            # 使用支持视频的 VL 模型
-            response = await self.video_client.chat.completions.create(
-                model=settings.get_video_model(),
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一个视频描述助手。请用简洁的中文（不超过80字）描述视频的主要内容，包括场景、动作和关键信息。"
-                    },
-                    {
-                        "role": "user",
-                        "content": [
+            # 不同链接的相同内容正在处理时直接等待其结果
+            if content_key in self._flights:
+                media.close()
+            return await self._flights.do(
+                content_key, partial(self._describe_video_media, media, content_key, alias)
+            )
+
+        except Exception as e:
+            logger.error(f"Video API error: {e}")
+            return f"[视频描述失败: {str(e)[:30]}]"
+
+    async def _describe_video_media(self, media: FetchedMedia, content_key: str, alias: Optional[str]) -> str:
+        """描述已下载的视频，结束后关闭 media"""
+        try:
+            # 关键帧模式：本地提取关键帧后用图片模型描述，不上传视频
+            if settings.video_mode == "keyframes":
+                return await self._describe_video_fallback(media, content_key, alias)
+
+            # 上传视频需要把整个视频编码进请求体，先预留内存预算
+            async with media_budget.reserve(
+                media.size * MEDIA_MEMORY_FACTOR, settings.media_budget_wait_seconds
+            ) as reserved:
+                if not reserved:
+                    logger.warning(f"Media memory budget exhausted, not uploading video ({media.size} bytes)")
+                    if settings.video_mode == "auto" and ffmpeg_available():
+                        return await self._describe_video_fallback(media, content_key, alias)
+                    return "[视频描述失败: 媒体处理繁忙]"
+
+                # 检测视频类型
+                mime_type = self._detect_video_mime_type(media.head(16))
+
+                logger.info(f"Processing video: {media.size} bytes, type: {mime_type}")
+
+                # 使用支持视频的 VL 模型
+                async with self._provider_slot(settings.get_video_base_url()):
+                    response = await self._create_completion(
+                        self.video_client, "video",
+                        model=settings.get_video_model(),
+                        messages=[
                             {
-                                "type": "video_url",
-                                "video_url": {
-                                    "url": f"data:{mime_type};base64,{base64_video}"
-                                }
+                                "role": "system",
+                                "content": "你是一个视频描述助手。请用简洁的中文（不超过80字）描述视频的主要内容，包括场景、动作和关键信息。"
                             },
                             {
-                                "type": "text",
-                                "text": "请简洁描述这个视频的内容。"
+                                "role": "user",
+                                "content": [
+                                    {
+                                        "type": "video_url",
+                                        "video_url": {
+                                            # 从下载暂存区流式编码，原始视频不整体读入内存
+                                            "url": media.data_url(mime_type)
+                                        }
+                                    },
+                                    {
+                                        "type": "text",
+                                        "text": "请简洁描述这个视频的内容。"
+                                    }
+                                ]
                             }
-                        ]
-                    }
-                ],
-                max_tokens=150
-            )
+                        ],
+                        max_tokens=150
+                    )
 
             description = response.choices[0].message.content
             logger.info(f"Video description: {description}")
+            await vision_cache.put(content_key, description, [alias] if alias else [])
             return description
 
         except Exception as e:
             error_msg = str(e)
             logger.error(f"Video API error: {error_msg}")
             
-            # 如果模型不支持视频，尝试降级到图片处理（使用封面）
-            if "video" in error_msg.lower() or "unsupported" in error_msg.lower():
-                logger.info("Video not supported by model, trying fallback...")
-                return await self._describe_video_fallback(video_url)
+            # 如果模型不支持视频，尝试降级到关键帧描述
+            if settings.video_mode == "auto" and (
+                "video" in error_msg.lower() or "unsupported" in error_msg.lower()
+            ):
+                logger.info("Video not supported by model, trying keyframe fallback...")
+                return await self._describe_video_fallback(media, content_key, alias)
             
             return f"[视频描述失败: {error_msg[:30]}]"
+        finally:
+            media.close()
+
+    async def _describe_video_fallback(
+        self,
+        video: FetchedMedia,
+        content_key: Optional[str] = None,
+        alias: Optional[str] = None
+    ) -> str:
+        """视频描述降级方案 - 本地提取关键帧，作为多图请求交给图片模型"""
+        if not settings.openai_api_key or not ffmpeg_available():
+            return "[视频 - 当前模型不支持视频描述]"
+
+        try:
+            frames = await extract_keyframes(
+                video,
+                max_frames=settings.video_keyframes,
+                max_edge=settings.vision_image_max_edge or 1024,
+                scene_threshold=settings.video_keyframe_scene_threshold
+            )
+            if not frames:
+                return "[视频 - 关键帧提取失败]"
 
-    async def _describe_video_fallback(self, video_url: str) -> str:
-        """视频描述降级方案 - 尝试提取关键帧或返回默认"""
-        # 这里可以扩展：提取视频帧作为图片处理
-        # 目前返回简单提示
-        return "[视频 - 当前模型不支持视频描述]"
+            content = [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": encode_data_url("image/jpeg", frame, len(frame))
+                    }
+                }
+                for frame in frames
+            ]
+            content.append({
+                "type": "text",
+                "text": "这些是同一个视频按时间顺序截取的关键帧，请简洁描述这个视频的内容。"
+            })
+
+            async with self._provider_slot(settings.openai_base_url):
+                response = await self._create_completion(
+                    self.image_client, "keyframes",
+                    model=settings.openai_model,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": "你是一个视频描述助手。请用简洁的中文（不超过80字）描述视频的主要内容，包括场景、动作和关键信息。"
+                        },
+                        {
+                            "role": "user",
+                            "content": content
+                        }
+                    ],
+                    max_tokens=150
+                )
+
+            description = response.choices[0].message.content
+            logger.info(f"Video keyframe description: {description}")
+            if content_key:
+                await vision_cache.put(content_key, description, [alias] if alias else [])
+            return description
 
-    async def describe_video_with_cover(self, video_url: str, cover_url: Optional[str] = None) -> str:
+        except Exception as e:
+            logger.error(f"Video keyframe description error: {e}")
+            return f"[视频描述失败: {str(e)[:30]}]"
+
+    async def describe_video_with_cover(
+        self,
+        video_url: str,
+        cover_url: Optional[str] = None,
+        file_id: Optional[str] = None
+    ) -> str:
         """描述视频，优先直接处理视频，如果失败则使用封面"""
         # 首先尝试直接处理视频
-        result = await self.describe_video(video_url)
+        result = await self.describe_video(video_url, file_id)
         
         # 如果视频处理失败且有封面，使用封面
         if "失败" in result or "不支持" in result:
@@ -166,40 +358,43 @@ class VisionService:
         
         return result
 
+    async def _create_completion(self, client: AsyncOpenAI, kind: str, **kwargs):
+        """调用 chat.completions 并记录耗时和结果"""
+        with VISION_SECONDS.time(kind):
+            try:
+                response = await client.chat.completions.create(**kwargs)
+            except Exception:
+                VISION_REQUESTS.inc(kind, "error")
+                raise
+        VISION_REQUESTS.inc(kind, "ok")
+        return response
+
+    def _provider_slot(self, base_url: Optional[str]):
+        """占用提供方（按 API 主机区分）的一个并发名额"""
+        return self._limiter.slot(urlsplit(base_url or "").netloc or "default")
+
+    def stats(self) -> dict:
+        """进行中的请求数与各提供方的并发/排队情况"""
+        return {
+            "in_flight": len(self._flights),
+            "coalesced": self._flights.shared,
+            "queued": self._limiter.waiting(),
+            "providers": self._limiter.stats(),
+        }
+
     async def describe_mface(self, summary: str) -> str:
         """描述表情包（使用 summary）"""
         if summary:
             return summary
         return "[表情包]"
 
-    async def _download_media(self, url: str, max_size_mb: int = 50) -> Optional[bytes]:
-        """下载媒体文件"""
-        try:
-            max_size = max_size_mb * 1024 * 1024  # 转换为字节
-            
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                # 先获取文件大小
-                head_response = await client.head(url, follow_redirects=True)
-                content_length = head_response.headers.get("content-length")
-                
-                if content_length and int(content_length) > max_size:
-                    logger.warning(f"Media too large: {content_length} bytes > {max_size} bytes")
-                    return None
-                
-                # 下载文件
-                response = await client.get(url, follow_redirects=True)
-                if response.status_code == 200:
-                    content = response.content
-                    if len(content) > max_size:
-                        logger.warning(f"Downloaded media too large: {len(content)} bytes")
-                        return None
-                    return content
-                    
-                logger.warning(f"Failed to download media: HTTP {response.status_code}")
-                return None
-        except Exception as e:
-            logger.error(f"Download media error: {e}")
-            return None
+    async def _download_media(self, url: str, max_size_mb: int = 50) -> Optional[FetchedMedia]:
+        """下载媒体文件（共享连接池，流式下载，超限即中止）"""
+        return await media_fetcher.fetch(url, max_size_mb * 1024 * 1024)
+
+    def _content_key(self, kind: str, sha256: str) -> str:
+        """按内容哈希生成缓存键"""
+        return f"{kind}:sha256:{sha256}"
 
     def _detect_image_mime_type(self, data: bytes) -> str:
         """检测图片 MIME 类型"""
@@ -234,3 +429,5 @@ class VisionService:
 
 # 全局服务实例
 vision_service = VisionService()
+VISION_COALESCED.set_function(lambda: vision_service._flights.shared)
+VISION_QUEUED.set_function(lambda: vision_service._limiter.waiting())
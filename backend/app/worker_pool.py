@@ -0,0 +1,69 @@
+"""异步任务池 - 固定数量的 worker 从有界队列中取任务执行"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class WorkerPool:
+    """固定数量 worker 的异步任务池
+
+    submit 返回一个 Future，任务完成后得到结果；队列满时 submit 等待
+    """
+
+    def __init__(self, name: str, workers: int, max_pending: int = 0):
+        self._name = name
+        self._workers = workers
+        self._queue: asyncio.Queue[tuple[Callable[[], Awaitable], asyncio.Future]] = asyncio.Queue(max_pending)
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._worker(), name=f"{self._name}-{i}")
+                for i in range(self._workers)
+            ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+    async def submit(self, fn: Callable[[], Awaitable[T]]) -> "asyncio.Future[T]":
+        """提交任务，返回结果 Future"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, future))
+        return future
+
+    def submit_nowait(self, fn: Callable[[], Awaitable[T]]) -> "asyncio.Future[T]":
+        """提交任务，队列满时抛出 asyncio.QueueFull"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, future))
+        return future
+
+    def pending(self) -> int:
+        """排队中的任务数"""
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            fn, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            try:
+                result = await fn()
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"{self._name} task failed: {e}")
+                if not future.done():
+                    future.set_exception(e)
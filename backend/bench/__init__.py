@@ -0,0 +1 @@
+"""端到端基准测试 - 进程内启动后端，配合模拟的 NapCat 服务端和 MC 客户端测量吞吐与延迟"""
@@ -0,0 +1,143 @@
+"""模拟的 NapCat (OneBot v11) WebSocket 服务端
+
+按固定速率推送群消息事件，延迟指定时间后响应 API 调用；
+从收到的 send_group_msg 中解析 MC 消息的编号，记录 MC → QQ 的延迟
+"""
+import asyncio
+import itertools
+import logging
+import re
+import time
+from typing import Optional
+
+import websockets
+
+from app.json_codec import dumps_text, loads
+
+logger = logging.getLogger(__name__)
+
+# 模拟 MC 客户端发送的消息内容为 "mc-<编号>"，发件箱格式化为 "[MC] 玩家: mc-<编号>"
+MC_ID_PATTERN = re.compile(r"\bmc-(\d+)\b")
+
+
+class FakeNapCat:
+    """模拟的 NapCat 服务端
+
+    rate 为每秒推送的群消息数，消息内容为 "qq-<编号>"，sent_at 记录每条消息的推送时间；
+    API 调用在 latency 秒后返回成功，received_at 记录每条 MC 消息到达的时间
+    """
+
+    def __init__(self, group_id: int, rate: float, latency: float):
+        self.group_id = group_id
+        self.rate = rate
+        self.latency = latency
+        self.sent_at: dict[int, float] = {}  # QQ 消息编号 -> 推送时间
+        self.received_at: dict[int, float] = {}  # MC 消息编号 -> 到达时间
+        self.api_calls = 0
+        self._ids = itertools.count(1)
+        self._server: Optional[websockets.Server] = None
+        self._connected = asyncio.Event()
+        self._emitting = False
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await websockets.serve(self._handle, host, port)
+
+    async def close(self):
+        self._emitting = False
+        for task in self._tasks:
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def wait_connected(self, timeout: float):
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    def start_emitting(self):
+        self._emitting = True
+
+    def stop_emitting(self):
+        self._emitting = False
+
+    async def _handle(self, websocket):
+        logger.info("Backend connected to fake NapCat")
+        self._connected.set()
+        emitter = asyncio.create_task(self._emit(websocket))
+        try:
+            async for raw in websocket:
+                request = loads(raw)
+                if "action" in request:
+                    self._spawn(self._respond(websocket, request))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            emitter.cancel()
+            self._connected.clear()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _emit(self, websocket):
+        """按固定时间表推送群消息，落后时立即补齐，不累积误差"""
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        while True:
+            if not self._emitting or self.rate <= 0:
+                await asyncio.sleep(0.01)
+                next_at = loop.time()
+                continue
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at += 1 / self.rate
+            msg_id = next(self._ids)
+            self.sent_at[msg_id] = time.perf_counter()
+            await websocket.send(dumps_text(self._group_event(msg_id)))
+
+    def _group_event(self, msg_id: int) -> dict:
+        user_id = 10000 + msg_id % 50
+        return {
+            "post_type": "message",
+            "message_type": "group",
+            "sub_type": "normal",
+            "time": int(time.time()),
+            "self_id": 1,
+            "message_id": msg_id,
+            "group_id": self.group_id,
+            "user_id": user_id,
+            "sender": {"user_id": user_id, "nickname": f"bench{user_id}", "card": ""},
+            "message": [{"type": "text", "data": {"text": f"qq-{msg_id}"}}]
+        }
+
+    async def _respond(self, websocket, request: dict):
+        # 以请求到达的时间计算延迟，响应延迟只影响后端的发送节奏
+        if request["action"] == "send_group_msg":
+            self._record(request.get("params", {}).get("message"))
+        self.api_calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        response = {
+            "status": "ok",
+            "retcode": 0,
+            "data": {"message_id": self.api_calls},
+            "echo": request.get("echo")
+        }
+        try:
+            await websocket.send(dumps_text(response))
+        except websockets.ConnectionClosed:
+            pass
+
+    def _record(self, message):
+        # 发件箱可能把多条消息合并为一条多行消息，也可能以消息段形式发送
+        if isinstance(message, list):
+            message = "".join(seg.get("data", {}).get("text", "") for seg in message)
+        now = time.perf_counter()
+        for match in MC_ID_PATTERN.finditer(message or ""):
+            self.received_at.setdefault(int(match.group(1)), now)
@@ -0,0 +1,413 @@
+"""端到端压力测试
+
+在同一进程内启动后端和模拟的 NapCat 服务端，模拟的 MC 客户端通过 /api/messages/poll 长轮询接收 QQ 消息、
+通过 /api/messages/send 发送 MC 消息，统计两个方向的 p50/p99 延迟、吞吐和进程内存，并与保存的基线比较。
+
+用法（在 backend 目录下）：
+    python -m bench.run                    # 运行并与 bench/baseline.json 比较，性能回退时退出码为 1
+    python -m bench.run --update-baseline  # 运行并把结果保存为新的基线
+
+默认重复运行 3 次（--runs），每次在独立的子进程中进行，各指标取中位数，丢失和错误取最大值。
+
+后端的队列、状态和缓存都写入临时目录，工作目录也切换到该目录，不读取开发环境的 .env 和 data/。
+基线与机器相关：默认允许 30% 的波动（延迟另加 10 毫秒），超出才算回退；更换机器后需要用 --update-baseline 重新生成
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+from bench.fake_napcat import FakeNapCat
+
+logger = logging.getLogger("bench")
+
+BENCH_TOKEN = "bench-token"
+BENCH_GROUP_ID = 900000001
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+
+# 模拟 NapCat 推送的消息内容为 "qq-<编号>"
+QQ_ID_PATTERN = re.compile(r"\bqq-(\d+)\b")
+
+# 与基线比较的参数，参数不同的结果没有可比性
+PARAM_KEYS = ("duration", "qq_rate", "mc_rate", "clients", "napcat_latency_ms", "merge_window_ms")
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description="MC-QQ bridge end-to-end load test")
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of traffic before measuring")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for in-flight messages")
+    parser.add_argument("--qq-rate", type=float, default=50, help="QQ group messages per second from fake NapCat")
+    parser.add_argument("--mc-rate", type=float, default=20, help="MC chat messages per second across all clients")
+    parser.add_argument("--clients", type=int, default=4, help="simulated MC servers, each with its own consumer")
+    parser.add_argument("--napcat-latency-ms", type=float, default=20, help="fake NapCat API response delay")
+    parser.add_argument("--merge-window-ms", type=int, default=50, help="OUTBOX_MERGE_WINDOW_MS for the run")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--update-baseline", action="store_true", help="save this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative regression")
+    parser.add_argument("--latency-slack-ms", type=float, default=10, help="absolute latency slack on top of tolerance")
+    parser.add_argument("--output", type=Path, help="also write the results as JSON to this file")
+    parser.add_argument("--runs", type=int, default=3, help="repetitions, each in a fresh process; medians are reported")
+    parser.add_argument("--log-level", default="WARNING")
+    # 子进程只运行一次并把结果写入 --output
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    # 运行时会切换工作目录
+    args.baseline = args.baseline.resolve()
+    if args.output:
+        args.output = args.output.resolve()
+    return args
+
+
+def configure_backend(args: argparse.Namespace, napcat_port: int, data_dir: str):
+    """导入后端前通过环境变量配置：单频道，发件箱不限速，只测后端本身的开销
+
+    所有持久化路径指向 data_dir，每次运行都从空队列开始，也不会改动开发环境的数据
+    """
+    os.environ.update({
+        "API_TOKEN": BENCH_TOKEN,
+        "QQ_GROUP_ID": str(BENCH_GROUP_ID),
+        "CHANNELS": "[]",
+        "NAPCAT_WS_URL": f"ws://127.0.0.1:{napcat_port}",
+        "NAPCAT_ACCESS_TOKEN": "",
+        "QUEUE_DATA_DIR": os.path.join(data_dir, "queue"),
+        "STATE_BACKEND": "memory",
+        "STATE_PATH": os.path.join(data_dir, "state.sqlite3"),
+        "VISION_CACHE_PATH": os.path.join(data_dir, "vision_cache.sqlite3"),
+        "MC_SERVER_DIR": os.path.join(data_dir, "server"),
+        "WORKERS": "1",
+        "OUTBOX_MERGE_WINDOW_MS": str(args.merge_window_ms),
+        "OUTBOX_RATE_PER_SECOND": "1000",
+        "OUTBOX_BURST": "1000",
+        "LOG_LEVEL": args.log_level,
+    })
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """最近秩百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def current_rss_mb() -> float:
+    """当前进程的常驻内存，/proc 不可用时退回到峰值"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class McClient:
+    """模拟的 MC 服务器：长轮询接收 QQ 消息，按固定速率发送聊天消息"""
+
+    def __init__(self, index: int, base_url: str, ids: itertools.count, sent_at: dict[int, float]):
+        self.consumer = f"bench-{index}"
+        self.player = f"Steve{index}"
+        self.received_at: dict[int, float] = {}  # QQ 消息编号 -> 收到时间
+        self.send_errors = 0
+        self.poll_errors = 0
+        self._ids = ids
+        self._sent_at = sent_at
+        self._http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Authorization": f"Bearer {BENCH_TOKEN}"},
+            timeout=10
+        )
+
+    async def close(self):
+        await self._http.aclose()
+
+    async def poll_loop(self, stop: asyncio.Event):
+        since = 0
+        while not stop.is_set():
+            try:
+                response = await self._http.get(
+                    "/api/messages/poll",
+                    params={"wait": 1, "consumer": self.consumer, "since": since}
+                )
+            except httpx.HTTPError:
+                self.poll_errors += 1
+                continue
+            if response.status_code == 204:
+                continue
+            if response.status_code != 200:
+                self.poll_errors += 1
+                continue
+            now = time.perf_counter()
+            body = response.json()
+            for message in body["messages"]:
+                match = QQ_ID_PATTERN.search(message.get("content", ""))
+                if match:
+                    self.received_at.setdefault(int(match.group(1)), now)
+            since = body["last_seq"]
+
+    async def send_loop(self, rate: float, stop: asyncio.Event):
+        """按固定时间表发送，落后时立即补齐"""
+        if rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        while not stop.is_set():
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at += 1 / rate
+            msg_id = next(self._ids)
+            self._sent_at[msg_id] = time.perf_counter()
+            try:
+                response = await self._http.post(
+                    "/api/messages/send",
+                    json={"type": "player_chat", "player": self.player, "message": f"mc-{msg_id}"}
+                )
+            except httpx.HTTPError:
+                self.send_errors += 1
+                continue
+            if response.status_code != 202:
+                self.send_errors += 1
+
+
+def summarize(sent_at: dict[int, float], deliveries: list[dict[int, float]], ids: range, duration: float) -> dict:
+    """统计测量窗口内发出的消息：每个接收方都应收到每条消息"""
+    latencies = [
+        (received[msg_id] - sent_at[msg_id]) * 1000
+        for received in deliveries
+        for msg_id in ids
+        if msg_id in received
+    ]
+    expected = len(ids) * len(deliveries)
+    return {
+        "sent": len(ids),
+        "delivered": len(latencies),
+        "lost": expected - len(latencies),
+        "msgs_per_s": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+async def run(args: argparse.Namespace, data_dir: str) -> dict:
+    import uvicorn
+
+    fake = FakeNapCat(BENCH_GROUP_ID, args.qq_rate, args.napcat_latency_ms / 1000)
+    await fake.start()
+    configure_backend(args, fake.port, data_dir)
+    # 相对路径（包括 .env）都解析到临时目录
+    os.chdir(data_dir)
+
+    # 配置完成后才能导入后端，设置在导入时读取
+    from app.main import app
+
+    # 由 uvicorn 绑定随机端口：自行创建的 socket 协议号为 0，asyncio 不会为其连接关闭 Nagle 算法
+    server = uvicorn.Server(uvicorn.Config(
+        app, host="127.0.0.1", port=0, log_level=args.log_level.lower(), access_log=False
+    ))
+    server_task = asyncio.create_task(server.serve())
+
+    mc_ids = itertools.count(1)
+    mc_sent_at: dict[int, float] = {}
+    clients: list[McClient] = []
+    stop_polling = asyncio.Event()
+    stop_sending = asyncio.Event()
+    tasks: list[asyncio.Task] = []
+    rss_samples: list[float] = []
+    try:
+        while not server.started:
+            if server_task.done():
+                raise RuntimeError("Backend failed to start")
+            await asyncio.sleep(0.05)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        clients += [McClient(i, f"http://127.0.0.1:{port}", mc_ids, mc_sent_at) for i in range(args.clients)]
+        await fake.wait_connected(timeout=10)
+        logger.warning(f"Backend on port {port}, fake NapCat on port {fake.port}")
+
+        tasks += [asyncio.create_task(client.poll_loop(stop_polling)) for client in clients]
+        # 等所有消费者注册后再推送，避免首批消息只被部分客户端收到
+        await asyncio.sleep(0.2)
+        fake.start_emitting()
+        tasks += [
+            asyncio.create_task(client.send_loop(args.mc_rate / len(clients), stop_sending))
+            for client in clients
+        ]
+
+        await asyncio.sleep(args.warmup)
+        qq_first, mc_first = len(fake.sent_at) + 1, len(mc_sent_at) + 1
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration:
+            await asyncio.sleep(0.5)
+            rss_samples.append(current_rss_mb())
+        fake.stop_emitting()
+        stop_sending.set()
+        measured = time.perf_counter() - started
+        qq_last, mc_last = len(fake.sent_at), len(mc_sent_at)
+
+        await asyncio.sleep(args.drain)
+    finally:
+        stop_polling.set()
+        stop_sending.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for client in clients:
+            await client.close()
+        server.should_exit = True
+        await server_task
+        await fake.close()
+
+    return {
+        "params": {key: getattr(args, key) for key in PARAM_KEYS},
+        "qq_to_mc": summarize(
+            fake.sent_at, [client.received_at for client in clients], range(qq_first, qq_last + 1), measured
+        ),
+        "mc_to_qq": summarize(mc_sent_at, [fake.received_at], range(mc_first, mc_last + 1), measured),
+        "errors": {
+            "send": sum(client.send_errors for client in clients),
+            "poll": sum(client.poll_errors for client in clients),
+        },
+        "rss_mb": round(max(rss_samples, default=current_rss_mb()), 1),
+        "peak_rss_mb": round(max(peak_rss_mb(), *rss_samples), 1),
+    }
+
+
+def run_in_child(args: argparse.Namespace, index: int, data_dir: str) -> dict:
+    """在独立的子进程中运行一次，后端的全局状态不会带入下一次运行"""
+    output = Path(data_dir) / f"run-{index}.json"
+    argv = [
+        sys.executable, "-m", "bench.run", "--child", "--output", str(output),
+        "--warmup", str(args.warmup), "--drain", str(args.drain), "--log-level", args.log_level
+    ]
+    for key in PARAM_KEYS:
+        argv += [f"--{key.replace('_', '-')}", str(getattr(args, key))]
+    subprocess.run(argv, cwd=BACKEND_DIR, check=True)
+    return json.loads(output.read_text())
+
+
+def merge_runs(args: argparse.Namespace, results: list[dict]) -> dict:
+    """各指标取中位数，丢失和错误取最大值"""
+    merged = {"params": {key: getattr(args, key) for key in PARAM_KEYS}, "runs": len(results)}
+    for direction in ("qq_to_mc", "mc_to_qq"):
+        runs = [result[direction] for result in results]
+        merged[direction] = {
+            key: (max if key == "lost" else statistics.median)(run[key] for run in runs)
+            for key in runs[0]
+        }
+    merged["errors"] = {key: max(result["errors"][key] for result in results) for key in results[0]["errors"]}
+    merged["rss_mb"] = statistics.median(result["rss_mb"] for result in results)
+    merged["peak_rss_mb"] = max(result["peak_rss_mb"] for result in results)
+    return merged
+
+
+def compare(result: dict, baseline: dict, tolerance: float, latency_slack_ms: float) -> list[str]:
+    """返回相对基线的性能回退，延迟和内存越低越好，吞吐越高越好，丢失不得多于基线"""
+    regressions = []
+
+    def check_higher(name: str, current: float, base: float, slack: float = 0.0):
+        limit = base * (1 + tolerance) + slack
+        if current > limit:
+            regressions.append(f"{name}: {current} > {limit:.2f} (baseline {base})")
+
+    for direction in ("qq_to_mc", "mc_to_qq"):
+        current, base = result[direction], baseline[direction]
+        check_higher(f"{direction}.p50_ms", current["p50_ms"], base["p50_ms"], latency_slack_ms)
+        check_higher(f"{direction}.p99_ms", current["p99_ms"], base["p99_ms"], latency_slack_ms)
+        limit = base["msgs_per_s"] * (1 - tolerance)
+        if current["msgs_per_s"] < limit:
+            regressions.append(
+                f"{direction}.msgs_per_s: {current['msgs_per_s']} < {limit:.1f} (baseline {base['msgs_per_s']})"
+            )
+        if current["lost"] > base["lost"]:
+            regressions.append(f"{direction}.lost: {current['lost']} > {base['lost']}")
+    check_higher("rss_mb", result["rss_mb"], baseline["rss_mb"])
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"{'direction':<10} {'sent':>7} {'delivered':>10} {'lost':>6} {'msgs/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for direction in ("qq_to_mc", "mc_to_qq"):
+        r = result[direction]
+        print(
+            f"{direction:<10} {r['sent']:>7} {r['delivered']:>10} {r['lost']:>6} "
+            f"{r['msgs_per_s']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8}"
+        )
+    errors = result["errors"]
+    print(f"errors: send={errors['send']} poll={errors['poll']}")
+    print(f"rss: {result['rss_mb']} MB (peak {result['peak_rss_mb']} MB)")
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    with tempfile.TemporaryDirectory(prefix="mcqq-bench-") as data_dir:
+        if args.child or args.runs <= 1:
+            try:
+                result = asyncio.run(run(args, data_dir))
+            finally:
+                os.chdir(BACKEND_DIR)
+        else:
+            results = []
+            for index in range(args.runs):
+                print(f"Run {index + 1}/{args.runs}...", flush=True)
+                results.append(run_in_child(args, index, data_dir))
+            result = merge_runs(args, results)
+
+    encoded = json.dumps(result, indent=2) + "\n"
+    if args.child:
+        args.output.write_text(encoded)
+        return 0
+    print_report(result)
+    if args.output:
+        args.output.write_text(encoded)
+    if args.update_baseline:
+        args.baseline.write_text(encoded)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create one")
+        return 0
+    baseline = json.loads(args.baseline.read_text())
+    if baseline["params"] != result["params"]:
+        print(f"Baseline was recorded with different parameters: {baseline['params']}")
+        return 2
+    print(
+        f"Comparing with {args.baseline.name}: tolerance {args.tolerance:.0%}, "
+        f"latency slack {args.latency_slack_ms:g} ms"
+    )
+    regressions = compare(result, baseline, args.tolerance, args.latency_slack_ms)
+    if regressions:
+        print("Performance regressions against baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        print("The baseline is machine-specific; on a different machine regenerate it with --update-baseline")
+        return 1
+    print("No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,15 +3,22 @@
 MC-QQ Chat Bridge Backend Launcher
 """
 
+import sys
+
 import uvicorn
 from app.config import settings
+from app.state import STATE_SQLITE
 
 if __name__ == "__main__":
+    if settings.workers > 1 and settings.state_backend != STATE_SQLITE:
+        # 进程内状态无法共享，多个 worker 会各自持有一份队列并各自连接 NapCat
+        sys.exit(f"WORKERS={settings.workers} requires STATE_BACKEND={STATE_SQLITE}")
     uvicorn.run(
         "app.main:app",
         host=settings.host,
         port=settings.port,
         reload=False,
+        workers=settings.workers,
         log_level=settings.log_level.lower()
     )
 
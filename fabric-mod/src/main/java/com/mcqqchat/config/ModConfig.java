@@ -25,6 +25,19 @@ public class ModConfig {
     // 轮询间隔（毫秒）
     public int pollInterval = 1000;
 
+    // 长轮询等待时间（秒），0 表示关闭长轮询，使用固定间隔轮询
+    public int longPollSeconds = 25;
+
+    // 消费者 ID，多个 MC 服务器连接同一后端时需各不相同，留空使用后端默认消费者
+    public String consumerId = "";
+
+    // WebSocket 长连接，断开时自动退回 HTTP 轮询
+    public boolean useWebSocket = true;
+    public int wsHeartbeatSeconds = 20;
+
+    // MC → QQ 事件的合并窗口（毫秒），窗口内的事件在一次请求中批量发送，0 表示逐条发送
+    public int batchWindowMs = 50;
+
     // 消息格式
     public String mcToQqFormat = "[MC] {player}: {message}";
     public String qqToMcFormat = "§b[QQ] §e{nickname}§7({qq})§f: {message}";
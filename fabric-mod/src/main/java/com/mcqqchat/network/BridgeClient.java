@@ -10,20 +10,52 @@ import net.minecraft.server.MinecraftServer;
 
 import java.io.IOException;
 import java.net.URI;
+import java.net.URLEncoder;
 import java.net.http.HttpClient;
 import java.net.http.HttpRequest;
 import java.net.http.HttpResponse;
+import java.nio.charset.StandardCharsets;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
 import java.time.Duration;
+import java.util.ArrayList;
+import java.util.Collections;
+import java.util.HexFormat;
+import java.util.List;
+import java.util.Map;
+import java.util.UUID;
+import java.util.concurrent.CompletableFuture;
+import java.util.concurrent.ConcurrentHashMap;
 import java.util.concurrent.Executors;
 import java.util.concurrent.ScheduledExecutorService;
 import java.util.concurrent.TimeUnit;
+import java.util.function.Supplier;
 
 public class BridgeClient {
     private final ModConfig config;
     private final HttpClient httpClient;
     private final Gson gson;
+    private final BridgeWebSocket webSocket;
     private ScheduledExecutorService scheduler;
+    private Thread longPollThread;
     private volatile boolean running = false;
+    // 单次批量提交的最大事件数，与后端一致
+    private static final int MAX_BATCH_SIZE = 500;
+    // 单条事件或一批事件因网络错误或后端 5xx 发送失败时的最大尝试次数
+    private static final int MAX_SEND_ATTEMPTS = 3;
+    // 等待后端确认 WebSocket 上行事件的时间，超时后改用 HTTP 以同一个幂等键重发
+    private static final long WS_ACK_TIMEOUT_MS = 5000;
+    // 已通过 WebSocket 发出、等待确认的事件：帧 ID（即幂等键） -> 确认帧
+    private final Map<String, CompletableFuture<JsonObject>> pendingAcks = new ConcurrentHashMap<>();
+    // 已处理到的消息序号，-1 表示尚未收到过响应（后端从游标开始返回，同样不自动确认）
+    private volatile long lastSeq = -1;
+    // 上次发给后端的玩家列表（已排序），null 表示下次需要发送完整列表
+    private volatile List<String> sentPlayers = null;
+    // 合并窗口内等待批量发送的事件，flushScheduled 同样由 pendingEvents 保护
+    private final List<JsonObject> pendingEvents = new ArrayList<>();
+    private boolean flushScheduled = false;
+    // 最近一次提交的事件发送，后续发送串在它之后以保持事件顺序，由 this 保护
+    private CompletableFuture<Integer> sendChain = CompletableFuture.completedFuture(0);
 
     public BridgeClient(ModConfig config) {
         this.config = config;
@@ -32,6 +64,7 @@ public class BridgeClient {
                 .version(HttpClient.Version.HTTP_1_1)  // 强制使用 HTTP/1.1
                 .connectTimeout(Duration.ofSeconds(10))
                 .build();
+        this.webSocket = new BridgeWebSocket(config, httpClient, gson, this::handleFrame);
     }
 
     public void start() {
@@ -44,17 +77,36 @@ public class BridgeClient {
             return t;
         });
 
-        // 定期轮询消息
-        scheduler.scheduleAtFixedRate(this::pollMessages, 1000, config.pollInterval, TimeUnit.MILLISECONDS);
+        if (config.longPollSeconds > 0) {
+            // 长轮询：独立线程循环挂起等待，避免阻塞发送和玩家列表更新
+            longPollThread = new Thread(this::longPollLoop, "MC-QQ-Bridge-LongPoll");
+            longPollThread.setDaemon(true);
+            longPollThread.start();
+        } else {
+            // 定期轮询消息
+            scheduler.scheduleAtFixedRate(this::pollMessages, 1000, config.pollInterval, TimeUnit.MILLISECONDS);
+        }
         
         // 定期更新玩家列表（每5秒）
         scheduler.scheduleAtFixedRate(this::updatePlayerList, 2000, 5000, TimeUnit.MILLISECONDS);
 
-        McQqChat.LOGGER.info("Bridge client started, polling every {}ms", config.pollInterval);
+        if (config.useWebSocket) {
+            // 维持 WebSocket 连接：未连接时重连，已连接时发送心跳
+            scheduler.scheduleWithFixedDelay(this::maintainWebSocket, 0, config.wsHeartbeatSeconds, TimeUnit.SECONDS);
+        }
+
+        if (config.longPollSeconds > 0) {
+            McQqChat.LOGGER.info("Bridge client started, long polling with {}s timeout", config.longPollSeconds);
+        } else {
+            McQqChat.LOGGER.info("Bridge client started, polling every {}ms", config.pollInterval);
+        }
     }
 
     public void stop() {
         running = false;
+        if (longPollThread != null) {
+            longPollThread.interrupt();
+        }
         if (scheduler != null) {
             scheduler.shutdown();
             try {
@@ -65,17 +117,149 @@ public class BridgeClient {
                 scheduler.shutdownNow();
             }
         }
+        webSocket.close();
         McQqChat.LOGGER.info("Bridge client stopped");
     }
 
+    private void maintainWebSocket() {
+        if (!running) return;
+
+        if (webSocket.isConnected()) {
+            webSocket.heartbeat();
+        } else {
+            webSocket.connect();
+        }
+    }
+
+    private void handleFrame(JsonObject frame) {
+        String op = frame.has("op") ? frame.get("op").getAsString() : "";
+
+        switch (op) {
+            case "messages":
+                JsonArray messages = frame.getAsJsonArray("messages");
+                if (messages != null) {
+                    for (JsonElement element : messages) {
+                        handleIncomingMessage(element.getAsJsonObject());
+                    }
+                }
+                if (frame.has("last_seq")) {
+                    // 确认已处理，未确认的消息在重连后会重新推送
+                    lastSeq = frame.get("last_seq").getAsLong();
+                    JsonObject ack = new JsonObject();
+                    ack.addProperty("op", "ack");
+                    ack.addProperty("seq", lastSeq);
+                    webSocket.send(ack);
+                }
+                break;
+            case "ack":
+                if (frame.has("id") && frame.get("id").isJsonPrimitive()) {
+                    CompletableFuture<JsonObject> pending = pendingAcks.remove(frame.get("id").getAsString());
+                    if (pending != null) pending.complete(frame);
+                }
+                break;
+            case "players":
+                if (frame.has("resync") && frame.get("resync").getAsBoolean()) {
+                    // 后端的玩家列表与本地不一致（如后端重启），下次发送完整列表
+                    sentPlayers = null;
+                }
+                break;
+            default:
+                break;
+        }
+    }
+
+    /**
+     * 通过 WebSocket 发送上行帧，未连接时返回 false
+     */
+    private boolean sendViaWebSocket(String op, JsonObject data) {
+        if (!config.useWebSocket) return false;
+
+        JsonObject frame = new JsonObject();
+        frame.addProperty("op", op);
+        frame.add("data", data);
+        return webSocket.send(frame);
+    }
+
+    /**
+     * 通过 WebSocket 发送事件并等待后端确认，帧 ID 即幂等键
+     *
+     * @return 确认中的状态码（与 HTTP 接口一致），未连接或超时未确认时为 -1
+     */
+    private CompletableFuture<Integer> sendViaWebSocketAcked(String op, JsonObject data, String id) {
+        if (!config.useWebSocket || !webSocket.isConnected()) return CompletableFuture.completedFuture(-1);
+
+        CompletableFuture<JsonObject> ack = new CompletableFuture<>();
+        pendingAcks.put(id, ack);
+        JsonObject frame = new JsonObject();
+        frame.addProperty("op", op);
+        frame.addProperty("id", id);
+        frame.add("data", data);
+        if (!webSocket.send(frame)) {
+            pendingAcks.remove(id);
+            return CompletableFuture.completedFuture(-1);
+        }
+
+        return ack.orTimeout(WS_ACK_TIMEOUT_MS, TimeUnit.MILLISECONDS).handle((json, e) -> {
+            pendingAcks.remove(id);
+            if (e != null) {
+                McQqChat.LOGGER.debug("No WebSocket ack for {}, falling back to HTTP", id);
+                return -1;
+            }
+            int status = json.has("code") ? json.get("code").getAsInt() : 200;
+            if (json.has("success") && !json.get("success").getAsBoolean()) {
+                // 批量提交的确认带有逐条结果
+                McQqChat.LOGGER.warn("Send failed with status: {} - {}", status, json.has("results") ? json.get("results") : json.get("message"));
+            }
+            return status;
+        });
+    }
+
+    private void longPollLoop() {
+        while (running) {
+            if (webSocket.isConnected()) {
+                // WebSocket 已接管消息推送
+                try {
+                    Thread.sleep(1000);
+                } catch (InterruptedException e) {
+                    return;
+                }
+                continue;
+            }
+            if (!pollMessages(config.longPollSeconds)) {
+                // 失败时退避，避免后端不可用时空转
+                try {
+                    Thread.sleep(Math.max(config.pollInterval, 1000));
+                } catch (InterruptedException e) {
+                    return;
+                }
+            }
+        }
+    }
+
     private void pollMessages() {
+        if (webSocket.isConnected()) return;
+        pollMessages(0);
+    }
+
+    /**
+     * 轮询消息，waitSeconds > 0 时使用长轮询
+     *
+     * @return 请求是否成功
+     */
+    private boolean pollMessages(int waitSeconds) {
         try {
+            StringBuilder uri = new StringBuilder(config.backendUrl).append("/api/messages/poll?wait=").append(waitSeconds);
+            if (!config.consumerId.isEmpty()) {
+                uri.append("&consumer=").append(URLEncoder.encode(config.consumerId, StandardCharsets.UTF_8));
+            }
+            // since 同时确认之前的消息，响应丢失时会重新拉取；始终携带 since，第一次轮询也不会被自动确认
+            uri.append("&since=").append(lastSeq);
             HttpRequest request = HttpRequest.newBuilder()
-                    .uri(URI.create(config.backendUrl + "/api/messages/poll"))
+                    .uri(URI.create(uri.toString()))
                     .header("Authorization", "Bearer " + config.backendToken)
                     .header("Content-Type", "application/json")
                     .GET()
-                    .timeout(Duration.ofSeconds(5))
+                    .timeout(Duration.ofSeconds(5 + waitSeconds))
                     .build();
 
             HttpResponse<String> response = httpClient.send(request, HttpResponse.BodyHandlers.ofString());
@@ -90,11 +274,17 @@ public class BridgeClient {
                         handleIncomingMessage(msg);
                     }
                 }
+                if (json.has("last_seq")) {
+                    lastSeq = json.get("last_seq").getAsLong();
+                }
             } else if (response.statusCode() != 204) {
                 McQqChat.LOGGER.warn("Poll failed with status: {}", response.statusCode());
+                return false;
             }
+            return true;
         } catch (IOException | InterruptedException e) {
             McQqChat.LOGGER.debug("Poll failed: {}", e.getMessage());
+            return false;
         }
     }
 
@@ -136,7 +326,7 @@ public class BridgeClient {
         json.addProperty("type", "player_chat");
         json.addProperty("player", playerName);
         json.addProperty("message", message);
-        sendToBackend("/api/messages/send", json);
+        submitEvent(json);
     }
 
     /**
@@ -146,7 +336,7 @@ public class BridgeClient {
         JsonObject json = new JsonObject();
         json.addProperty("type", "system");
         json.addProperty("message", message);
-        sendToBackend("/api/messages/send", json);
+        submitEvent(json);
     }
 
     /**
@@ -158,34 +348,144 @@ public class BridgeClient {
         JsonObject json = new JsonObject();
         json.addProperty("type", eventType);
         json.addProperty("player", playerName);
-        sendToBackend("/api/messages/send", json);
+        submitEvent(json);
     }
 
-    private void sendToBackend(String endpoint, JsonObject data) {
+    /**
+     * 提交一条 MC 事件：合并窗口内的事件攒成一批，在一次请求中发送
+     */
+    private void submitEvent(JsonObject data) {
         if (!running) return;
 
-        // 异步发送
-        scheduler.submit(() -> {
-            try {
-                HttpRequest request = HttpRequest.newBuilder()
-                        .uri(URI.create(config.backendUrl + endpoint))
-                        .header("Authorization", "Bearer " + config.backendToken)
-                        .header("Content-Type", "application/json")
-                        .POST(HttpRequest.BodyPublishers.ofString(gson.toJson(data)))
-                        .timeout(Duration.ofSeconds(5))
-                        .build();
-
-                HttpResponse<String> response = httpClient.send(request, HttpResponse.BodyHandlers.ofString());
-
-                if (response.statusCode() != 200) {
-                    McQqChat.LOGGER.warn("Send failed with status: {} - {}", response.statusCode(), response.body());
+        if (config.batchWindowMs <= 0) {
+            sendEvent(data);
+            return;
+        }
+
+        synchronized (pendingEvents) {
+            pendingEvents.add(data);
+            if (flushScheduled) return;
+            flushScheduled = true;
+        }
+        scheduler.schedule(this::flushEvents, config.batchWindowMs, TimeUnit.MILLISECONDS);
+    }
+
+    private void flushEvents() {
+        List<JsonObject> events;
+        synchronized (pendingEvents) {
+            events = new ArrayList<>(pendingEvents);
+            pendingEvents.clear();
+            flushScheduled = false;
+        }
+
+        if (events.size() == 1) {
+            sendEvent(events.get(0));
+            return;
+        }
+        for (int start = 0; start < events.size(); start += MAX_BATCH_SIZE) {
+            List<JsonObject> chunk = new ArrayList<>(events.subList(start, Math.min(start + MAX_BATCH_SIZE, events.size())));
+            JsonArray messages = new JsonArray();
+            chunk.forEach(messages::add);
+            JsonObject batch = new JsonObject();
+            batch.add("messages", messages);
+
+            // 整批使用同一个幂等键重试，后端按 "<键>:<序号>" 逐条去重，已受理的事件不会重复投递
+            String batchKey = UUID.randomUUID().toString();
+            sendInOrder(() -> sendWithRetry("/api/messages/batch", "batch", batch, batchKey, 1).thenCompose(status -> {
+                if (status != 404) return CompletableFuture.completedFuture(status);
+                // 后端版本较旧，不支持批量接口：在同一环节内逐条发送，之后提交的事件仍排在这批之后
+                CompletableFuture<Integer> each = CompletableFuture.completedFuture(0);
+                for (JsonObject event : chunk) {
+                    String idempotencyKey = UUID.randomUUID().toString();
+                    each = each.thenCompose(previous -> postEvent(event, idempotencyKey));
                 }
-            } catch (IOException | InterruptedException e) {
-                McQqChat.LOGGER.debug("Send failed: {}", e.getMessage());
+                return each;
+            }));
+        }
+    }
+
+    /**
+     * 发送单条事件，携带幂等键；网络错误或后端 5xx 时用同一个键重试，后端只会投递一次
+     */
+    private void sendEvent(JsonObject event) {
+        String idempotencyKey = UUID.randomUUID().toString();
+        sendInOrder(() -> postEvent(event, idempotencyKey));
+    }
+
+    private CompletableFuture<Integer> postEvent(JsonObject event, String idempotencyKey) {
+        return sendWithRetry("/api/messages/send", "message", event, idempotencyKey, 1);
+    }
+
+    /**
+     * 网络错误或后端 5xx 时用同一个幂等键重试；重试在同一环节内延迟进行，
+     * 重试结束前后续事件不会发出，事件顺序不受重试影响
+     */
+    private CompletableFuture<Integer> sendWithRetry(String endpoint, String wsOp, JsonObject data, String idempotencyKey, int attempt) {
+        return sendToBackend(endpoint, wsOp, data, idempotencyKey).thenCompose(status -> {
+            if ((status == -1 || status >= 500) && attempt < MAX_SEND_ATTEMPTS && running) {
+                return CompletableFuture
+                        .runAsync(() -> {}, CompletableFuture.delayedExecutor(1000L << (attempt - 1), TimeUnit.MILLISECONDS))
+                        .thenCompose(ignored -> sendWithRetry(endpoint, wsOp, data, idempotencyKey, attempt + 1));
             }
+            return CompletableFuture.completedFuture(status);
+        });
+    }
+
+    /**
+     * 在上一次提交的发送完成后再开始 send，事件按提交顺序到达后端
+     */
+    private synchronized CompletableFuture<Integer> sendInOrder(Supplier<CompletableFuture<Integer>> send) {
+        sendChain = sendChain
+                .thenCompose(previous -> send.get())
+                .exceptionally(e -> -1);
+        return sendChain;
+    }
+
+    /**
+     * 异步发送到后端，优先使用 WebSocket，未收到确认时改用 HTTP；两者共用幂等键，事件只会投递一次。
+     * HTTP 请求不占用轮询线程，后端处理慢时也不会推迟消息轮询和玩家列表更新
+     *
+     * @return HTTP 状态码（WebSocket 确认中的状态码与其一致），请求失败时为 -1
+     */
+    private CompletableFuture<Integer> sendToBackend(String endpoint, String wsOp, JsonObject data, String idempotencyKey) {
+        return sendViaWebSocketAcked(wsOp, data, idempotencyKey).thenCompose(status -> {
+            if (status != -1) return CompletableFuture.completedFuture(status);
+            return postToBackend(endpoint, wsOp, data, idempotencyKey);
         });
     }
+
+    private CompletableFuture<Integer> postToBackend(String endpoint, String wsOp, JsonObject data, String idempotencyKey) {
+        HttpRequest.Builder builder = HttpRequest.newBuilder()
+                .uri(URI.create(config.backendUrl + endpoint))
+                .header("Authorization", "Bearer " + config.backendToken)
+                .header("Content-Type", "application/json")
+                .POST(HttpRequest.BodyPublishers.ofString(gson.toJson(data)))
+                .timeout(Duration.ofSeconds(5))
+                .header("Idempotency-Key", idempotencyKey);
+
+        return httpClient.sendAsync(builder.build(), HttpResponse.BodyHandlers.ofString())
+                .thenApply(response -> {
+                    // /api/messages/send 受理后返回 202，投递在后端异步进行
+                    if (response.statusCode() / 100 != 2) {
+                        McQqChat.LOGGER.warn("Send failed with status: {} - {}", response.statusCode(), response.body());
+                    } else if (wsOp.equals("batch")) {
+                        JsonObject json = gson.fromJson(response.body(), JsonObject.class);
+                        if (!json.get("success").getAsBoolean()) {
+                            McQqChat.LOGGER.warn("Send failed: {}", json.get("results"));
+                        }
+                    }
+                    return response.statusCode();
+                })
+                .exceptionally(e -> {
+                    McQqChat.LOGGER.debug("Send failed: {}", e.getMessage());
+                    return -1;
+                });
+    }
     
+    /**
+     * 同步玩家列表：首次或需要重新同步时发送完整列表，之后只发送加入/离开增量，
+     * 没有变化时只发送列表摘要作为心跳
+     */
     private void updatePlayerList() {
         if (!running) return;
         
@@ -194,18 +494,32 @@ public class BridgeClient {
             if (server == null) return;
             
             // 获取在线玩家列表
-            JsonObject data = new JsonObject();
-            JsonArray players = new JsonArray();
-            
+            List<String> current = new ArrayList<>();
             server.getPlayerManager().getPlayerList().forEach(player -> {
-                players.add(player.getName().getString());
+                current.add(player.getName().getString());
             });
+            Collections.sort(current);
             
-            data.add("players", players);
+            JsonObject data = new JsonObject();
+            List<String> previous = sentPlayers;
+            if (previous == null) {
+                data.add("players", toJsonArray(current));
+            } else if (!previous.equals(current)) {
+                List<String> joined = new ArrayList<>(current);
+                joined.removeAll(previous);
+                List<String> left = new ArrayList<>(previous);
+                left.removeAll(current);
+                data.add("joined", toJsonArray(joined));
+                data.add("left", toJsonArray(left));
+            }
+            data.addProperty("hash", playersHash(current));
             data.addProperty("max_players", server.getMaxPlayerCount());
+            sentPlayers = current;
             
             // 发送到后端
             scheduler.submit(() -> {
+                if (sendViaWebSocket("players", data)) return;
+
                 try {
                     HttpRequest request = HttpRequest.newBuilder()
                             .uri(URI.create(config.backendUrl + "/api/players/update"))
@@ -215,8 +529,13 @@ public class BridgeClient {
                             .timeout(Duration.ofSeconds(5))
                             .build();
 
-                    httpClient.send(request, HttpResponse.BodyHandlers.ofString());
+                    HttpResponse<String> response = httpClient.send(request, HttpResponse.BodyHandlers.ofString());
+                    if (response.statusCode() != 200) {
+                        // 409 表示后端的列表与本地不一致，其他错误也无法确认更新已生效
+                        sentPlayers = null;
+                    }
                 } catch (IOException | InterruptedException e) {
+                    sentPlayers = null;
                     McQqChat.LOGGER.debug("Update player list failed: {}", e.getMessage());
                 }
             });
@@ -224,5 +543,24 @@ public class BridgeClient {
             McQqChat.LOGGER.debug("Error updating player list: {}", e.getMessage());
         }
     }
+
+    private static JsonArray toJsonArray(List<String> values) {
+        JsonArray array = new JsonArray();
+        values.forEach(array::add);
+        return array;
+    }
+
+    /**
+     * 玩家列表摘要：排序后以换行连接的 SHA-1，与后端的计算方式一致
+     */
+    private static String playersHash(List<String> sortedPlayers) {
+        try {
+            MessageDigest digest = MessageDigest.getInstance("SHA-1");
+            byte[] hash = digest.digest(String.join("\n", sortedPlayers).getBytes(StandardCharsets.UTF_8));
+            return HexFormat.of().formatHex(hash);
+        } catch (NoSuchAlgorithmException e) {
+            throw new IllegalStateException(e);
+        }
+    }
 }
 
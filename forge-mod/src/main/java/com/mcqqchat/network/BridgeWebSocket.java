@@ -0,0 +1,150 @@
+package com.mcqqchat.network;
+
+import com.google.gson.Gson;
+import com.google.gson.JsonObject;
+import com.mcqqchat.McQqChat;
+import com.mcqqchat.config.ModConfig;
+
+import java.net.URI;
+import java.net.URLEncoder;
+import java.net.http.HttpClient;
+import java.net.http.WebSocket;
+import java.nio.charset.StandardCharsets;
+import java.time.Duration;
+import java.util.concurrent.CompletionStage;
+import java.util.concurrent.TimeUnit;
+import java.util.function.Consumer;
+
+/**
+ * 与后端 /api/ws/mc 的长连接，断开时由 BridgeClient 退回 HTTP 轮询
+ */
+public class BridgeWebSocket implements WebSocket.Listener {
+    private final ModConfig config;
+    private final HttpClient httpClient;
+    private final Gson gson;
+    private final Consumer<JsonObject> frameHandler;
+    private final StringBuilder buffer = new StringBuilder();
+    private volatile WebSocket webSocket;
+    private volatile long lastFrameAt;
+
+    public BridgeWebSocket(ModConfig config, HttpClient httpClient, Gson gson, Consumer<JsonObject> frameHandler) {
+        this.config = config;
+        this.httpClient = httpClient;
+        this.gson = gson;
+        this.frameHandler = frameHandler;
+    }
+
+    public void connect() {
+        if (isConnected()) return;
+
+        String wsUrl = config.backendUrl.replaceFirst("^http", "ws") + "/api/ws/mc";
+        if (!config.consumerId.isEmpty()) {
+            wsUrl += "?consumer=" + URLEncoder.encode(config.consumerId, StandardCharsets.UTF_8);
+        }
+        try {
+            webSocket = httpClient.newWebSocketBuilder()
+                    .header("Authorization", "Bearer " + config.backendToken)
+                    .connectTimeout(Duration.ofSeconds(10))
+                    .buildAsync(URI.create(wsUrl), this)
+                    .get(15, TimeUnit.SECONDS);
+            lastFrameAt = System.currentTimeMillis();
+            McQqChat.LOGGER.info("WebSocket connected to {}", wsUrl);
+        } catch (Exception e) {
+            webSocket = null;
+            McQqChat.LOGGER.debug("WebSocket connect failed, using HTTP polling: {}", e.getMessage());
+        }
+    }
+
+    public boolean isConnected() {
+        WebSocket ws = webSocket;
+        return ws != null && !ws.isOutputClosed() && !ws.isInputClosed();
+    }
+
+    /**
+     * 发送心跳，超过 3 个心跳周期没有收到任何帧则断开
+     */
+    public void heartbeat() {
+        if (!isConnected()) return;
+
+        long timeout = TimeUnit.SECONDS.toMillis(config.wsHeartbeatSeconds) * 3;
+        if (System.currentTimeMillis() - lastFrameAt > timeout) {
+            McQqChat.LOGGER.warn("WebSocket heartbeat timeout, falling back to HTTP polling");
+            abort();
+            return;
+        }
+
+        JsonObject ping = new JsonObject();
+        ping.addProperty("op", "ping");
+        send(ping);
+    }
+
+    /**
+     * 发送一帧，返回 false 表示连接不可用，调用方应改用 HTTP
+     */
+    public synchronized boolean send(JsonObject frame) {
+        WebSocket ws = webSocket;
+        if (ws == null || ws.isOutputClosed()) return false;
+
+        try {
+            ws.sendText(gson.toJson(frame), true).get(5, TimeUnit.SECONDS);
+            return true;
+        } catch (Exception e) {
+            McQqChat.LOGGER.debug("WebSocket send failed: {}", e.getMessage());
+            abort();
+            return false;
+        }
+    }
+
+    public void close() {
+        WebSocket ws = webSocket;
+        webSocket = null;
+        if (ws != null) {
+            ws.sendClose(WebSocket.NORMAL_CLOSURE, "server stopping");
+        }
+    }
+
+    private void abort() {
+        WebSocket ws = webSocket;
+        webSocket = null;
+        if (ws != null) {
+            ws.abort();
+        }
+    }
+
+    @Override
+    public CompletionStage<?> onText(WebSocket ws, CharSequence data, boolean last) {
+        buffer.append(data);
+        if (last) {
+            String text = buffer.toString();
+            buffer.setLength(0);
+            lastFrameAt = System.currentTimeMillis();
+            try {
+                JsonObject frame = gson.fromJson(text, JsonObject.class);
+                if (frame != null) {
+                    frameHandler.accept(frame);
+                }
+            } catch (Exception e) {
+                McQqChat.LOGGER.debug("Invalid WebSocket frame: {}", e.getMessage());
+            }
+        }
+        ws.request(1);
+        return null;
+    }
+
+    @Override
+    public CompletionStage<?> onClose(WebSocket ws, int statusCode, String reason) {
+        if (webSocket == ws) {
+            webSocket = null;
+        }
+        McQqChat.LOGGER.info("WebSocket closed ({}): {}", statusCode, reason);
+        return null;
+    }
+
+    @Override
+    public void onError(WebSocket ws, Throwable error) {
+        if (webSocket == ws) {
+            webSocket = null;
+        }
+        McQqChat.LOGGER.debug("WebSocket error: {}", error.getMessage());
+    }
+}